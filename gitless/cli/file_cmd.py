@@ -18,8 +18,9 @@ def parser(help_msg, subcmd):
     p = subparsers.add_parser(
         subcmd, help=help_msg, description=help_msg.capitalize())
     p.add_argument(
-        'files', nargs='+', help='the file(s) to {0}'.format(subcmd),
+        'files', nargs='*', help='the file(s) to {0}'.format(subcmd),
         action=helpers.PathProcessor, repo=repo)
+    helpers.stdin_flags(p)
     p.set_defaults(func=main(subcmd))
   return f
 
@@ -29,18 +30,24 @@ def main(subcmd):
     curr_b = repo.current_branch
     success = True
 
-    for fp in args.files:
-      try:
-        getattr(curr_b, subcmd + '_file')(fp)
+    # All files are processed at once (in one index transaction)
+    files = helpers.input_paths(args, args.files, repo)
+    results = getattr(curr_b, subcmd + '_files')(files)
+    if not results:
+      pprint.err('No files to {0}'.format(subcmd))
+      return False
+
+    for fp, err in results:
+      if not err:
         pprint.ok(
             'File {0} is now a{1} {2}{3}d file'.format(
               fp, 'n' if subcmd.startswith(VOWELS) else '', subcmd,
               '' if subcmd.endswith('e') else 'e'))
-      except KeyError:
+      elif isinstance(err, KeyError):
         pprint.err('Can\'t {0} non-existent file {1}'.format(subcmd, fp))
         success = False
-      except ValueError as e:
-        pprint.err(e)
+      else:
+        pprint.err(err)
         success = False
 
     return success
@@ -8,19 +8,11 @@
 from __future__ import unicode_literals
 
 import argparse
+import importlib
+import sys
 import traceback
-import pygit2
-from sh import ErrorReturnCode
 
-from clint.textui import colored
-
-from gitless import core
-
-from . import (
-    gl_track, gl_untrack, gl_status, gl_diff, gl_commit, gl_branch, gl_tag,
-    gl_checkout, gl_merge, gl_resolve, gl_fuse, gl_remote, gl_publish,
-    gl_switch, gl_init, gl_history)
-from . import pprint
+from . import gl_server
 
 
 SUCCESS = 0
@@ -31,40 +23,63 @@ NOT_IN_GL_REPO = 4
 
 VERSION = '0.8.3'
 URL = 'http://gitless.com'
+VERSION_MSG = (
+    'GL Version: {0}\nYou can check if there\'s a new version of Gitless '
+    'available at {1}'.format(VERSION, URL))
 
+# The subcommands, subcommand x is implemented in module gl_x. We only import
+# (and build the parser of) the subcommand that is going to be run, importing
+# all of them (and their dependencies) is what dominates the startup time.
+SUB_CMDS = [
+    'track', 'untrack', 'status', 'diff', 'commit', 'branch', 'tag',
+    'checkout', 'merge', 'resolve', 'fuse', 'remote', 'publish', 'switch',
+    'init', 'history', 'server', 'watch', 'prompt', 'index', 'sparse']
 
-repo = None
-try:
-  repo = core.Repository()
-  colored.DISABLE_COLOR = not repo.config.get_bool('color.ui')
-except (core.NotInRepoError, KeyError):
-  pass
+# Subcommands that work with an index Gitless can't read (see gl index)
+_ANY_INDEX_CMDS = frozenset(['init', 'index', 'server', 'watch'])
 
 
 def main():
-  parser = argparse.ArgumentParser(
-      description=(
-          'Gitless: a version control system built on top of Git. More info, '
-          'downloads and documentation available at {0}'.format(URL)),
-      formatter_class=argparse.RawDescriptionHelpFormatter)
-  parser.add_argument(
-      '--version', action='version', version=(
-         'GL Version: {0}\nYou can check if there\'s a new version of Gitless '
-         'available at {1}'.format(VERSION, URL)))
-  subparsers = parser.add_subparsers(title='subcommands', dest='subcmd_name')
-  subparsers.required = True
+  code = gl_server.forward(sys.argv[1:], VERSION)
+  if code is None:  # no server running, run the cmd in-process
+    code = run(sys.argv[1:])
+  return code
+
+
+def run(argv, repo=None):
+  """Runs the gl command given by argv (without the program name).
+
+  Args:
+    argv: the command line arguments.
+    repo: the repository to run the command in (defaults to the repository
+      the cwd is in, which is only looked up if a subcommand is given).
+  """
+  subcmd_name = _subcmd_name(argv)
+  if not subcmd_name and '--version' in argv:
+    # What argparse's version action would do, but without importing all the
+    # subcommands to build the parser first
+    sys.stdout.write(VERSION_MSG + '\n')
+    return SUCCESS
+  if subcmd_name and not repo:
+    repo = _open_repository()
 
-  sub_cmds = [
-      gl_track, gl_untrack, gl_status, gl_diff, gl_commit, gl_branch, gl_tag,
-      gl_checkout, gl_merge, gl_resolve, gl_fuse, gl_remote, gl_publish,
-      gl_switch, gl_init, gl_history]
-  for sub_cmd in sub_cmds:
-    sub_cmd.parser(subparsers, repo)
+  parser = _parser([subcmd_name] if subcmd_name else SUB_CMDS, repo)
+  args = parser.parse_args(argv)
+
+  # If we got here a subcommand is going to be run, and that means that all of
+  # these were already imported
+  import pygit2
+  from sh import ErrorReturnCode
+
+  from gitless import core
+
+  from . import pprint
 
-  args = parser.parse_args()
   try:
     if args.subcmd_name != 'init' and not repo:
       raise core.NotInRepoError('You are not in a Gitless\'s repository')
+    if args.subcmd_name not in _ANY_INDEX_CMDS:
+      repo.check_index(split=False)
 
     return SUCCESS if args.func(args, repo) else ERRORS_FOUND
   except KeyboardInterrupt:
@@ -76,7 +91,16 @@ def main():
     pprint.err_exp('do gl init to turn this directory into an empty repository')
     pprint.err_exp('do gl init remote_repo to clone an existing repository')
     return NOT_IN_GL_REPO
-  except (ValueError, pygit2.GitError, core.GlError) as e:
+  except pygit2.GitError as e:
+    if repo and args.subcmd_name not in _ANY_INDEX_CMDS:
+      # Maybe libgit2 failed to read a split index (see check_index)
+      try:
+        repo.check_index()
+      except core.GlError as index_e:
+        e = index_e
+    pprint.err(e)
+    return ERRORS_FOUND
+  except (ValueError, core.GlError) as e:
     pprint.err(e)
     return ERRORS_FOUND
   except ErrorReturnCode as e:
@@ -89,3 +113,45 @@ def main():
         'include the following information:\n\n{1}\n\n{2}'.format(
             URL, VERSION, traceback.format_exc()))
     return INTERNAL_ERROR
+
+
+def _parser(subcmd_names, repo):
+  parser = argparse.ArgumentParser(
+      description=(
+          'Gitless: a version control system built on top of Git. More info, '
+          'downloads and documentation available at {0}'.format(URL)),
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--version', action='version', version=VERSION_MSG)
+  subparsers = parser.add_subparsers(title='subcommands', dest='subcmd_name')
+  subparsers.required = True
+
+  for subcmd_name in subcmd_names:
+    sub_cmd = importlib.import_module('.gl_' + subcmd_name, __package__)
+    sub_cmd.parser(subparsers, repo)
+  return parser
+
+
+def _subcmd_name(argv):
+  """Returns the name of the subcommand to run or None if there's none."""
+  # The main parser only has flags that take no value, so the subcommand (if
+  # any) is the first positional argument
+  for arg in argv:
+    if not arg.startswith('-'):
+      return arg if arg in SUB_CMDS else None
+  return None
+
+
+def _open_repository():
+  from clint.textui import colored
+
+  from gitless import core
+
+  try:
+    repo = core.Repository()
+  except core.NotInRepoError:
+    return None
+  try:
+    colored.DISABLE_COLOR = not repo.config.get_bool('color.ui')
+  except KeyError:
+    pass
+  return repo
@@ -22,8 +22,9 @@ def parser(subparsers, repo):
           'the commit point to checkout the files at. Defaults to HEAD.'),
       dest='cp', default='HEAD')
   checkout_parser.add_argument(
-      'files', nargs='+', help='the file(s) to checkout',
+      'files', nargs='*', help='the file(s) to checkout',
       action=helpers.PathProcessor, repo=repo)
+  helpers.stdin_flags(checkout_parser)
   checkout_parser.set_defaults(func=main)
 
 
@@ -32,28 +33,42 @@ def main(args, repo):
 
   curr_b = repo.current_branch
   cp = args.cp
+  try:
+    commit = repo.revparse_single(cp)
+  except (KeyError, ValueError):
+    pprint.err('Invalid commit point {0}'.format(cp))
+    return False
 
-  for fp in args.files:
+  files = list(helpers.input_paths(args, args.files, repo))
+  if not files:
+    pprint.err('No files to checkout')
+    return False
+  sts = curr_b.status_files(files)
+  to_checkout = []
+  for fp in files:
     conf_msg = (
         'You have uncomitted changes in "{0}" that could be overwritten by '
         'checkout'.format(fp))
-    try:
-      f = curr_b.status_file(fp)
-      if f.type == core.GL_STATUS_TRACKED and f.modified and (
-          not pprint.conf_dialog(conf_msg)):
-        pprint.err('Checkout aborted')
-        continue
-    except KeyError:
-      pass
-
-    try:
-      curr_b.checkout_file(fp, repo.revparse_single(cp))
+    f = sts.get(fp)
+    if f and f.type == core.GL_STATUS_TRACKED and f.modified and (
+        not pprint.conf_dialog(conf_msg)):
+      pprint.err('Checkout aborted')
+      continue
+    to_checkout.append(fp)
+
+  # All files are checked out at once (in one index transaction)
+  for fp, err in curr_b.checkout_files(to_checkout, commit):
+    if not err:
       pprint.ok(
           'File {0} checked out successfully to its state at {1}'.format(
               fp, cp))
-    except KeyError:
+    elif isinstance(err, KeyError):
       pprint.err('Checkout aborted')
       pprint.err('There\'s no file {0} at {1}'.format(fp, cp))
       errors_found = True
+    else:
+      pprint.err('Checkout aborted')
+      pprint.err(err)
+      errors_found = True
 
   return not errors_found
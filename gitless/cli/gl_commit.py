@@ -71,8 +71,9 @@ def main(args, repo):
 
 def _do_partial_selection(files, curr_b):
   partials = []
+  sts = curr_b.status_files(files)
   for fp in files:
-    f_st = curr_b.status_file(fp)
+    f_st = sts[fp]
     if not f_st.exists_at_head:
       pprint.warn('Can\'t select segments for new file {0}'.format(fp))
       continue
@@ -89,10 +90,13 @@ def _do_partial_selection(files, curr_b):
 
 def _auto_track(files, curr_b):
   """Tracks those untracked files in the list."""
-  for fp in files:
-    f = curr_b.status_file(fp)
-    if f.type == core.GL_STATUS_UNTRACKED:
-      curr_b.track_file(f.fp)
+  untracked = [
+      f.fp for f in curr_b.status_files(files).values()
+      if f.type == core.GL_STATUS_UNTRACKED]
+  if untracked:
+    for _, err in curr_b.track_files(untracked):
+      if err:
+        raise err
 
 
 def _op_continue(op, fn):
@@ -7,8 +7,7 @@
 
 from __future__ import unicode_literals
 
-import os
-import tempfile
+from gitless import core
 
 from . import helpers, pprint
 
@@ -22,39 +21,81 @@ def parser(subparsers, repo):
         'By default all tracked modified files are diffed. To customize the '
         ' set of files to diff use the only, exclude, and include flags'))
   helpers.oei_flags(diff_parser, repo)
+  summary_group = diff_parser.add_mutually_exclusive_group()
+  summary_group.add_argument(
+      '--stat', help=(
+          'only output the number of lines added and removed in each file and '
+          'in total'),
+      action='store_const', const='stat', dest='summary')
+  summary_group.add_argument(
+      '--numstat', help=(
+          'like --stat but in a machine-friendly format: the number of lines '
+          'added and removed and the file, separated by tabs (- for binary '
+          'files)'),
+      action='store_const', const='numstat', dest='summary')
+  summary_group.add_argument(
+      '--name-only', help='only output the name of the files with changes',
+      action='store_const', const='name-only', dest='summary')
+  diff_parser.add_argument(
+      '--full', help=(
+          'show the diffs of big files too (by default files bigger than '
+          'gitless.diffMaxSize or with more lines than gitless.diffMaxLines '
+          'are only summarized)'),
+      action='store_true')
   diff_parser.set_defaults(func=main)
 
 
 def main(args, repo):
-  files = helpers.oei_fs(args, repo)
-  if not files:
-    pprint.warn('No files to diff')
+  only, exclude, include = helpers.oei_sets(args, repo)
+  # Unless only is given, the tracked modified files are found by the diff
+  # itself (there's no need to compute the status of the repo first)
+  diff_args = {'paths': sorted(only) if only else None}
+  if not only:
+    diff_args.update(include=sorted(include), exclude=exclude)
+  curr_b = repo.current_branch
+
+  if args.summary:
+    stats = curr_b.diff_stats(**diff_args)
+    if not stats or not stats.files_changed:
+      pprint.warn('No files to diff')
+      return True
+    with helpers.Pager(repo) as pager:
+      pprint.diff_stats(stats, args.summary, stream=pager.write)
+    return True
 
   success = True
-  curr_b = repo.current_branch
-  with tempfile.NamedTemporaryFile(mode='w', delete=False) as tf:
-    for fp in files:
-      try:
-        patch = curr_b.diff_file(fp)
-      except KeyError:
-        pprint.err('Can\'t diff non-existent file {0}'.format(fp))
+  # The warnings are printed once we are done with the pager so that they
+  # don't get mixed with its output
+  warnings = []
+  diffed = False
+  with helpers.Pager(repo) as pager:
+    for fp, patch in curr_b.diff_files(full=args.full, **diff_args):
+      diffed = True
+      if not patch:
+        warnings.append((
+            pprint.err, 'Can\'t diff non-existent file {0}'.format(fp)))
         success = False
         continue
 
+      if isinstance(patch, core.DiffSummary):
+        pprint.diff(patch, stream=pager.write)
+        continue
+
       if patch.delta.is_binary:
-        pprint.warn('Not showing diffs for binary file {0}'.format(fp))
+        warnings.append((
+            pprint.warn, 'Not showing diffs for binary file {0}'.format(fp)))
         continue
 
       additions = patch.line_stats[1]
       deletions = patch.line_stats[2]
       if (not additions) and (not deletions):
-        pprint.warn('No diffs to output for {0}'.format(fp))
+        warnings.append((pprint.warn, 'No diffs to output for {0}'.format(fp)))
         continue
 
-      pprint.diff(patch, stream=tf.write)
-
-  if os.path.getsize(tf.name) > 0:
-    helpers.page(tf.name, repo)
-  os.remove(tf.name)
+      pprint.diff(patch, stream=pager.write)
 
+  if not diffed:
+    pprint.warn('No files to diff')
+  for print_fn, text in warnings:
+    print_fn(text)
   return success
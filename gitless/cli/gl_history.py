@@ -7,9 +7,6 @@
 
 from __future__ import unicode_literals
 
-import os
-import tempfile
-
 from . import helpers, pprint
 
 
@@ -21,6 +18,16 @@ def parser(subparsers, _):
   history_parser.add_argument(
       '-v', '--verbose', help='be verbose, will output the diffs of the commit',
       action='store_true')
+  history_parser.add_argument(
+      '-s', '--stat', help=(
+          'output the number of lines added and removed in each file changed '
+          'by the commit and in total'),
+      action='store_true')
+  history_parser.add_argument(
+      '--full', help=(
+          'with -v, show the diffs of big files too (by default they are only '
+          'summarized, see gl diff --full)'),
+      action='store_true')
   history_parser.add_argument(
       '-l', '--limit', help='limit number of commits displayed', type=int)
   history_parser.add_argument(
@@ -34,19 +41,23 @@ def parser(subparsers, _):
 
 def main(args, repo):
   b = helpers.get_branch(args.b, repo) if args.b else repo.current_branch
-  with tempfile.NamedTemporaryFile(mode='w', delete=False) as tf:
+  with helpers.Pager(repo) as pager:
     count = 0
     for ci in b.history():
       if args.limit and count == args.limit:
         break
-      pprint.commit(ci, compact=args.compact, stream=tf.write)
+      pprint.commit(ci, compact=args.compact, stream=pager.write)
       if not args.compact:
-        pprint.puts(stream=tf.write)
-      if args.verbose and len(ci.parents) == 1:
-        for patch in b.diff_commits(ci.parents[0], ci):
-          pprint.diff(patch, stream=tf.write)
+        pprint.puts(stream=pager.write)
+      if (args.verbose or args.stat) and len(ci.parents) == 1:
+        if args.stat:
+          diff = b.diff_commits(ci.parents[0], ci)
+          pprint.diff_stats(diff.stats, stream=pager.write)
+          pprint.puts(stream=pager.write)
+        if args.verbose:
+          for patch in b.diff_commits_files(
+              ci.parents[0], ci, full=args.full):
+            pprint.diff(patch, stream=pager.write)
 
       count += 1
-  helpers.page(tf.name, repo)
-  os.remove(tf.name)
   return True
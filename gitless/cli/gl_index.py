@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git.
+# Licensed under GNU GPL v2.
+
+"""gl index - Show or change the format of the index.
+
+Every command that changes what's tracked (track, untrack, resolve, checkout,
+commit, ...) writes the whole index, so in big repositories the cost of these
+commands is dominated by the size of the index. Git can make the index
+smaller with version 4 of the format (paths are prefix-compressed) and its
+split index mode (only the entries that changed are written, the rest are in
+a shared index), but the libgit2 version Gitless is built on can only read
+versions 2 and 3 of the format. If the index is in a format Gitless can't
+read, gl index --rewrite rewrites it (and updates the config so that git keeps
+writing it in that format).
+"""
+
+
+from __future__ import unicode_literals
+
+from gitless import core
+
+from . import pprint
+
+
+def parser(subparsers, _):
+  """Adds the index parser to the given subparsers object."""
+  desc = 'show the format of the index or rewrite it in another one'
+  index_parser = subparsers.add_parser(
+      'index', help=desc, description=desc.capitalize())
+  index_parser.add_argument(
+      '--rewrite', help=(
+          'rewrite the index in version {0} of the format (or the one given '
+          'with --version), not split'.format(core.INDEX_VERSIONS[0])),
+      action='store_true')
+  index_parser.add_argument(
+      '-v', '--version', type=int, choices=core.INDEX_VERSIONS,
+      default=core.INDEX_VERSIONS[0], help=(
+          'the version of the format to rewrite the index in (defaults to '
+          '{0})'.format(core.INDEX_VERSIONS[0])),
+      dest='version')
+  index_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  if args.rewrite:
+    repo.rewrite_index(version=args.version)
+    pprint.ok('Rewrote the index in version {0} of the format'.format(
+        args.version))
+
+  info = repo.index_info()
+  if info.version is None:
+    pprint.msg('There\'s no index yet')
+    return True
+  pprint.msg('Index version {0}{1}, {2} entries, {3:.1f} MB'.format(
+      info.version, ' (split)' if info.split else '', info.entries,
+      info.size / 1024.0 / 1024.0))
+  try:
+    repo.check_index()
+  except core.GlError as e:
+    pprint.err(e)
+    return False
+  return True
@@ -26,6 +26,11 @@ def parser(subparsers, _):
       help=(
           'an optional remote repo address from where to read to create the '
           'local repo'))
+  init_parser.add_argument(
+      '--sparse', nargs='+', help=(
+          'only check out the given dirs of the remote repo (and the files at '
+          'its root), see gl sparse'),
+      metavar='dir', dest='sparse')
   init_parser.set_defaults(func=main)
 
 
@@ -33,7 +38,10 @@ def main(args, repo):
   if repo:
     pprint.err('You are already in a Gitless repository')
     return False
-  core.init_repository(url=args.repo)
+  if args.sparse and not args.repo:
+    pprint.err('--sparse can only be used when creating a repo from a remote')
+    return False
+  core.init_repository(url=args.repo, sparse_dirs=args.sparse)
   pprint.ok('Local repo created in {0}'.format(os.getcwd()))
   if args.repo:
     pprint.ok('Initialized from remote {0}'.format(args.repo))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git.
+# Licensed under GNU GPL v2.
+
+"""gl prompt - Print a short summary of the status for shell prompts."""
+
+
+from __future__ import unicode_literals
+
+from . import pprint
+
+
+DEFAULT_TIMEOUT = 200  # in ms
+
+STALE_MARKER = '~'
+
+
+def parser(subparsers, _):
+  """Adds the prompt parser to the given subparsers object."""
+  desc = (
+      'print a one-line summary of the status (branch, op in progress and '
+      'number of changed files) meant to be used in shell prompts')
+  prompt_parser = subparsers.add_parser(
+      'prompt', help=desc, description=desc.capitalize())
+  prompt_parser.add_argument(
+      '-t', '--timeout', type=int, default=DEFAULT_TIMEOUT, help=(
+          'max number of ms to wait for the summary, if it takes longer the '
+          'last summary computed is printed followed by {0} (0 to always '
+          'wait, defaults to {1})'.format(STALE_MARKER, DEFAULT_TIMEOUT)),
+      dest='timeout')
+  prompt_parser.add_argument(
+      '--no-counts', help=(
+          'only show whether there are changes or not (faster, we stop '
+          'looking as soon as we find a change)'),
+      action='store_true', dest='no_counts')
+  prompt_parser.add_argument(
+      '--format', help=(
+          'how to format the summary, a Python format string with the fields '
+          'branch, op, dirty, modified, untracked, conflicts and stale'),
+      dest='fmt')
+  prompt_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  curr_b = repo.current_branch
+  summary = curr_b.status_summary(
+      counts=not args.no_counts,
+      timeout=args.timeout / 1000.0 if args.timeout > 0 else None)
+
+  if args.fmt:
+    def field(n):
+      return '' if n is None else n
+    out = args.fmt.format(
+        branch=summary.branch_name, op=field(summary.op),
+        dirty='*' if summary.dirty else '',
+        modified=field(summary.tracked_modified),
+        untracked=field(summary.untracked), conflicts=field(summary.conflicts),
+        stale=STALE_MARKER if summary.stale else '')
+  else:
+    out = _format(summary)
+  pprint.puts(out)
+  return True
+
+
+def _format(summary):
+  """Formats the summary like 'master|merge !1 *2 %3'.
+
+  ! is followed by the number of files in conflict, * by the number of tracked
+  modified files and % by the number of untracked files. If there are no
+  counts, there's a * if there are changes and a ? if we don't know.
+  """
+  out = summary.branch_name
+  if summary.op:
+    out += '|' + summary.op
+  if summary.dirty is None:
+    out += ' ?'
+  elif summary.tracked_modified is None:
+    if summary.dirty:
+      out += ' *'
+  else:
+    for marker, n in [
+        ('!', summary.conflicts), ('*', summary.tracked_modified),
+        ('%', summary.untracked)]:
+      if n:
+        out += ' {0}{1}'.format(marker, n)
+  if summary.stale:
+    out += ' ' + STALE_MARKER
+  return out
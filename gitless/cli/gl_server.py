@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git.
+# Licensed under GNU GPL v2.
+
+"""gl server - Keep Gitless loaded between commands.
+
+The server is opt-in and per repository: `gl server start` forks a background
+process that holds the already imported Gitless's library and listens on a
+unix socket inside the Gitless's dir. Subsequent gl commands run in that
+repository are forwarded to the server, which forks a worker to run each of
+them. The worker opens the repository (so the config is read as of the
+command, like when running it in-process) and gets the standard streams of
+the client (they are passed over the socket), so interactive commands, colors
+and paging work as if the command was run in-process. If there's no server
+running the command is run in-process as usual.
+
+This module only imports stdlib modules at the top so that forwarding a
+command stays cheap.
+"""
+
+
+from __future__ import unicode_literals
+
+import array
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+
+
+SOCKET_FILE = 'GL_SERVER_SOCK'
+PID_FILE = 'GL_SERVER_PID'
+
+DEFAULT_IDLE_TIMEOUT = 60  # in minutes
+
+# Commands that are never forwarded to the server
+NOT_SERVED = frozenset(['init', 'server'])
+
+# Same as gl.INTERNAL_ERROR (we can't import gl from here, gl imports us)
+_INTERNAL_ERROR = 3
+
+# Passing the client's standard streams requires SCM_RIGHTS support
+_CAN_SERVE = hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+_STD_FDS = [0, 1, 2]
+
+
+def parser(subparsers, _):
+  """Adds the server parser to the given subparsers object."""
+  desc = (
+      'start, stop or check a background server that keeps Gitless loaded '
+      'to speed up gl commands run in the repository')
+  server_parser = subparsers.add_parser(
+      'server', help=desc, description=desc.capitalize())
+  server_parser.add_argument(
+      'action', nargs='?', choices=['start', 'stop', 'status'],
+      default='status', help='what to do (defaults to status)')
+  server_parser.add_argument(
+      '-t', '--idle-timeout', type=int, default=DEFAULT_IDLE_TIMEOUT,
+      help=(
+          'minutes of inactivity after which the server stops (only relevant '
+          'if the server is started; defaults to {0})'.format(
+              DEFAULT_IDLE_TIMEOUT)),
+      dest='idle_timeout')
+  server_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  from . import pprint
+
+  sock_fp = os.path.join(repo.path, SOCKET_FILE)
+  pid_fp = os.path.join(repo.path, PID_FILE)
+  if args.action == 'start':
+    if not _CAN_SERVE:
+      pprint.err('The gl server is not supported on this platform')
+      return False
+    if is_running(sock_fp):
+      pprint.err('The gl server is already running for this repository')
+      return False
+    idle_timeout = args.idle_timeout * 60
+    try:
+      start_daemon(
+          sock_fp, pid_fp, lambda s: _serve(s, idle_timeout))
+    except socket.error as e:
+      pprint.err('Couldn\'t start the gl server: {0}'.format(e))
+      return False
+    pprint.ok('Started gl server for repository {0}'.format(repo.root))
+  elif args.action == 'stop':
+    if not stop_daemon(sock_fp, pid_fp):
+      pprint.err('The gl server is not running for this repository')
+      return False
+    pprint.ok('Stopped gl server for repository {0}'.format(repo.root))
+  elif is_running(sock_fp):
+    pprint.msg('The gl server is running for this repository')
+  else:
+    pprint.msg('The gl server is not running for this repository')
+  return True
+
+
+def forward(argv, version):
+  """Runs the gl command given by argv in the server, if there's one.
+
+  Args:
+    argv: the command line arguments (without the program name).
+    version: the version of gl the client is running. If the server is running
+      another version the command is not forwarded.
+
+  Returns:
+    the exit code of the command or None if the command couldn't be forwarded
+    (in which case the caller should run the command in-process).
+  """
+  # Only subcommands are forwarded (the main parser's flags, --help and
+  # --version, are cheap to handle in-process)
+  if (not _CAN_SERVE or not argv or argv[0].startswith('-') or
+      argv[0] in NOT_SERVED):
+    return None
+  git_dir = _find_git_dir(os.getcwd())
+  if not git_dir:
+    return None
+  sock_fp = os.path.join(git_dir, SOCKET_FILE)
+  if not os.path.exists(sock_fp):
+    return None
+
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(sock_fp)
+    req = json.dumps({
+        'version': version, 'argv': argv, 'cwd': os.getcwd(),
+        'env': dict(os.environ)})
+    s.sendmsg(
+        [req.encode('utf-8') + b'\n'],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', _STD_FDS))])
+  except socket.error:
+    s.close()
+    return None
+
+  try:
+    try:
+      resp = _recv_line(s)
+    except KeyboardInterrupt:
+      # Let the server know, it will interrupt the worker running the cmd
+      s.shutdown(socket.SHUT_WR)
+      resp = _recv_line(s)
+  finally:
+    s.close()
+
+  if not resp:
+    sys.stderr.write('✘ Lost connection to the gl server\n')
+    return _INTERNAL_ERROR
+  resp = json.loads(resp.decode('utf-8'))
+  if resp.get('fallback'):
+    return None
+  return resp['code']
+
+
+# Server side
+
+def start_daemon(sock_fp, pid_fp, serve):
+  """Starts a daemon that listens on the unix socket sock_fp.
+
+  The daemon writes its pid to pid_fp and then calls serve with the listening
+  socket. When serve returns the daemon cleans up and exits. This function
+  returns once the daemon is started.
+  """
+  if os.path.exists(sock_fp):  # left behind by a daemon that died
+    os.remove(sock_fp)
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # Only the user can connect to the socket (whoever can connect can run
+  # commands as the user), the socket is created with 0600
+  old_umask = os.umask(0o177)
+  try:
+    s.bind(sock_fp)
+  finally:
+    os.umask(old_umask)
+  s.listen(16)
+
+  # Double fork so that the server is detached from the terminal and it is not
+  # a child of the gl process that started it
+  pid = os.fork()
+  if pid:
+    s.close()
+    os.waitpid(pid, 0)
+    return
+
+  os.setsid()
+  if os.fork():
+    os._exit(0)
+
+  devnull = os.open(os.devnull, os.O_RDWR)
+  for fd in _STD_FDS:
+    os.dup2(devnull, fd)
+  os.close(devnull)
+
+  with open(pid_fp, 'w') as f:
+    f.write('{0}\n'.format(os.getpid()))
+
+  try:
+    serve(s)
+  finally:
+    s.close()
+    for fp in (sock_fp, pid_fp):
+      if os.path.exists(fp):
+        os.remove(fp)
+    os._exit(0)
+
+
+def stop_daemon(sock_fp, pid_fp):
+  """Stops the daemon started with start_daemon, returns False if none."""
+  if not os.path.exists(pid_fp):
+    return False
+  with open(pid_fp, 'r') as f:
+    pid = int(f.read().strip())
+  try:
+    os.kill(pid, signal.SIGTERM)
+  except OSError as e:
+    if e.errno != errno.ESRCH:
+      raise
+    # Stale files of a daemon that died
+    os.remove(pid_fp)
+    if os.path.exists(sock_fp):
+      os.remove(sock_fp)
+    return False
+  return True
+
+
+def _serve(s, idle_timeout):
+  def terminate(*_):
+    raise SystemExit()
+
+  signal.signal(signal.SIGTERM, terminate)
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # auto-reap handlers
+  s.settimeout(idle_timeout)
+  while True:
+    try:
+      conn, _ = s.accept()
+    except socket.timeout:
+      return
+    except socket.error as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+
+    # Each request is handled in a child process so that we can keep
+    # accepting requests while a long command (like a commit waiting on the
+    # editor) runs
+    if os.fork() == 0:
+      s.close()
+      code = 0
+      try:
+        _handle(conn)
+      except BaseException:
+        code = _INTERNAL_ERROR
+      finally:
+        os._exit(code)
+    conn.close()
+
+
+def _handle(conn):
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  conn.settimeout(None)
+
+  from . import gl
+
+  req, fds = _recv_request(conn)
+  if not req:  # a ping (see is_running)
+    return
+  if req['version'] != gl.VERSION or len(fds) != len(_STD_FDS):
+    for fd in fds:
+      os.close(fd)
+    conn.sendall(json.dumps({'fallback': True}).encode('utf-8') + b'\n')
+    return
+
+  # We get notified via the pipe when the worker exits
+  chld_r, chld_w = os.pipe()
+  signal.signal(signal.SIGCHLD, lambda *_: os.write(chld_w, b'x'))
+
+  pid = os.fork()
+  if pid == 0:  # worker
+    code = _INTERNAL_ERROR
+    try:
+      conn.close()
+      for fd, std_fd in zip(fds, _STD_FDS):
+        os.dup2(fd, std_fd)
+        os.close(fd)
+      signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      os.environ.clear()
+      os.environ.update(req['env'])
+      os.chdir(req['cwd'])
+      code = gl.run(req['argv'])
+    except SystemExit as e:  # argparse exits on --help or on syntax errors
+      code = e.code if isinstance(e.code, int) else int(bool(e.code))
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(code)
+
+  for fd in fds:
+    os.close(fd)
+
+  interrupted = False
+  while True:
+    rlist = [chld_r] if interrupted else [chld_r, conn]
+    try:
+      ready, _, _ = select.select(rlist, [], [])
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    if conn in ready and not conn.recv(1):  # client interrupted
+      interrupted = True
+      os.kill(pid, signal.SIGINT)
+    if chld_r in ready:
+      _, status = os.waitpid(pid, 0)
+      break
+
+  code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else _INTERNAL_ERROR
+  conn.sendall(json.dumps({'code': code}).encode('utf-8') + b'\n')
+
+
+def _recv_request(conn):
+  fds = array.array('i')
+  data, ancdata, _, _ = conn.recvmsg(
+      4096, socket.CMSG_LEN(len(_STD_FDS) * fds.itemsize))
+  if not data:
+    return None, []
+  for level, kind, cmsg_data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(
+          cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+  if not data.endswith(b'\n'):
+    data += _recv_line(conn)
+  return json.loads(data.decode('utf-8')), list(fds)
+
+
+# Misc
+
+def _recv_line(s):
+  data = b''
+  while not data.endswith(b'\n'):
+    chunk = s.recv(4096)
+    if not chunk:
+      break
+    data += chunk
+  return data
+
+
+def is_running(sock_fp):
+  """True if there's a daemon listening on the unix socket sock_fp."""
+  if not os.path.exists(sock_fp):
+    return False
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(sock_fp)
+    return True
+  except socket.error:
+    return False
+  finally:
+    s.close()
+
+
+def _find_git_dir(path):
+  """Finds the Git dir of the repository path is in without using pygit2.
+
+  Returns None if the repository has a .git file instead of a dir (a
+  submodule or a linked worktree), those are not served so that the command
+  is not run in the wrong repository (the superproject's server).
+  """
+  if 'GIT_DIR' in os.environ:
+    return None
+  while True:
+    git_dir = os.path.join(path, '.git')
+    if os.path.isdir(git_dir):
+      return git_dir
+    if os.path.lexists(git_dir):  # a .git file
+      return None
+    parent = os.path.dirname(path)
+    if parent == path:
+      return None
+    path = parent
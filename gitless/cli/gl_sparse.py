@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git.
+# Licensed under GNU GPL v2.
+
+"""gl sparse - Check out only some dirs of the repository."""
+
+
+from __future__ import unicode_literals
+
+from . import helpers, pprint
+
+
+def parser(subparsers, repo):
+  """Adds the sparse parser to the given subparsers object."""
+  desc = (
+      'check out only some dirs of the repository (the files at the root are '
+      'always checked out)')
+  sparse_parser = subparsers.add_parser(
+      'sparse', help=desc, description=desc.capitalize())
+  sparse_parser.add_argument(
+      'action', nargs='?', choices=['list', 'set', 'add', 'disable'],
+      default='list', help=(
+          'list the dirs checked out, set the dirs to check out, add dirs to '
+          'those checked out or disable the sparse checkout to check out the '
+          'whole tree (defaults to list)'))
+  sparse_parser.add_argument(
+      'dirs', nargs='*', help='the dir(s) to set or add',
+      action=helpers.PathProcessor, repo=repo, recursive=False)
+  sparse_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  dirs = ['' if d == '.' else d for d in args.dirs]
+  if args.action in ('set', 'add'):
+    if not dirs:
+      pprint.err('No dirs to {0}'.format(args.action))
+      return False
+    repo.set_sparse_dirs(dirs, add=args.action == 'add')
+    pprint.ok('Checked out {0}'.format(', '.join(dirs)))
+  elif args.action == 'disable':
+    if not repo.is_sparse():
+      pprint.err('The whole tree is already checked out')
+      return False
+    repo.disable_sparse()
+    pprint.ok('Checked out the whole tree')
+    return True
+
+  if not repo.is_sparse():
+    pprint.msg('The whole tree is checked out')
+    return True
+  sparse_dirs = repo.sparse_dirs()
+  if sparse_dirs is None:
+    pprint.err(
+        'The sparse checkout is not in cone mode, Gitless only supports cone '
+        'mode')
+    pprint.err_exp('use gl sparse set to switch to cone mode')
+    return False
+  pprint.msg('Dirs checked out (in addition to the files at the root):')
+  if not sparse_dirs:
+    pprint.item('None')
+  for d in sparse_dirs:
+    pprint.item(d + '/')
+  return True
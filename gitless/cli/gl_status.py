@@ -7,15 +7,39 @@
 
 from __future__ import unicode_literals
 
+import collections
 import os
-
-from clint.textui import colored
+import sys
+import time
 
 from gitless import core
 
 from . import helpers, pprint
 
 
+# Version of the porcelain format, it's bumped if the format needs to change.
+#
+# v1: a '# gl-status v1' record, a '# branch <name>' record, a '# op <op>'
+# record if a merge or fuse is in progress and then one '<type> <flags> <path>'
+# record per file, in no particular order. type is T (tracked modified) or U
+# (untracked). flags are 4 chars: H if the file exists at head, W if it exists
+# in the working directory, M if it's modified, C if it's in conflict ('-' if
+# not). path is relative to the repo root and utf-8 encoded, the path of dirs
+# with only untracked files in them (that are reported as a whole unless
+# --untracked=all is given) ends with a '/'. Records end with a newline or with
+# NUL if -z is given (use -z if paths can have newlines).
+PORCELAIN_VERSION = 'v1'
+
+# If computing the status takes longer than this (in ms, it can be changed
+# with the gitless.statusAdviceThreshold config option, 0 disables it) we print
+# where the time went and what could make it faster
+DEFAULT_ADVICE_THRESHOLD = 2000
+
+# Thresholds for the advice
+_MANY_UNTRACKED = 1000
+_MANY_INDEX_ENTRIES = 10000
+
+
 def parser(subparsers, repo):
   """Adds the status parser to the given subparsers object."""
   desc = 'show status of the repo'
@@ -23,14 +47,63 @@ def parser(subparsers, repo):
       'status', help=desc, description=desc.capitalize())
   status_parser.add_argument(
       'paths', nargs='*', help='the specific path(s) to status',
-      action=helpers.PathProcessor, repo=repo)
+      action=helpers.PathProcessor, repo=repo, recursive=False)
+  status_parser.add_argument(
+      '--no-cache', help=(
+          'compute the status from scratch, without using (or updating) the '
+          'status cache'),
+      action='store_true', dest='no_cache')
+  status_parser.add_argument(
+      '--untracked', choices=['normal', 'all'], default='normal', help=(
+          'how to show untracked files: normal shows dirs with only '
+          'untracked files in them as the dir (without looking at what\'s '
+          'inside of them), all shows each file (defaults to normal)'),
+      dest='untracked')
+  status_parser.add_argument(
+      '-j', '--jobs', type=int, help=(
+          'check the tracked files with this many threads, which helps if '
+          'many of them need to be re-hashed, e.g., after a checkout '
+          '(defaults to the gitless.statusWorkers config option or to 1)'),
+      dest='jobs')
+  status_parser.add_argument(
+      '--porcelain', help=(
+          'output the status in a stable, easy-to-parse format for scripts '
+          '(the first record is the version of the format)'),
+      action='store_true', dest='porcelain')
+  status_parser.add_argument(
+      '-z', help=(
+          'terminate records with NUL instead of newline (implies '
+          '--porcelain)'),
+      action='store_true', dest='nul')
+  status_parser.add_argument(
+      '--timings', help=(
+          'show where the time computing the status went and what could make '
+          'it faster'),
+      action='store_true', dest='timings')
   status_parser.set_defaults(func=main)
 
 
 def main(args, repo):
   curr_b = repo.current_branch
+  # The paths are given to the status engine (it only looks at what's under
+  # them) as they are, without expanding dirs
+  pathspec = ['' if p == '.' else p for p in args.paths]
+  collapse = args.untracked == 'normal'
+  timings = core.StatusTimings()
+  untracked_dirs = collections.Counter()
+  if args.porcelain or args.nul:
+    start = time.time()
+    _print_porcelain(
+        curr_b, pathspec, not args.no_cache, collapse, args.jobs, args.nul,
+        timings, untracked_dirs)
+    _maybe_print_timings(
+        timings, time.time() - start, untracked_dirs, args, pathspec, repo,
+        stream=sys.stderr.write)
+    return True
+
   pprint.msg('On branch {0}, repo-directory {1}'.format(
-    colored.green(curr_b.branch_name), colored.green('//' + repo.cwd)))
+    pprint.color('green', curr_b.branch_name),
+    pprint.color('green', '//' + repo.cwd)))
 
   if curr_b.merge_in_progress:
     pprint.blank()
@@ -39,16 +112,18 @@ def main(args, repo):
     pprint.blank()
     _print_conflict_exp('fuse')
 
-  tracked_mod_list = []
-  untracked_list = []
-  paths = frozenset(args.paths)
-  for f in curr_b.status():
-    if paths and (f.fp not in paths):
-      continue
+  tracked_mod_list = core.FileStatusList()
+  untracked_list = core.FileStatusList()
+  start = time.time()
+  for f in curr_b.status(
+      use_cache=not args.no_cache, pathspec=pathspec,
+      collapse_untracked=collapse, workers=args.jobs, timings=timings):
     if f.type == core.GL_STATUS_TRACKED and f.modified:
-      tracked_mod_list.append(f)
+      tracked_mod_list.append(*f)
     elif f.type == core.GL_STATUS_UNTRACKED:
-      untracked_list.append(f)
+      untracked_list.append(*f)
+      _count_untracked(untracked_dirs, f.fp)
+  elapsed = time.time() - start
 
   relative_paths = True  # git seems to default to true
   try:
@@ -56,80 +131,231 @@ def main(args, repo):
   except KeyError:
     pass
 
-  pprint.blank()
-  tracked_mod_list.sort(key=lambda f: f.fp)
-  _print_tracked_mod_files(tracked_mod_list, relative_paths, repo)
-  pprint.blank()
-  pprint.blank()
-  untracked_list.sort(key=lambda f: f.fp)
-  _print_untracked_files(untracked_list, relative_paths, repo)
+  with pprint.Buffer() as out:
+    out.blank()
+    tracked_mod_list.sort()
+    _print_tracked_mod_files(tracked_mod_list, relative_paths, repo, out)
+    out.blank()
+    out.blank()
+    untracked_list.sort()
+    _print_untracked_files(untracked_list, relative_paths, repo, out)
+  _maybe_print_timings(
+      timings, elapsed, untracked_dirs, args, pathspec, repo)
   return True
 
 
-def _print_tracked_mod_files(tracked_mod_list, relative_paths, repo):
-  pprint.msg('Tracked files with modifications:')
-  pprint.exp('these will be automatically considered for commit')
-  pprint.exp(
+def _print_porcelain(
+    curr_b, pathspec, use_cache, collapse, workers, nul, timings,
+    untracked_dirs):
+  # Records are written as Branch.status() yields them, without sorting or
+  # making paths relative to the cwd, and bypassing clint. With the status
+  # cache, the records of tracked files are written as soon as the tracked
+  # part of the status is known (it only takes stat'ing the files in the
+  # index), before the working directory is walked for untracked files. The
+  # untracked ones come once the walk is done
+  out = getattr(sys.stdout, 'buffer', sys.stdout)
+  end = b'\0' if nul else b'\n'
+
+  def write(record):
+    out.write(record.encode('utf-8') + end)
+
+  def write_status(f):
+    if f.type == core.GL_STATUS_TRACKED and f.modified:
+      f_type = 'T'
+    elif f.type == core.GL_STATUS_UNTRACKED:
+      f_type = 'U'
+      _count_untracked(untracked_dirs, f.fp)
+    else:
+      return
+    write('{0} {1}{2}{3}{4} {5}'.format(
+        f_type, 'H' if f.exists_at_head else '-',
+        'W' if f.exists_in_wd else '-', 'M' if f.modified else '-',
+        'C' if f.in_conflict else '-', f.fp))
+
+  def write_tracked(sts):
+    for f in sts:
+      write_status(f)
+    out.flush()  # so that consumers get them before the walk is done
+
+  write('# gl-status {0}'.format(PORCELAIN_VERSION))
+  write('# branch {0}'.format(curr_b.branch_name))
+  if curr_b.merge_in_progress:
+    write('# op merge')
+  elif curr_b.fuse_in_progress:
+    write('# op fuse')
+  out.flush()
+
+  for f in curr_b.status(
+      use_cache=use_cache, pathspec=pathspec, collapse_untracked=collapse,
+      workers=workers, timings=timings, on_tracked=write_tracked):
+    write_status(f)
+  out.flush()
+
+
+def _print_tracked_mod_files(tracked_mod_list, relative_paths, repo, out):
+  out.msg('Tracked files with modifications:')
+  out.exp('these will be automatically considered for commit')
+  out.exp(
       'use gl untrack f if you don\'t want to track changes to file f')
-  pprint.exp(
+  out.exp(
       'if file f was committed before, use gl checkout f to discard '
       'local changes')
-  pprint.blank()
+  out.blank()
 
   if not tracked_mod_list:
-    pprint.item('There are no tracked files with modifications to list')
+    out.item('There are no tracked files with modifications to list')
     return
 
   root = repo.root
   for f in tracked_mod_list:
     exp = ''
-    color = colored.yellow
+    color = 'yellow'
     if not f.exists_at_head:
       exp = ' (new file)'
-      color = colored.green
+      color = 'green'
     elif not f.exists_in_wd:
       exp = ' (deleted)'
-      color = colored.red
+      color = 'red'
     elif f.in_conflict:
       exp = ' (with conflicts)'
-      color = colored.cyan
+      color = 'cyan'
 
     fp = os.path.relpath(os.path.join(root, f.fp)) if relative_paths else f.fp
     if fp == '.':
       continue
 
-    pprint.item(color(fp), opt_text=exp)
+    out.item(pprint.color(color, fp), opt_text=exp)
 
 
-def _print_untracked_files(untracked_list, relative_paths, repo):
-  pprint.msg('Untracked files:')
-  pprint.exp('these won\'t be considered for commit')
-  pprint.exp('use gl track f if you want to track changes to file f')
-  pprint.blank()
+def _print_untracked_files(untracked_list, relative_paths, repo, out):
+  out.msg('Untracked files:')
+  out.exp('these won\'t be considered for commit')
+  out.exp('use gl track f if you want to track changes to file f')
+  out.blank()
 
   if not untracked_list:
-    pprint.item('There are no untracked files to list')
+    out.item('There are no untracked files to list')
     return
 
   root = repo.root
   for f in untracked_list:
     exp = ''
-    color = colored.blue
+    color = 'blue'
     if f.in_conflict:
       exp = ' (with conflicts)'
-      color = colored.cyan
+      color = 'cyan'
     elif f.exists_at_head:
-      color = colored.magenta
+      color = 'magenta'
       if f.exists_in_wd:
         exp = ' (exists at head)'
       else:
         exp = ' (exists at head but not in working directory)'
 
     fp = os.path.relpath(os.path.join(root, f.fp)) if relative_paths else f.fp
-    if fp == '.':
+    if f.fp.endswith('/'):  # a dir with only untracked files in it
+      fp = fp.rstrip('/') + '/'  # relpath drops the trailing '/'
+    elif fp == '.':
       continue
 
-    pprint.item(color(fp), opt_text=exp)
+    out.item(pprint.color(color, fp), opt_text=exp)
+
+
+def _count_untracked(untracked_dirs, fp):
+  """Counts fp in the entry of the top dir it's in ('' for the root)."""
+  i = fp.find('/')
+  untracked_dirs[fp[:i] if i != -1 else ''] += 1
+
+
+def _maybe_print_timings(
+    timings, elapsed, untracked_dirs, args, pathspec, repo,
+    stream=sys.stdout.write):
+  """Prints the timings and the advice if asked to or if status was slow."""
+  if not args.timings:
+    try:
+      threshold = repo.config.get_int('gitless.statusAdviceThreshold')
+    except (KeyError, ValueError):
+      threshold = DEFAULT_ADVICE_THRESHOLD
+    if not threshold or elapsed * 1000 < threshold:
+      return
+
+  pprint.blank(stream=stream)
+  pprint.msg(
+      'Computing the status took {0:.3f}s:'.format(elapsed), stream=stream)
+  for phase, secs in timings.phases.items():
+    pprint.item('{0:<20}{1:.3f}s'.format(phase, secs), stream=stream)
+  pprint.item(
+      '{0:<20}{1:.3f}s'.format('other', max(elapsed - timings.total, 0)),
+      stream=stream)
+  cache = 'not used' if timings.cache is None else timings.cache
+  if timings.cache in ('stat', 'watcher'):
+    cache += ', {0} dirs rescanned'.format(timings.dirs_rescanned)
+  pprint.msg(
+      '{0} index entries, {1} untracked entries, status cache: {2}'.format(
+          timings.index_entries, sum(untracked_dirs.values()), cache),
+      stream=stream)
+  for advice in _advice(
+      timings, elapsed, untracked_dirs, args, pathspec, repo.is_sparse()):
+    pprint.exp(advice, stream=stream)
+
+
+def _advice(timings, elapsed, untracked_dirs, args, pathspec, sparse):
+  """Return a list of suggestions to make computing the status faster.
+
+  sparse is True if the repo is sparse (the status cache is not used then).
+  """
+  ret = []
+
+  def secs(*phases):
+    return sum(timings.phases.get(p, 0) for p in phases)
+
+  if timings.cache is None and not sparse and (
+      not pathspec or '' in pathspec):
+    if args.no_cache:
+      ret.append(
+          'don\'t use --no-cache, the status cache only rescans the dirs '
+          'that changed')
+    else:
+      ret.append(
+          'enable the status cache, which only rescans the dirs that changed, '
+          'with git config gitless.statusCache true')
+  elif timings.cache == 'rebuilt':
+    ret.append(
+        'the status cache had to be computed from scratch (e.g., because '
+        'HEAD, the index or the ignore rules changed), the next gl status '
+        'should be faster')
+  elif timings.cache == 'stat' and (
+      secs('cache', 'untracked files') > elapsed / 2):
+    ret.append(
+        'start the watcher with gl watch start, so that only the paths that '
+        'changed are looked at instead of checking every dir')
+
+  untracked = sum(untracked_dirs.values())
+  if untracked > _MANY_UNTRACKED:
+    if args.untracked == 'all':
+      ret.append(
+          'use --untracked=normal to show dirs with only untracked files in '
+          'them as the dir, without looking at what\'s inside of them')
+    top = [(d, n) for d, n in untracked_dirs.most_common(4) if d][:3]
+    advice = (
+        'add ignore rules to .gitignore for the untracked files you don\'t '
+        'care about (e.g., build outputs)')
+    if top:
+      advice += ', most of them are in: ' + ', '.join(
+          '{0}/ ({1})'.format(d, n) for d, n in top)
+    ret.append(advice)
+
+  if (secs('working directory', 'tracked files', 'git status') > elapsed / 2 and
+      timings.index_entries > _MANY_INDEX_ENTRIES):
+    if timings.workers <= 1:
+      ret.append(
+          'check the tracked files with more threads with gl status -j 4 or '
+          'git config gitless.statusWorkers 4')
+    if timings.refreshed:
+      ret.append(
+          '{0} tracked files were touched without being modified and had to '
+          'be re-hashed (e.g., after a checkout or a build that rewrites '
+          'files)'.format(timings.refreshed))
+  return ret
 
 
 def _print_conflict_exp(op):
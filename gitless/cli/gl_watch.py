@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git.
+# Licensed under GNU GPL v2.
+
+"""gl watch - Watch the working directory to speed up the status.
+
+The watcher is opt-in and per repository: `gl watch start` forks a background
+process that uses inotify to learn which paths of the working directory
+change. When computing the status, Gitless asks the watcher for the paths that
+changed since the last time it asked (it identifies that point in time with a
+token the watcher gives it) and only looks at those, instead of stating every
+file and dir of the working directory. If the watcher can't tell what changed
+(e.g., the kernel's event queue overflowed) the whole working directory is
+looked at, as if there was no watcher running. Only Linux is supported.
+"""
+
+
+from __future__ import unicode_literals
+
+import binascii
+import ctypes
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+from gitless import core
+
+from . import gl_server, pprint
+
+
+DEFAULT_IDLE_TIMEOUT = 60  # in minutes
+
+# If more paths than this changed since a client last asked, we forget about
+# them and tell the client to look at the whole working directory
+_MAX_CHANGES = 100000
+
+_CONN_TIMEOUT = 2  # in secs
+
+# inotify flags (from <sys/inotify.h>)
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_EXCL_UNLINK = 0x4000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+    _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR |
+    _IN_DONT_FOLLOW | _IN_EXCL_UNLINK)
+
+_EVENT = struct.Struct(str('iIII'))  # wd, mask, cookie, len
+
+
+def parser(subparsers, _):
+  """Adds the watch parser to the given subparsers object."""
+  desc = (
+      'start, stop or check a background process that watches the working '
+      'directory for changes to speed up gl status')
+  watch_parser = subparsers.add_parser(
+      'watch', help=desc, description=desc.capitalize())
+  watch_parser.add_argument(
+      'action', nargs='?', choices=['start', 'stop', 'status'],
+      default='status', help='what to do (defaults to status)')
+  watch_parser.add_argument(
+      '-t', '--idle-timeout', type=int, default=DEFAULT_IDLE_TIMEOUT,
+      help=(
+          'minutes without gl commands asking for changes after which the '
+          'watcher stops (only relevant if the watcher is started; defaults '
+          'to {0})'.format(DEFAULT_IDLE_TIMEOUT)),
+      dest='idle_timeout')
+  watch_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  sock_fp = os.path.join(repo.path, core.WATCHER_SOCKET_FILE)
+  pid_fp = os.path.join(repo.path, core.WATCHER_PID_FILE)
+  if args.action == 'start':
+    libc = _inotify()
+    if not libc or not hasattr(socket, 'AF_UNIX'):
+      pprint.err('The watcher is not supported on this platform')
+      return False
+    if gl_server.is_running(sock_fp):
+      pprint.err('The watcher is already running for this repository')
+      return False
+    # We set up the watches before forking so that errors (like running out
+    # of watches) are reported
+    try:
+      watcher = _Watcher(libc, repo)
+    except OSError as e:
+      pprint.err('Couldn\'t start the watcher: {0}'.format(e))
+      if e.errno == errno.ENOSPC:
+        pprint.err_exp(
+            'the max number of watches can be raised via the '
+            'fs.inotify.max_user_watches kernel parameter')
+      return False
+    idle_timeout = args.idle_timeout * 60
+    try:
+      gl_server.start_daemon(
+          sock_fp, pid_fp, lambda s: _serve(s, watcher, idle_timeout))
+    except socket.error as e:
+      pprint.err('Couldn\'t start the watcher: {0}'.format(e))
+      return False
+    finally:
+      watcher.close()
+    pprint.ok('Started watcher for repository {0}'.format(repo.root))
+  elif args.action == 'stop':
+    if not gl_server.stop_daemon(sock_fp, pid_fp):
+      pprint.err('The watcher is not running for this repository')
+      return False
+    pprint.ok('Stopped watcher for repository {0}'.format(repo.root))
+  elif gl_server.is_running(sock_fp):
+    pprint.msg('The watcher is running for this repository')
+  else:
+    pprint.msg('The watcher is not running for this repository')
+  return True
+
+
+def _inotify():
+  """Return the libc to use inotify from or None if it's not available."""
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+  except (OSError, AttributeError):
+    return None
+  return libc
+
+
+class _Watcher(object):
+  """Keeps track of the paths of the working directory that change.
+
+  Each time we are asked for changes we hand out a token ('id:seq'). Changes
+  are recorded with the seq of the next token to hand out, so the changes
+  since a given token are those recorded with a greater seq. If events were
+  lost, all tokens handed out before that are no longer good. If we can't
+  keep watching (e.g., we ran out of watches when a dir was created) ok is
+  set to False.
+
+  Ignored dirs (like node_modules or build outputs) are not watched, the
+  status doesn't look into them either and watching them could use up all
+  the watches. We watch the index and the exclude file (and .gitignore files
+  in the working directory) to find out when they stop being ignored.
+  """
+
+  def __init__(self, libc, repo):
+    self.libc = libc
+    self.repo = repo
+    self.root = repo.root
+    self.id = binascii.hexlify(os.urandom(8)).decode('ascii')
+    self.seq = 1
+    self.lost_seq = 1
+    self.changes = {}  # path -> seq
+    self.wds = {}  # watch descriptor -> path of the dir it watches
+    self.git_wds = set()  # watch descriptors of the Git dirs we watch
+    self.ignored = set()  # the ignored dirs, which are not watched
+    self.ok = True
+    self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self.fd < 0:
+      _raise_errno()
+    try:
+      self._watch_tree('')
+      for fp in (repo.path, os.path.join(repo.path, 'info')):
+        wd = self._inotify_add_watch(fp)
+        if wd is not None:
+          self.git_wds.add(wd)
+    except OSError:
+      self.close()
+      raise
+
+  def close(self):
+    os.close(self.fd)
+
+  def changes_since(self, token):
+    """Return a (token, paths) tuple, paths is None if we can't tell."""
+    self.read_events()
+    paths = None
+    try:
+      token_id, token_seq = token.split(':')
+      token_seq = int(token_seq)
+    except (AttributeError, ValueError):
+      token_id = None
+    if self.ok and token_id == self.id and token_seq >= self.lost_seq:
+      paths = sorted(p for p, seq in self.changes.items() if seq > token_seq)
+    token = '{0}:{1}'.format(self.id, self.seq)
+    self.seq += 1
+    return token, paths
+
+  def read_events(self):
+    """Processes all pending events."""
+    while self.ok:
+      try:
+        buf = os.read(self.fd, 65536)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.EAGAIN:
+          return
+        raise
+      offset = 0
+      while offset < len(buf) and self.ok:
+        wd, mask, _, name_len = _EVENT.unpack_from(buf, offset)
+        offset += _EVENT.size
+        name = buf[offset:offset + name_len].rstrip(b'\0')
+        offset += name_len
+        self._process(wd, mask, _fs_decode(name))
+
+  def _process(self, wd, mask, name):
+    if mask & _IN_Q_OVERFLOW:
+      self._lost()
+      return
+    if mask & _IN_IGNORED:
+      self.wds.pop(wd, None)
+      self.git_wds.discard(wd)
+      return
+    if wd in self.git_wds:
+      if name in ('index', 'exclude'):
+        self._recheck_ignored()
+      return
+    if wd not in self.wds:  # a dir we stopped watching
+      return
+    dir_path = self.wds[wd]
+    if not name:
+      # Events on the watched dir itself are also reported to the dir's parent
+      # (with a name), except for those of the root
+      if not dir_path and mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+        self.ok = False
+      return
+
+    path = dir_path + '/' + name if dir_path else name
+    if name == '.git':
+      if not dir_path:
+        return
+      # A repo appeared or disappeared at dir_path, the files in it are no
+      # longer ours (or the other way around)
+      self._unwatch_tree(dir_path)
+      path = dir_path
+      mask = _IN_ISDIR | _IN_CREATE
+    elif mask & _IN_ISDIR and mask & (_IN_MOVED_FROM | _IN_DELETE):
+      self._unwatch_tree(path)
+
+    self._record(path)
+    if name == '.gitignore':
+      self._recheck_ignored()
+    if mask & _IN_ISDIR and mask & (_IN_MOVED_TO | _IN_CREATE):
+      # Things could have been created in the dir before we started watching
+      # it, but we recorded the dir as a whole so they'll be looked at
+      try:
+        self._watch_tree(path)
+      except OSError:
+        self.ok = False
+
+  def _record(self, path):
+    self.changes[path] = self.seq
+    if len(self.changes) > _MAX_CHANGES:
+      self._lost()
+
+  def _lost(self):
+    self.changes.clear()
+    self.lost_seq = self.seq
+
+  def _recheck_ignored(self):
+    """Starts watching the dirs that are no longer ignored."""
+    if not self.ignored:
+      return
+    still_ignored = self._ignored_dirs(sorted(self.ignored))
+    if still_ignored is None:
+      self.ok = False
+      return
+    for d in sorted(self.ignored - still_ignored):
+      self.ignored.discard(d)
+      self._record(d)
+      try:
+        self._watch_tree(d)
+      except OSError:
+        self.ok = False
+
+  def _watch_tree(self, dir_path):
+    root = self.root
+    ignored = self._ignored_dirs([dir_path]) or set()  # if in doubt, watch
+    self.ignored.update(ignored)
+    if dir_path in ignored:
+      return
+    for curr, dirnames, fps in os.walk(os.path.join(root, dir_path)):
+      curr = os.path.relpath(curr, root)
+      curr = '' if curr == '.' else curr.replace(os.sep, '/')
+      self._add_watch(curr)
+      if curr and ('.git' in dirnames or '.git' in fps):
+        # A nested repo, its files are not ours (we still watch its root to
+        # know if it stops being a repo)
+        dirnames[:] = []
+        continue
+      dirnames[:] = [
+          d for d in dirnames
+          if d != '.git' and (curr + '/' + d if curr else d) not in ignored]
+
+  def _ignored_dirs(self, paths):
+    """Return the ignored dirs at or under paths, None if we can't tell."""
+    try:
+      return self.repo.ignored_dirs(paths)
+    except Exception:  # e.g., the index was being written
+      return None
+
+  def _add_watch(self, dir_path):
+    wd = self._inotify_add_watch(os.path.join(self.root, dir_path))
+    if wd is not None:
+      self.wds[wd] = dir_path
+
+  def _inotify_add_watch(self, fp):
+    """Return the watch descriptor of dir fp, None if it's already gone."""
+    wd = self.libc.inotify_add_watch(self.fd, _fs_encode(fp), _WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err in (errno.ENOENT, errno.ENOTDIR):
+        return None  # it's already gone, we'll get the event
+      _raise_errno(err, fp)
+    return wd
+
+  def _unwatch_tree(self, dir_path):
+    prefix = dir_path + '/'
+    self.ignored = set(
+        d for d in self.ignored if d != dir_path and not d.startswith(prefix))
+    for wd, path in list(self.wds.items()):
+      if path == dir_path or path.startswith(prefix):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.wds[wd]
+
+
+def _serve(s, watcher, idle_timeout):
+  def terminate(*_):
+    raise SystemExit()
+
+  signal.signal(signal.SIGTERM, terminate)
+  last_req = time.time()
+  while True:
+    timeout = last_req + idle_timeout - time.time()
+    if timeout <= 0:
+      return
+    try:
+      ready, _, _ = select.select([s, watcher.fd], [], [], timeout)
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+
+    if watcher.fd in ready:
+      watcher.read_events()
+    if s in ready:
+      last_req = time.time()
+      try:
+        conn, _ = s.accept()
+      except socket.error:
+        continue
+      try:
+        _handle(conn, watcher)
+      except (socket.error, ValueError):
+        pass
+      finally:
+        conn.close()
+    # If we can't keep watching we stop, without a watcher running clients
+    # look at the whole working directory
+    if not watcher.ok:
+      return
+
+
+def _handle(conn, watcher):
+  conn.settimeout(_CONN_TIMEOUT)
+  req = conn.makefile('rb').readline()
+  if not req:  # a ping (see gl_server.is_running)
+    return
+  req = json.loads(req.decode('utf-8'))
+  token, paths = watcher.changes_since(req.get('since'))
+  conn.sendall(
+      json.dumps({'token': token, 'paths': paths}).encode('utf-8') + b'\n')
+
+
+# Misc
+
+def _raise_errno(err=None, fp=None):
+  err = err or ctypes.get_errno()
+  raise OSError(err, os.strerror(err), fp)
+
+
+_FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+
+def _fs_encode(fp):
+  if isinstance(fp, bytes):
+    return fp
+  if hasattr(os, 'fsencode'):
+    return os.fsencode(fp)
+  return fp.encode(_FS_ENCODING)
+
+
+def _fs_decode(name):
+  if hasattr(os, 'fsdecode'):
+    return os.fsdecode(name)
+  return name.decode(_FS_ENCODING)
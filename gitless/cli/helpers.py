@@ -8,6 +8,8 @@
 from __future__ import unicode_literals
 
 import argparse
+import errno
+import itertools
 import os
 import subprocess
 import sys
@@ -66,34 +68,173 @@ def get_branch_or_use_upstream(branch_name, arg, repo):
   return ret
 
 
-def page(fp, repo):
-  pager = ''
-  try:
-    pager = repo.config['core.pager']
-  except KeyError:
-    pass
-  cmd = [pager, fp] if pager else ['less', '-r', '-f', fp]
-  subprocess.call(cmd, stdin=sys.stdin, stdout=sys.stdout)
+class PagerClosed(Exception):
+  """The pager exited before we were done writing to it."""
+
+
+class Pager(object):
+  """Output piped into the pager as it's generated.
+
+  The pager (core.pager, run by the shell like git does, or less) is started
+  on the first write, so nothing is paged if there's no output. Writes block
+  while the pager is not reading, and once the pager exits (e.g., the user
+  quit less) the next write raises PagerClosed, which the with block
+  swallows, so that we stop generating output nobody is going to see. If
+  stdout is not a tty the output goes straight to stdout.
+
+  Usage:
+    with helpers.Pager(repo) as pager:
+      for patch in patches:
+        pprint.diff(patch, stream=pager.write)
+  """
+
+  def __init__(self, repo):
+    self.repo = repo
+    self.proc = None
+    self.out = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_value, unused_traceback):
+    try:
+      if self.proc:
+        self.proc.stdin.close()
+      elif self.out:
+        self.out.flush()
+    except IOError as e:
+      if e.errno != errno.EPIPE:
+        raise
+    if self.proc:
+      self.proc.wait()
+    return exc_type is not None and issubclass(exc_type, PagerClosed)
+
+  def write(self, s):
+    if not isinstance(s, bytes):
+      s = s.encode(pprint.ENCODING)
+    if not self.out:
+      self._start()
+    try:
+      self.out.write(s)
+    except IOError as e:
+      if e.errno != errno.EPIPE:
+        raise
+      raise PagerClosed()
+
+  def _start(self):
+    pager = None
+    try:
+      pager = self.repo.config['core.pager']
+    except KeyError:
+      pass
+    sys.stdout.flush()
+    if not sys.stdout.isatty() or pager == '':  # an empty pager means no pager
+      self.out = getattr(sys.stdout, 'buffer', sys.stdout)
+      return
+    self.proc = subprocess.Popen(
+        pager or 'less -r', shell=True, stdin=subprocess.PIPE)
+    self.out = self.proc.stdin
 
 
 class PathProcessor(argparse.Action):
+  """Makes paths relative to the repo root.
 
-  def __init__(self, option_strings, dest, repo=None, **kwargs):
+  If recursive is True (the default) dirs are expanded to the files in them
+  that are not ignored (see core.Repository.expand_paths). The paths are
+  processed lazily, when the command gets to them.
+  """
+
+  def __init__(
+      self, option_strings, dest, repo=None, recursive=True, **kwargs):
+    self.repo = repo
     self.root = repo.root if repo else ''
+    self.recursive = recursive
     super(PathProcessor, self).__init__(option_strings, dest, **kwargs)
 
   def __call__(self, parser, namespace, paths, option_string=None):
-    def process_paths():
-      for path in paths:
-        path = os.path.normpath(path)
-        if os.path.isdir(path):
-          for curr_dir, _, fps in os.walk(path):
-            for fp in fps:
-              yield os.path.relpath(os.path.join(curr_dir, fp), self.root)
-        else:
-          yield os.path.relpath(path, self.root)
+    setattr(
+        namespace, self.dest,
+        process_paths(paths, self.repo, recursive=self.recursive))
+
+
+def process_paths(paths, repo, recursive=True):
+  """Return a generator of the given paths made relative to the repo root.
+
+  If recursive is True dirs are expanded (see PathProcessor).
+  """
+  root = repo.root if repo else ''
+  rel_paths = (os.path.relpath(os.path.normpath(path), root) for path in paths)
+  if recursive and repo:
+    return repo.expand_paths(rel_paths)
+  return rel_paths
+
 
-    setattr(namespace, self.dest, process_paths())
+# Reading paths from stdin
+
+_STDIN_CHUNK_SIZE = 64 * 1024
+
+
+def stdin_flags(subparsers):
+  """Adds the --stdin and -z flags to read the paths from stdin."""
+  subparsers.add_argument(
+      '--stdin', help=(
+          'also read the files from stdin, one per line (or NUL-terminated '
+          'with -z)'),
+      action='store_true')
+  _nul_flag(subparsers)
+
+
+def _nul_flag(subparsers):
+  subparsers.add_argument(
+      '-z', help='the files read from stdin are NUL-terminated',
+      action='store_true', dest='nul')
+
+
+def stdin_paths(nul=False):
+  """Return a generator of the paths read from stdin.
+
+  Stdin is read as the generator is consumed, so there's no limit on the
+  number of paths (like there is for argv). Note that the commands still
+  collect all the paths before doing anything with them, the status of the
+  files and the index transaction are for all of them at once.
+  """
+  sep = b'\0' if nul else b'\n'
+  stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+  pending = b''
+  while True:
+    chunk = stdin.read(_STDIN_CHUNK_SIZE)
+    if not chunk:
+      break
+    lines = (pending + chunk).split(sep)
+    pending = lines.pop()
+    for line in lines:
+      path = _stdin_path(line, nul)
+      if path:
+        yield path
+  path = _stdin_path(pending, nul)
+  if path:
+    yield path
+
+
+def _stdin_path(line, nul):
+  if not nul:
+    line = line.rstrip(b'\r')
+  return line.decode('utf-8')
+
+
+def input_paths(args, paths, repo, recursive=True):
+  """Return the paths given as arguments and then those read from stdin.
+
+  paths are the (already processed) arguments, stdin is read only if --stdin
+  was given (see stdin_flags).
+  """
+  if paths is None:
+    paths = []
+  if not args.stdin:
+    return paths
+  return itertools.chain(
+      paths,
+      process_paths(stdin_paths(nul=args.nul), repo, recursive=recursive))
 
 
 class CommitIdProcessor(argparse.Action):
@@ -120,18 +261,36 @@ def oei_flags(subparsers, repo):
       '-i', '--include', nargs='+',
       help='include files given (files must be untracked)',
       action=PathProcessor, repo=repo, metavar='file')
+  subparsers.add_argument(
+      '--stdin', nargs='?', const='only', choices=OEI_FLAGS, help=(
+          'also read the files to use only (the default), exclude or include '
+          'from stdin, one per line (or NUL-terminated with -z)'))
+  _nul_flag(subparsers)
 
 
-def oei_fs(args, repo):
-  """Compute the final fileset per oei flags."""
-  only = frozenset(args.only if args.only else [])
-  exclude = frozenset(args.exclude if args.exclude else [])
-  include = frozenset(args.include if args.include else [])
+OEI_FLAGS = ['only', 'exclude', 'include']
 
-  curr_b = repo.current_branch
-  if not _oei_validate(only, exclude, include, curr_b):
+
+def oei_sets(args, repo):
+  """Return the (only, exclude, include) sets of files given with oei flags."""
+  fps = {}
+  for flag in OEI_FLAGS:
+    fps[flag] = getattr(args, flag) or []
+  if args.stdin:
+    fps[args.stdin] = input_paths(args, fps[args.stdin], repo)
+  only = frozenset(fps['only'])
+  exclude = frozenset(fps['exclude'])
+  include = frozenset(fps['include'])
+
+  if not _oei_validate(only, exclude, include, repo.current_branch):
     raise ValueError('Invalid input')
+  return only, exclude, include
+
 
+def oei_fs(args, repo):
+  """Compute the final fileset per oei flags."""
+  only, exclude, include = oei_sets(args, repo)
+  curr_b = repo.current_branch
   if only:
     ret = only
   else:
@@ -163,14 +322,13 @@ def _oei_validate(only, exclude, include, curr_b):
     return False
 
   err = []
+  sts = curr_b.status_files(only | exclude | include)
 
   def validate(fps, check_fn, msg):
     ret = True
-    if not fps:
-      return ret
-    for fp in fps:
+    for fp in sorted(fps):
       try:
-        f = curr_b.status_file(fp)
+        f = sts[fp]
       except KeyError:
         err.append('File {0} doesn\'t exist'.format(fp))
         ret = False
@@ -178,7 +336,7 @@ def _oei_validate(only, exclude, include, curr_b):
         if not check_fn(f):
           err.append(msg(fp))
           ret = False
-      return ret
+    return ret
 
   only_valid = validate(
       only, lambda f: f.type == core.GL_STATUS_UNTRACKED or (
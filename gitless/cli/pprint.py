@@ -13,8 +13,10 @@ except ImportError:
   from io import StringIO
 
 from datetime import datetime, tzinfo, timedelta
+import difflib
 from locale import getpreferredencoding
 import re
+import shutil
 import sys
 
 from clint.textui import colored, indent
@@ -41,6 +43,103 @@ def puts(s='', newline=True, stream=sys.stdout.write):
   clint_puts(s, newline=newline, stream=stream)
 
 
+# Buffered output
+
+# The output is written to the stream when it adds up to this many chars
+_BUFFER_SIZE = 64 * 1024
+
+_NEWLINES = re.compile(r'\r\n|\r|\n')
+
+
+class Buffer(object):
+  """Output rendered in memory and written to the stream in large chunks.
+
+  This is for output with lots of lines (diffs, long histories, the status
+  of big repos), which would otherwise go through clint and a stream write
+  per line. Flush it (or use it as a context manager) when done.
+  """
+
+  def __init__(self, stream=sys.stdout.write, size=_BUFFER_SIZE):
+    self.stream = stream
+    self.size = size
+    self._parts = []
+    self._len = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.flush()
+
+  def write(self, s):
+    self._parts.append(s)
+    self._len += len(s)
+    if self._len >= self.size:
+      self.flush()
+
+  def puts(self, s='', indent=0):
+    """Like puts, the lines of s are indented by indent spaces."""
+    if indent:
+      pad = ' ' * indent
+      if '\n' in s or '\r' in s:
+        s = ('\n' + pad).join(_NEWLINES.split(s))
+      s = pad + s
+    self.write(s + '\n')
+
+  def msg(self, text):
+    self.puts(text)
+
+  def exp(self, text):
+    self.puts('➜ {0}'.format(text), indent=2)
+
+  def item(self, i, opt_text=''):
+    self.puts('{0}{1}'.format(i, opt_text), indent=4)
+
+  def blank(self):
+    self.write('\n')
+
+  def flush(self):
+    if not self._parts:
+      return
+    out = ''.join(self._parts)
+    self._parts = []
+    self._len = 0
+    if IS_PY2:
+      out = out.encode(ENCODING)
+    self.stream(out)
+
+
+COLORS = ['red', 'green', 'yellow', 'blue', 'magenta', 'cyan']
+
+_color_codes = {}
+
+
+def color(name, s):
+  """Return s in the given color (one of COLORS), like clint's colored.
+
+  The codes are computed once, and like clint's they are empty if stdout is
+  not a TTY or color is disabled.
+  """
+  prefix, suffix = _codes()[name]
+  return prefix + s + suffix
+
+
+def _codes():
+  if not _color_codes:
+    on = sys.stdout.isatty() and not colored.DISABLE_COLOR
+    for name in COLORS:
+      if on:
+        _color_codes[name] = tuple(
+            getattr(colored, name)('\0', always=True).color_str.split('\0'))
+      else:
+        _color_codes[name] = ('', '')
+    # For diff lines: green, bold green, red, bold red and clear
+    _color_codes['diff'] = (
+        ('\033[32m', '\033[1;32m', '\033[31m', '\033[1;31m', '\033[0m') if on
+        else ('', '', '', '', ''))
+  return _color_codes
+
+
 # Stdout
 
 
@@ -137,24 +236,25 @@ def commit_str(ci):
 
 def commit(ci, compact=False, stream=sys.stdout.write):
   merge_commit = len(ci.parent_ids) > 1
-  color = colored.magenta if merge_commit else colored.yellow
+  c = 'magenta' if merge_commit else 'yellow'
+  out = Buffer(stream=stream)
   if compact:
     title = ci.message.splitlines()[0]
-    puts('{0} {1}'.format(color(str(ci.id)[:7]), title), stream=stream)
+    out.puts('{0} {1}'.format(color(c, str(ci.id)[:7]), title))
+    out.flush()
     return
-  puts(color('Commit Id: {0}'.format(ci.id)), stream=stream)
+  out.puts(color(c, 'Commit Id: {0}'.format(ci.id)))
   if merge_commit:
     merges_str = ' '.join(str(oid)[:7] for oid in ci.parent_ids)
-    puts(color('Merges:    {0}'.format(merges_str)), stream=stream)
-  puts(
-      color('Author:    {0} <{1}>'.format(ci.author.name, ci.author.email)),
-      stream=stream)
+    out.puts(color(c, 'Merges:    {0}'.format(merges_str)))
+  out.puts(
+      color(c, 'Author:    {0} <{1}>'.format(ci.author.name, ci.author.email)))
   ci_author_dt = datetime.fromtimestamp(
       ci.author.time, FixedOffset(ci.author.offset))
-  puts(color('Date:      {0:%c %z}'.format(ci_author_dt)), stream=stream)
-  puts(stream=stream)
-  with indent(4):
-    puts(ci.message, stream=stream)
+  out.puts(color(c, 'Date:      {0:%c %z}'.format(ci_author_dt)))
+  out.blank()
+  out.puts(ci.message, indent=4)
+  out.flush()
 
 # Op Callbacks
 
@@ -193,44 +293,107 @@ class FixedOffset(tzinfo):
 
 
 def diff(patch, stream=sys.stdout.write):
+  out = Buffer(stream=stream)
+  _diff(patch, out)
+  out.flush()
+
+
+def _diff(patch, out):
+  if isinstance(patch, core.DiffSummary):
+    _diff_summary(patch, out)
+    return
+
   # Diff header
 
   old_fp = patch.delta.old_file.path
   new_fp = patch.delta.new_file.path
-  puts('Diff of file "{0}"'.format(old_fp), stream=stream)
+  out.puts('Diff of file "{0}"'.format(old_fp))
   if old_fp != new_fp:
-    puts(colored.cyan(' (renamed to {0})'.format(new_fp)), stream=stream)
-    puts(stream=stream)
+    out.puts(color('cyan', ' (renamed to {0})'.format(new_fp)))
+    out.blank()
 
   if patch.delta.is_binary:
-    puts('Not showing diffs for binary file', stream=stream)
+    out.puts('Not showing diffs for binary file')
     return
 
   additions = patch.line_stats[1]
   deletions = patch.line_stats[2]
   if (not additions) and (not deletions):
-    puts('No diffs to output for file', stream=stream)
+    out.puts('No diffs to output for file')
     return
 
   put_s = lambda num: '' if num == 1 else 's'
-  puts('{0} line{1} added'.format(additions, put_s(additions)), stream=stream)
-  puts('{0} line{1} removed'.format(deletions, put_s(deletions)), stream=stream)
-  puts(stream=stream)
+  out.puts('{0} line{1} added'.format(additions, put_s(additions)))
+  out.puts('{0} line{1} removed'.format(deletions, put_s(deletions)))
+  out.blank()
 
   # Diff body
 
   for hunk in patch.hunks:
-    puts(stream=stream)
-    _hunk(hunk, stream=stream)
+    out.blank()
+    _hunk(hunk, out)
+
+  out.blank()
+  out.blank()
+
+
+def _diff_summary(summary, out):
+  """Output the summary of a file too big to diff (see core.DiffSummary)."""
+  out.puts('Diff of file "{0}"'.format(summary.path))
+  out.puts('Not showing diffs for big file (use --full to show them)')
+  for name, size, lines in [
+      ('Old', summary.old_size, summary.old_lines),
+      ('New', summary.new_size, summary.new_lines)]:
+    if size is None:
+      out.puts('{0} version: no file'.format(name))
+    else:
+      out.puts('{0} version: {1} line{2} ({3})'.format(
+          name, lines, '' if lines == 1 else 's', _format_size(size)))
+  out.blank()
+  out.blank()
+
+
+def _format_size(size):
+  if size < 1024:
+    return '{0} bytes'.format(size)
+  for unit in ['KB', 'MB', 'GB']:
+    size /= 1024.0
+    if size < 1024 or unit == 'GB':
+      return '{0:.1f} {1}'.format(size, unit)
+
 
-  puts(stream=stream)
-  puts(stream=stream)
+def diff_stats(stats, summary='stat', stream=sys.stdout.write):
+  """Output the stats of a diff (see core.Branch.diff_stats).
+
+  summary is the format, one of stat (the lines added and removed in each
+  file and in total, like git diff --stat), numstat (the same with tabs) or
+  name-only.
+  """
+  if not stats.files_changed:
+    return
+  if summary == 'stat':
+    stream(stats.format(core.DIFF_STATS_FULL, _terminal_width()))
+    return
+  with Buffer(stream=stream) as out:
+    for fp, insertions, deletions in core.diff_stats_files(stats):
+      if summary == 'name-only':
+        out.puts(fp)
+      else:
+        out.puts('{0}\t{1}\t{2}'.format(
+            '-' if insertions is None else insertions,
+            '-' if deletions is None else deletions, fp))
 
 
-def _hunk(hunk, stream=sys.stdout.write):
-  puts(colored.cyan('@@ -{0},{1} +{2},{3} @@'.format(
-      hunk.old_start, hunk.old_lines, hunk.new_start, hunk.new_lines)),
-      stream=stream)
+def _terminal_width():
+  try:
+    return shutil.get_terminal_size().columns
+  except AttributeError:  # Python 2
+    return 80
+
+
+def _hunk(hunk, out):
+  out.puts(color('cyan', '@@ -{0},{1} +{2},{3} @@'.format(
+      hunk.old_start, hunk.old_lines, hunk.new_start, hunk.new_lines)))
   padding = _padding(hunk)
 
   del_line, add_line, maybe_bold, saw_add = None, None, False, False
@@ -247,33 +410,33 @@ def _hunk(hunk, stream=sys.stdout.write):
     elif st == ' ' and maybe_bold and saw_add:
       bold1, bold2 = _highlight(del_line.content, add_line.content)
 
-      puts(_format_line(del_line, padding, bold_delim=bold1), stream=stream)
-      puts(_format_line(add_line, padding, bold_delim=bold2), stream=stream)
+      out.puts(_format_line(del_line, padding, bold_delim=bold1))
+      out.puts(_format_line(add_line, padding, bold_delim=bold2))
 
       del_line, add_line, maybe_bold, saw_add = None, None, False, False
 
-      puts(_format_line(diff_line, padding), stream=stream)
+      out.puts(_format_line(diff_line, padding))
     else:
       if del_line:
-        puts(_format_line(del_line, padding), stream=stream)
+        out.puts(_format_line(del_line, padding))
       if add_line:
-        puts(_format_line(add_line, padding), stream=stream)
+        out.puts(_format_line(add_line, padding))
 
       del_line, add_line, maybe_bold, saw_add = None, None, False, False
 
-      puts(_format_line(diff_line, padding), stream=stream)
+      out.puts(_format_line(diff_line, padding))
 
 
   if maybe_bold and saw_add:
     bold1, bold2 = _highlight(del_line.content, add_line.content)
 
-    puts(_format_line(del_line, padding, bold_delim=bold1), stream=stream)
-    puts(_format_line(add_line, padding, bold_delim=bold2), stream=stream)
+    out.puts(_format_line(del_line, padding, bold_delim=bold1))
+    out.puts(_format_line(add_line, padding, bold_delim=bold2))
   else:
     if del_line:
-      puts(_format_line(del_line, padding), stream=stream)
+      out.puts(_format_line(del_line, padding))
     if add_line:
-      puts(_format_line(add_line, padding), stream=stream)
+      out.puts(_format_line(add_line, padding))
 
 
 def _padding(hunk):
@@ -288,15 +451,13 @@ def _padding(hunk):
 def _format_line(diff_line, padding, bold_delim=None):
   """Format a standard diff line.
 
+  bold_delim is a list of (start, end) sections of the line (see _highlight)
+  to bold.
+
   Returns:
     a colored version of the diff line using ANSI control characters.
   """
-  # Color constants
-  GREEN = '\033[32m'
-  GREEN_BOLD = '\033[1;32m'
-  RED = '\033[31m'
-  RED_BOLD = '\033[1;31m'
-  CLEAR = '\033[0m'
+  GREEN, GREEN_BOLD, RED, RED_BOLD, CLEAR = _codes()['diff']
 
   formatted = ''
   st = diff_line.origin
@@ -309,55 +470,149 @@ def _format_line(diff_line, padding, bold_delim=None):
         str(old_lineno).ljust(padding) + str(new_lineno).ljust(padding) + line)
   elif st == '+':
     formatted = ' ' * padding + GREEN + str(new_lineno).ljust(padding)
-    if not bold_delim:
-      formatted += line
-    else:
-      bold_start, bold_end = bold_delim
-      formatted += (
-          line[:bold_start] + GREEN_BOLD + line[bold_start:bold_end] + CLEAR +
-          GREEN + line[bold_end:])
+    formatted += _bold(line, bold_delim, GREEN, GREEN_BOLD, CLEAR)
   elif st == '-':
     formatted = RED + str(old_lineno).ljust(padding) + ' ' * padding
-    if not bold_delim:
-      formatted += line
-    else:
-      bold_start, bold_end = bold_delim
-      formatted += (
-          line[:bold_start] + RED_BOLD + line[bold_start:bold_end] + CLEAR +
-          RED + line[bold_end:])
+    formatted += _bold(line, bold_delim, RED, RED_BOLD, CLEAR)
 
   return formatted + CLEAR
 
 
+def _bold(line, sections, color, color_bold, clear):
+  if not sections:
+    return line
+  parts = []
+  prev_end = 0
+  for start, end in sections:
+    parts.append(line[prev_end:start])
+    parts.append(color_bold + line[start:end] + clear + color)
+    prev_end = end
+  parts.append(line[prev_end:])
+  return ''.join(parts)
+
+
+# Intra-line highlighting
+
+# Changed sections are snapped to the boundaries of the tokens they fall in
+# (identifiers, numbers, runs of whitespace or single punctuation chars), we
+# don't look further than this for the start or end of a token
+_MAX_TOKEN_LEN = 64
+# Above this many chars (in the changed section of both lines) we don't diff
+# the tokens to find the changes in it and bold the whole section instead
+_MAX_TOKEN_DIFF_LEN = 2000
+
+_TOKEN = re.compile(r'\w+|\s+|[^\w\s]', re.UNICODE)
+_TOKEN_START = re.compile(r'\w+$', re.UNICODE)
+_TOKEN_END = re.compile(r'^\w+', re.UNICODE)
+_WORD_CHAR = re.compile(r'\w', re.UNICODE)
+
+
 def _highlight(line1, line2):
   """Returns the sections that should be bolded in the given lines.
 
+  The lines (without leading and trailing whitespace) are compared in bulk to
+  find their common prefix and suffix, what's left in between is what
+  changed. If it's not too long, the tokens in it are diffed so that only
+  the tokens that changed are bolded (e.g., only foo and bar in
+  "f(foo, x, y)" -> "f(bar, x, z)"). If the lines have nothing in common
+  nothing is bolded.
+
   Returns:
-    two tuples. Each tuple indicates the start and end of the section
-    of the line that should be bolded for line1 and line2 respectively.
-   """
-  start1 = start2 = 0
-  match = re.search(r'\S', line1)  # ignore leading whitespace
-  if match:
-    start1 = match.start()
-  match = re.search(r'\S', line2)
-  if match:
-    start2 = match.start()
-  length = min(len(line1), len(line2)) - 1
-  bold_start1 = start1
-  bold_start2 = start2
-  while (bold_start1 <= length and bold_start2 <= length and
-         line1[bold_start1] == line2[bold_start2]):
-    bold_start1 += 1
-    bold_start2 += 1
-  match = re.search(r'\s*$', line1)  # ignore trailing whitespace
-  bold_end1 = match.start() - 1
-  match = re.search(r'\s*$', line2)
-  bold_end2 = match.start() - 1
-  while (bold_end1 >= bold_start1 and bold_end2 >= bold_start2 and
-         line1[bold_end1] == line2[bold_end2]):
-    bold_end1 -= 1
-    bold_end2 -= 1
-  if bold_start1 - start1 > 0 or len(line1) - 1 - bold_end1 > 0:
-    return (bold_start1 + 1, bold_end1 + 2), (bold_start2 + 1, bold_end2 + 2)
-  return None, None
+    two lists (or None, None if nothing should be bolded). Each list has the
+    (start, end) sections to bold for line1 and line2 respectively (in the
+    line as output, i.e., with the leading +/- char).
+  """
+  start1 = len(line1) - len(line1.lstrip())
+  start2 = len(line2) - len(line2.lstrip())
+  l1 = line1[start1:len(line1.rstrip())]
+  l2 = line2[start2:len(line2.rstrip())]
+  if l1 == l2:
+    return None, None
+
+  prefix = _common_prefix_len(l1, l2)
+  suffix = _common_prefix_len(l1[prefix:][::-1], l2[prefix:][::-1])
+  if not prefix and not suffix:
+    return None, None
+  prefix = _token_start(l1, l2, prefix)
+  end1 = _token_end(l1, len(l1) - suffix)
+  end2 = _token_end(l2, len(l2) - suffix)
+
+  changed1 = l1[prefix:end1]
+  changed2 = l2[prefix:end2]
+  if len(changed1) + len(changed2) > _MAX_TOKEN_DIFF_LEN:
+    sections1 = [(prefix, end1)] if changed1 else []
+    sections2 = [(prefix, end2)] if changed2 else []
+  else:
+    sections1, sections2 = _diff_tokens(changed1, changed2)
+    sections1 = [(s + prefix, e + prefix) for s, e in sections1]
+    sections2 = [(s + prefix, e + prefix) for s, e in sections2]
+
+  # + 1 for the leading +/- char
+  return (
+      [(s + start1 + 1, e + start1 + 1) for s, e in sections1],
+      [(s + start2 + 1, e + start2 + 1) for s, e in sections2])
+
+
+def _common_prefix_len(s1, s2):
+  """Return the length of the common prefix of s1 and s2.
+
+  Instead of going char by char, slices of the strings are compared (which is
+  done in C) halving their size until the prefix is found.
+  """
+  lo, hi = 0, min(len(s1), len(s2))
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if s1[lo:mid] == s2[lo:mid]:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo
+
+
+def _token_start(l1, l2, i):
+  """Move i back to the start of the token it's in (in both lines)."""
+  if i and (
+      _WORD_CHAR.match(l1[i - 1:i]) and (
+          _WORD_CHAR.match(l1[i:i + 1]) or _WORD_CHAR.match(l2[i:i + 1]))):
+    match = _TOKEN_START.search(l1, max(0, i - _MAX_TOKEN_LEN), i)
+    if match:
+      i = match.start()
+  return i
+
+
+def _token_end(l, i):
+  """Move i forward to the end of the token it's in."""
+  if i < len(l) and i and (
+      _WORD_CHAR.match(l[i:i + 1]) and _WORD_CHAR.match(l[i - 1:i])):
+    match = _TOKEN_END.match(l[i:i + _MAX_TOKEN_LEN])
+    if match:
+      i += match.end()
+  return i
+
+
+def _diff_tokens(s1, s2):
+  """Return the sections of s1 and s2 with the tokens that differ."""
+  tokens1 = [(m.start(), m.end()) for m in _TOKEN.finditer(s1)]
+  tokens2 = [(m.start(), m.end()) for m in _TOKEN.finditer(s2)]
+  if len(tokens1) <= 1 or len(tokens2) <= 1:
+    # The common case of a token changed or added, nothing to diff
+    return [(0, len(s1))] if s1 else [], [(0, len(s2))] if s2 else []
+  matcher = difflib.SequenceMatcher(
+      None, [s1[s:e] for s, e in tokens1], [s2[s:e] for s, e in tokens2],
+      autojunk=False)
+  sections1, sections2 = [], []
+  for op, i1, i2, j1, j2 in matcher.get_opcodes():
+    if op == 'equal':
+      continue
+    if i1 < i2:
+      _add_section(sections1, tokens1[i1][0], tokens1[i2 - 1][1])
+    if j1 < j2:
+      _add_section(sections2, tokens2[j1][0], tokens2[j2 - 1][1])
+  return sections1, sections2
+
+
+def _add_section(sections, start, end):
+  if sections and sections[-1][1] == start:  # merge contiguous sections
+    sections[-1] = (sections[-1][0], end)
+  else:
+    sections.append((start, end))
@@ -7,21 +7,38 @@
 
 from __future__ import unicode_literals
 
+import array
+import binascii
 import collections
+import fnmatch
+import hashlib
 import io
 try:
   from itertools import izip as zip
 except ImportError:
   pass
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 import itertools
 import json
 from locale import getpreferredencoding
 import os
 import re
+import select
 import shutil
+import socket
+import stat
+import struct
+import threading
+import time
 
 import pygit2
+from pygit2.errors import check_error
+from pygit2.ffi import ffi, C
+from pygit2.utils import StrArray
 from sh import git, ErrorReturnCode
 
 
@@ -39,19 +56,64 @@ class BranchIsCurrentError(GlError): pass
 class ApplyFailedError(GlError): pass
 
 
+# Index
+
+# The versions of the index format we can read
+INDEX_VERSIONS = (2, 3)
+
+# Special chars are escaped with a backslash in cone mode patterns
+_SPARSE_UNESCAPE = re.compile(r'\\(.)')
+
+_INDEX_HEADER = struct.Struct(str('>4sII'))  # signature, version, entries
+
+
 # File status
 
 GL_STATUS_UNTRACKED = 1
 GL_STATUS_TRACKED = 2
 GL_STATUS_IGNORED = 3
 
+# Below this many paths, Branch.status_files looks up each path individually
+# instead of computing the status of the whole repo
+_STATUS_FILES_BATCH_MIN = 32
+
+
+# Diff stats
+
+# To format the stats of a diff (see Branch.diff_stats) like git diff --stat
+DIFF_STATS_FULL = pygit2.GIT_DIFF_STATS_FULL
+
+# In the number format of libgit2 the counts are left-justified in columns of
+# this width (with no separator, so counts of 8+ digits run into the next
+# column and can't be told apart, see diff_stats_files)
+_DIFF_STATS_NUMBER_WIDTH = 8
+_DIFF_STATS_NUMBER = re.compile(r'(-|\d+) +$')
+
 
-def init_repository(url=None):
+# Diff limits (see _DiffLimits)
+
+# Files bigger than this many bytes or with more than this many lines are not
+# diffed, only a summary of them is reported (unless the diff is forced)
+_DIFF_MAX_SIZE = 2 * 1024 * 1024
+_DIFF_MAX_LINES = 20000
+
+_DIFF_CHUNK_SIZE = 1024 * 1024
+
+# What is reported instead of the patch of a file over the diff limits. The
+# sizes (in bytes) and lines are those of the old and new versions of the
+# file, None if there's no such version
+DiffSummary = collections.namedtuple(
+    'DiffSummary', ['path', 'old_size', 'new_size', 'old_lines', 'new_lines'])
+
+
+def init_repository(url=None, sparse_dirs=None):
   """Creates a new Gitless's repository in the cwd.
 
   Args:
     url: if given the local repository will be a clone of the remote repository
       given by this url.
+    sparse_dirs: if given (and there's a url) only these dirs of the remote
+      repository are checked out (see Repository.set_sparse_dirs).
   """
   cwd = os.getcwd()
   try:
@@ -65,12 +127,19 @@ def init_repository(url=None):
       return repo
 
     try:
-      git.clone(url, cwd)
+      if sparse_dirs is None:
+        git.clone(url, cwd)
+      else:
+        # Only the files at the root are checked out until we set the dirs
+        git.clone('--sparse', url, cwd)
     except ErrorReturnCode as e:
       raise GlError(stderr(e))
 
-    # We get all remote branches as well and create local equivalents
     repo = Repository()
+    if sparse_dirs is not None:
+      repo.set_sparse_dirs(sparse_dirs)
+
+    # We get all remote branches as well and create local equivalents
     remote = repo.remotes['origin']
     for rb in (remote.lookup_branch(bn) for bn in remote.listall_branches()):
       if rb.branch_name == 'master':
@@ -105,12 +174,71 @@ class Repository(object):
     self.path = self.git_repo.path
     self.root = self.path[:-6]  # strip trailing /.git/
     self.config = self.git_repo.config
+    # The checksum of the index as of the last index transaction (see
+    # Branch._index)
+    self._txn_index_checksum = None
 
   @property
   def cwd(self):
     ret = os.path.relpath(os.getcwd(), self.root)
     return '' if ret == '.' else ret
 
+  def expand_paths(self, paths):
+    """Return a generator of the files at or under the given paths.
+
+    Paths are relative to the repo root ('' is the root) and so are the files
+    generated. Paths that are not dirs are generated as they are. Dirs are
+    expanded to the files in them that are not ignored: the ignore rules are
+    applied by the walk itself, so ignored dirs (like node_modules) are never
+    descended into, nor are .git dirs and nested repos. Tracked files in
+    ignored dirs are still generated. Each dir is expanded when the generator
+    gets to it and each file is generated only once.
+    """
+    git_repo = self.git_repo
+    index = git_repo.index
+    root = self.root
+    seen = set()
+    for path in paths:
+      path = '' if path in ('.', '') else path.replace(os.sep, '/')
+      fp = os.path.join(root, path)
+      if os.path.islink(fp) or not os.path.isdir(fp):
+        if path not in seen:
+          seen.add(path)
+          yield path
+        continue
+
+      index.read(False)
+      # Tracked files first, straight from the index
+      for f, _ in _index_entries(index, pathspec=[path]):
+        if f not in seen and os.path.lexists(os.path.join(root, f)):
+          seen.add(f)
+          yield f
+      # Then the untracked ones. Nested repos are reported as an untracked
+      # 'dir/' entry (libgit2 doesn't look into them) and ignored dirs as an
+      # ignored 'dir/' entry, so neither shows up here.
+      sts = _git_status(git_repo, index, pathspec=[path], tracked=False)
+      dirs = frozenset([path])
+      for f in sorted(sts):
+        if (sts[f] == pygit2.GIT_STATUS_WT_NEW and not f.endswith('/') and
+            f not in seen and _under_any(f, dirs)):
+          seen.add(f)
+          yield f
+
+  def ignored_dirs(self, paths):
+    """Return the set of ignored dirs at or under the given paths.
+
+    Those are the dirs that are ignored as a whole: libgit2 (and so the
+    status) doesn't look into them. Ignored dirs with tracked files in them
+    are not.
+    """
+    git_repo = self.git_repo
+    index = git_repo.index
+    index.read(False)
+    sts = _git_status(git_repo, index, pathspec=list(paths), tracked=False)
+    return set(
+        f[:-1] for f, st in sts.items()
+        if f.endswith('/') and st == pygit2.GIT_STATUS_IGNORED)
+
   def revparse_single(self, revision):
     if '/' in revision:  # might be a remote branch
       remote, remote_branch = revision.split('/', 1)
@@ -123,6 +251,177 @@ class Repository(object):
     except (KeyError, ValueError):
       raise ValueError('No commit found for {0}'.format(revision))
 
+  IndexInfo = collections.namedtuple(
+      'IndexInfo', ['version', 'entries', 'size', 'split'])
+
+  def index_info(self):
+    """Return the format of the index (see IndexInfo).
+
+    The info is read straight from the index file (the index is not loaded).
+    version and entries are None if there's no index yet, split is True if
+    the index is split in two (git's split index mode), size is the size in
+    bytes of the index file plus that of the shared index if it's split.
+    """
+    index_fp = os.path.join(self.path, 'index')
+    try:
+      size = os.path.getsize(index_fp)
+    except OSError:
+      return self.IndexInfo(None, None, 0, False)
+    version, entries = _index_header(self.path)
+    # Shared indexes can outlive the split index that used them, the index is
+    # split if it has the link extension (that libgit2 refuses to read)
+    shared = [
+        fp for fp in os.listdir(self.path) if fp.startswith('sharedindex.')]
+    split = False
+    if shared and version in INDEX_VERSIONS:
+      try:
+        self.git_repo.index.read(False)
+      except pygit2.GitError:
+        split = True
+    for fp in shared if split else []:
+      size += os.path.getsize(os.path.join(self.path, fp))
+    return self.IndexInfo(version, entries, size, split)
+
+  def check_index(self, split=True):
+    """Raises GlError if the index is in a format we can't work with.
+
+    The libgit2 version we use only reads versions 2 and 3 of the index
+    format, and it doesn't know about git's split index mode (see
+    rewrite_index). If split is False only the version is checked, which
+    only takes reading the header of the index (a split index can only be
+    told apart by trying to read it, so that's left for when reading it
+    fails).
+    """
+    if not split:
+      version, unused_entries = _index_header(self.path)
+      info = self.IndexInfo(version, None, None, False)
+    else:
+      info = self.index_info()
+    if info.split or (
+        info.version is not None and info.version not in INDEX_VERSIONS):
+      raise GlError(
+          'The index of this repository is in a format Gitless can\'t read '
+          '({0}). Do gl index --rewrite to rewrite it in a format Gitless '
+          'can read'.format(
+              'split index' if info.split
+              else 'version {0}'.format(info.version)))
+
+  def rewrite_index(self, version=INDEX_VERSIONS[0]):
+    """Rewrites the index in the given version of the format, not split.
+
+    The config options that make git write the index in a format we can't
+    read (index.version, feature.manyFiles and core.splitIndex) are updated
+    so that it stays in that format.
+    """
+    if version not in INDEX_VERSIONS:
+      raise ValueError(
+          'Unsupported index version {0}, the versions supported are '
+          '{1}'.format(version, ', '.join(str(v) for v in INDEX_VERSIONS)))
+    config = self.config
+    try:
+      index_version = config.get_int('index.version')
+    except (KeyError, ValueError):
+      index_version = None
+    if (index_version not in INDEX_VERSIONS and (
+        index_version is not None or self._config_bool('feature.manyFiles'))):
+      config['index.version'] = version
+    if self._config_bool('core.splitIndex'):
+      config['core.splitIndex'] = False
+    git('update-index', '--index-version', str(version), '--no-split-index')
+    self.git_repo.index.read()
+
+  # Sparse checkouts
+
+  def is_sparse(self):
+    """True if only part of the tree is checked out (see set_sparse_dirs)."""
+    return self._config_bool('core.sparseCheckout')
+
+  def sparse_dirs(self):
+    """Return the dirs checked out, None if the whole tree is checked out.
+
+    Only sparse checkouts in cone mode are supported (None is returned if the
+    sparse checkout is not in cone mode). In cone mode, the files at the root,
+    the files directly in the parents of the dirs and everything under the
+    dirs are checked out.
+    """
+    if not self.is_sparse() or not self._config_bool('core.sparseCheckoutCone'):
+      return None
+    dirs = []
+    parents = set()
+    try:
+      with io.open(
+          os.path.join(self.path, 'info', 'sparse-checkout'), mode='r',
+          encoding='utf-8') as f:
+        patterns = f.read().splitlines()
+    except IOError:
+      return []
+    for pattern in patterns:
+      pattern = _SPARSE_UNESCAPE.sub(r'\1', pattern)
+      if pattern.startswith('!/') and pattern.endswith('/*/'):
+        parents.add(pattern[2:-3])
+      elif pattern.startswith('/') and pattern.endswith('/') and pattern != '/':
+        dirs.append(pattern[1:-1])
+    return [d for d in dirs if d not in parents]
+
+  def set_sparse_dirs(self, dirs, add=False):
+    """Checks out only the given dirs (and the files at the root).
+
+    This is git's sparse checkout in cone mode: the files at the root, the
+    files directly in the parents of the dirs and everything under the dirs
+    are checked out, the rest of the tree is removed from the working
+    directory (but it's still in the index, with the skip-worktree bit set).
+    The status, switching branches and checking out files only look at what's
+    checked out, so their cost scales with it instead of with the repo.
+
+    Args:
+      dirs: the dirs to check out (relative to the root).
+      add: if True, the dirs are checked out in addition to those that already
+        are (instead of replacing them).
+    """
+    dirs = [d.strip('/') for d in dirs]
+    if '' in dirs:
+      raise ValueError(
+          'The root is always checked out, to check out the whole tree '
+          'disable the sparse checkout')
+    try:
+      if self.sparse_dirs() is None:
+        git('sparse-checkout', 'init', '--cone', _cwd=self.root)
+        add = False
+      git('sparse-checkout', 'add' if add else 'set', *dirs, _cwd=self.root)
+    except ErrorReturnCode as e:
+      raise GlError(stderr(e))
+    self.git_repo.index.read()
+
+  def disable_sparse(self):
+    """Checks out the whole tree again."""
+    try:
+      git('sparse-checkout', 'disable', _cwd=self.root)
+    except ErrorReturnCode as e:
+      raise GlError(stderr(e))
+    self.git_repo.index.read()
+
+  def _checkout_branch(self, b):
+    if self.is_sparse():
+      # libgit2 doesn't know about sparse checkouts, it would check out the
+      # whole tree
+      git.checkout(b.branch_name, '--', _cwd=self.root)
+      self.git_repo.index.read()
+    else:
+      self.git_repo.checkout(b.git_branch)
+
+  def _reset_hard(self, cid):
+    if self.is_sparse():  # same as above
+      git.reset('--hard', str(cid), _cwd=self.root)
+      self.git_repo.index.read()
+    else:
+      self.git_repo.reset(cid, pygit2.GIT_RESET_HARD)
+
+  def _config_bool(self, name):
+    try:
+      return self.config.get_bool(name)
+    except (KeyError, ValueError):
+      return False
+
   def merge_base(self, b1, b2):
     try:
       return self.git_repo.merge_base(b1.target, b2.target)
@@ -250,17 +549,16 @@ class Repository(object):
     git_repo = self.git_repo
     au_fp = lambda b: os.path.join(
         self.path, 'GL_AU_{0}'.format(b.branch_name.replace('/', '_')))
-    update_index = git.bake('update-index', _cwd=self.root)
 
     def save(b):
       msg = _stash_msg(b.branch_name)
 
       # Save assumed unchanged info
-      au_fps = ' '.join(b._au_files())
+      au_fps = b._au_files()
       if au_fps:
         with io.open(au_fp(b), mode='w', encoding=ENCODING) as f:
-          f.write(au_fps)
-        update_index('--no-assume-unchanged', au_fps)
+          f.write(''.join(fp + '\n' for fp in au_fps))
+        b._set_au_files(au_fps, False)
 
       if b.merge_in_progress or b.fuse_in_progress:
         body = {}
@@ -328,7 +626,13 @@ class Repository(object):
         if os.path.exists(au):
           with io.open(au, mode='r', encoding=ENCODING) as f:
             au_fps = f.read()
-          update_index('--assume-unchanged', au_fps)
+          # One path per line, older versions wrote them separated by spaces
+          # (and with no newline at the end)
+          if au_fps.endswith('\n'):
+            au_fps = au_fps.splitlines()
+          else:
+            au_fps = au_fps.split()
+          b._set_au_files(au_fps, True)
           os.remove(au)
 
       split_msg = msg.split(INFO_SEP)
@@ -345,7 +649,7 @@ class Repository(object):
         if 'GL_FUSE_ORIG_HEAD' in ref_info:  # fuse
           head = git_repo[ref_info['HEAD']]
           git_repo.set_head(head.id)
-          git_repo.reset(head.id, pygit2.GIT_RESET_HARD)
+          self._reset_hard(head.id)
           self._ref_create('CHERRY_PICK_HEAD', ref_info['CHERRY_PICK_HEAD'])
           self._ref_create('GL_FUSE_ORIG_HEAD', ref_info['GL_FUSE_ORIG_HEAD'])
         else:  # merge
@@ -356,21 +660,13 @@ class Repository(object):
 
         # Restore conflict info
         conf_info = body[CONF_INFO]
-        rm_sentinel = lambda path: '0 {0}\t{1}'.format('0' * 40, path)
-        build_entry = (
-            lambda e, num: '{mode:o} {id} {0}\t{path}'.format(num, **e))
-        index_info = []
-        for path, index_e in conf_info.items():
-          index_info.append(rm_sentinel(path))
-          if index_e[ANCESTOR]:
-            index_info.append(build_entry(index_e[ANCESTOR], 1))
-          if index_e[OURS]:
-            index_info.append(build_entry(index_e[OURS], 2))
-          if index_e[THEIRS]:
-            index_info.append(build_entry(index_e[THEIRS], 3))
-
-        update_index('--unresolve', _in=' '.join(conf_info.keys()))
-        update_index('--index-info', _in='\n'.join(index_info))
+        if conf_info:
+          index = git_repo.index
+          index.read()
+          for path, index_e in conf_info.items():
+            _add_conflict(
+                index, path, index_e[ANCESTOR], index_e[OURS], index_e[THEIRS])
+          index.write()
 
         # Restore msg info
         merge_msg_fp = os.path.join(self.path, 'MERGE_MSG')
@@ -381,7 +677,7 @@ class Repository(object):
         restore_au_info()
 
     save(self.current_branch)
-    git_repo.checkout(dst_b.git_branch)
+    self._checkout_branch(dst_b)
     restore(dst_b)
 
 
@@ -670,17 +966,55 @@ class Branch(object):
   def diff_commits(self, c1, c2):
     return c1.tree.diff_to_tree(c2.tree)
 
+  def diff_commits_files(self, c1, c2, full=False):
+    """Return a generator of the patch of each file changed from c1 to c2.
+
+    Files over the diff limits get a DiffSummary instead of a patch, unless
+    full is True (see diff_files).
+    """
+    if full:
+      for patch in self.diff_commits(c1, c2):
+        yield patch
+      return
+    git_repo = self.gl_repo.git_repo
+    limits = _DiffLimits(git_repo.config)
+    # Nothing is diffed to find the files that changed (not even to count
+    # lines, as libgit2's stats do), and only the files under the limits are
+    # diffed after that
+    for path, old, new in _tree_changes(git_repo, c1.tree, c2.tree):
+      summary = limits.summary(path, _blob_version(old), _blob_version(new))
+      if summary:
+        yield summary
+        continue
+      if old is None:  # a new file
+        old = _empty_blob(git_repo)
+      elif new is None:  # a deleted file
+        new = _empty_blob(git_repo)
+      yield old.diff(new, 0, path, path)
+
   def __str__(self):
     return self.branch_name
 
   @property
   def _index(self):
     """Convenience wrapper of Git's index."""
+    gl_repo = self.gl_repo
+
     class Index(object):
 
       def __init__(self, git_index):
         self._git_index = git_index
-        self._git_index.read()
+        # The index is only parsed again if it changed in disk (any changes
+        # left in memory are discarded on exit). libgit2 tells that by the
+        # mtime (in secs) and size of the index, which misses a change made
+        # in the same second that keeps the size (and we would write the
+        # stale index over it), so we also compare the checksum of the index
+        # in disk with that of the one we last wrote
+        checksum = _index_checksum(gl_repo.path)
+        if checksum and checksum == gl_repo._txn_index_checksum:
+          self._git_index.read(False)
+        else:
+          self._git_index.read()
 
       def __enter__(self):
         return self
@@ -688,12 +1022,14 @@ class Branch(object):
       def __exit__(self, type, value, traceback):
         if not value:  # no exception
           self._git_index.write()
+          gl_repo._txn_index_checksum = _index_checksum(gl_repo.path)
           return True
+        self._git_index.read()  # discard the changes
 
       def __getattr__(self, name):
         return getattr(self._git_index, name)
 
-    return Index(self.gl_repo.git_repo.index)
+    return Index(gl_repo.git_repo.index)
 
   _st_map = {
     # git status: gl status, exists_at_head, exists_in_wd, modified, conflict
@@ -737,150 +1073,651 @@ class Branch(object):
         'fp', 'type', 'exists_at_head', 'exists_in_wd', 'modified',
         'in_conflict'])
 
-  def _au_files(self):
-    for f_out in stdout(
-        git('ls-files', '-v', _cwd=self.gl_repo.root)).splitlines():
-      if f_out[0] == 'h':
-        yield f_out[2:].strip()
+  def _au_files(self, pathspec=None):
+    """Return the list of assumed unchanged files.
+
+    The assume-valid bits are read straight from the entries of the in-memory
+    index (there's no need to ask git for them).
+
+    Args:
+      pathspec: if given, only the files at or under these paths are looked
+        at.
+    """
+    index = self.gl_repo.git_repo.index
+    index.read(False)  # only reloads the index if it changed in disk
+    return [path for path, flags in _index_entries(index, pathspec=pathspec)
+            if flags & _IDXENTRY_VALID]
+
+  def _set_au_files(self, paths, au):
+    """Marks (or unmarks if au is False) paths as assumed unchanged."""
+    with self._index as index:
+      for path in paths:
+        _set_index_entry_flag(index, path, _IDXENTRY_VALID, au)
 
-  def status(self):
+  def status(
+      self, use_cache=True, pathspec=None, collapse_untracked=False,
+      workers=None, timings=None, on_tracked=None):
     """Return a generator of file statuses (see FileStatus).
 
     Ignored and tracked unmodified files are not reported.
     File paths are always relative to the repo root.
+
+    Args:
+      use_cache: if False, the status cache is not used (nor updated).
+      pathspec: if given, only the status of the files at or under these paths
+        (relative to the repo root, '' is the root) is computed.
+      collapse_untracked: if True, dirs with only untracked files in them are
+        reported as one untracked entry with the path of the dir followed by
+        a '/' (and the files in them are not looked at).
+      workers: the number of threads to use to check the files in the index
+        before computing the status (see _preload_index). Defaults to the
+        value of the gitless.statusWorkers config option (or to 1, which
+        means no preloading).
+      timings: if given, a StatusTimings object where to record where the
+        time went (it's complete once the generator is exhausted).
+      on_tracked: if given, it's called with the list of statuses of the
+        files whose status is already known once the tracked part of the
+        status is computed, before walking the working directory for
+        untracked files. That's only the case if the status cache is used
+        (see _StatusCache). These statuses are not yielded.
     """
-    for fp, git_s in self.gl_repo.git_repo.status().items():
-      yield self.FileStatus(fp, *self._st_map[git_s])
+    early = set()
+
+    def tracked_done(tracked):
+      # A file deleted from the index might be untracked in the working
+      # directory, all others are in the index so the walk can't change them
+      for fp, git_s in tracked.items():
+        if not git_s & pygit2.GIT_STATUS_INDEX_DELETED:
+          early.add(fp)
+      on_tracked(
+          [self.FileStatus(fp, *self._st_map[tracked[fp]]) for fp in early])
+
+    git_sts = self._git_status(
+        use_cache=use_cache, pathspec=pathspec,
+        collapse_untracked=collapse_untracked, workers=workers,
+        timings=timings, on_tracked=tracked_done if on_tracked else None)
+    for fp, git_s in git_sts.items():
+      if fp not in early:
+        yield self.FileStatus(fp, *self._st_map[git_s])
 
     # status doesn't report au files
-    au_files = self._au_files()
-    if au_files:
-      for fp in au_files:
-        exists_in_wd = os.path.exists(os.path.join(self.gl_repo.root, fp))
-        yield self.FileStatus(
-            fp, GL_STATUS_UNTRACKED, True, exists_in_wd, True, False)
+    root = self.gl_repo.root
+    with _Phase(timings, 'assumed unchanged'):
+      au_files = self._au_files(pathspec=pathspec)
+    for fp in au_files:
+      exists_in_wd = os.path.exists(os.path.join(root, fp))
+      yield self.FileStatus(
+          fp, GL_STATUS_UNTRACKED, True, exists_in_wd, True, False)
+
+  def _git_status(
+      self, use_cache=True, pathspec=None, collapse_untracked=False,
+      workers=None, timings=None, on_tracked=None):
+    """Return a dict of path -> git status of the repo (or of pathspec).
+
+    on_tracked is given to _StatusCache if it's used (see status).
+    """
+    gl_repo = self.gl_repo
+    recurse = not collapse_untracked
+    index = gl_repo.git_repo.index
+    index.read(False)
+    if workers is None:
+      try:
+        workers = gl_repo.config.get_int('gitless.statusWorkers')
+      except (KeyError, ValueError):  # not set or not a number
+        workers = 1
+    if timings:
+      timings.index_entries = len(index)
+      timings.workers = max(workers, 1)
+    sparse = gl_repo.is_sparse()
+    if sparse and (not pathspec or '' in pathspec):
+      # Only what's checked out is looked at, the top-level dirs that are not
+      # checked out are not even in the working directory
+      pathspec = _sparse_pathspec(gl_repo, index) or ['']
+    # The checksum of the index we read, if we refresh it (see _preload_index)
+    # and write it the checksum changes but the status doesn't
+    refreshed_from = None
+    if workers > 1:
+      checksum = _index_checksum(gl_repo.path)
+      with _Phase(timings, 'preload'):
+        refreshed = _preload_index(
+            gl_repo.git_repo, index, workers, pathspec=pathspec,
+            checksum=checksum)
+      if timings:
+        timings.refreshed = refreshed
+      if refreshed:
+        refreshed_from = checksum
+    if sparse:
+      # The cache is for the whole repo, so it's not used
+      sts = _git_status(
+          gl_repo.git_repo, index, pathspec=_top_dirs(pathspec),
+          recurse_untracked=recurse, timings=timings)
+      _drop_not_checked_out(sts, index)
+      return sts
+    if pathspec and '' not in pathspec:
+      # The walk is limited to the given paths, which is what makes this
+      # cheap, so there's no need for the cache (that is for the whole repo)
+      return _git_status(
+          gl_repo.git_repo, index, pathspec=_top_dirs(pathspec),
+          recurse_untracked=recurse, timings=timings)
+    if use_cache:
+      try:
+        use_cache = gl_repo.config.get_bool('gitless.statusCache')
+      except KeyError:
+        pass
+    if not use_cache:
+      # libgit2's status, which is the reference our own status engine is
+      # checked against
+      with _Phase(timings, 'git status'):
+        sts = gl_repo.git_repo.status()
+        if not recurse:
+          sts = _collapse_untracked(sts, index)
+      return sts
+
+    return _StatusCache(
+        gl_repo, recurse_untracked=recurse, timings=timings,
+        refreshed_from=refreshed_from, on_tracked=on_tracked).status(index)
 
   def status_file(self, path):
     """Return the status (see FileStatus) of the given path."""
     return self._status_file(path)[0]
 
+  def status_files(self, paths):
+    """Return the status (see FileStatus) of the given paths.
+
+    The status of all paths is computed at once, which is much faster than
+    calling status_file for each path.
+
+    Returns:
+      a dict of path -> FileStatus. Nonexistent paths are not in the dict.
+    """
+    return dict(
+        (path, st[0]) for path, st in self._status_files(paths).items())
+
+  StatusSummary = collections.namedtuple(
+    'StatusSummary', [
+        'branch_name', 'op', 'dirty', 'tracked_modified', 'untracked',
+        'conflicts', 'stale'])
+
+  def status_summary(self, counts=True, timeout=None):
+    """Return a summary of the status (see StatusSummary).
+
+    Only aggregate counts are computed, no per-file statuses are built. The
+    counts are of the files gl status would list (conflicts are not counted as
+    tracked modified files and dirs with only untracked files in them count as
+    one).
+
+    Args:
+      counts: if False, we stop as soon as we know whether there are changes
+        or not (dirty) and the counts are None.
+      timeout: if given, the max number of secs to wait for the summary. If
+        it's not ready by then, the last summary that was computed is
+        returned with stale set to True (if there's none, a summary with
+        dirty and the counts set to None). The summary is computed in a
+        detached process (see _fork_detached) that saves it for the next
+        time, so we don't have to wait for it to finish to exit.
+    """
+    op = None
+    if self.merge_in_progress:
+      op = 'merge'
+    elif self.fuse_in_progress:
+      op = 'fuse'
+    if timeout is None or not hasattr(os, 'fork'):
+      return self._status_summary(op, counts)
+
+    r, w = os.pipe()
+    if _fork_detached():
+      try:
+        os.close(r)
+        summary = self._status_summary(op, counts)
+        # It's less than PIPE_BUF, so it's written in one go (and read that
+        # way)
+        os.write(w, json.dumps(summary._asdict()).encode('utf-8'))
+      finally:
+        os._exit(0)
+    os.close(w)
+    try:
+      if select.select([r], [], [], timeout)[0]:
+        data = os.read(r, _STATUS_SUMMARY_MAX_SIZE)
+        if data:
+          return self.StatusSummary(**json.loads(data.decode('utf-8')))
+    finally:
+      os.close(r)
+    try:
+      with io.open(
+          os.path.join(self.gl_repo.path, STATUS_SUMMARY_FILE), mode='rb') as f:
+        last = json.loads(f.read().decode('utf-8'))
+      if last['branch_name'] != self.branch_name:
+        raise ValueError()
+      dirty, tracked_modified, untracked, conflicts = (
+          last['dirty'], last['tracked_modified'], last['untracked'],
+          last['conflicts'])
+    except (IOError, OSError, ValueError, KeyError):
+      dirty = tracked_modified = untracked = conflicts = None
+    return self.StatusSummary(
+        self.branch_name, op, dirty, tracked_modified, untracked, conflicts,
+        True)
+
+  def _status_summary(self, op, counts):
+    git_repo = self.gl_repo.git_repo
+    index = git_repo.index
+    index.read(False)
+    au_fps = (
+        path for path, flags in _index_entries(index)
+        if flags & _IDXENTRY_VALID)
+    tracked_modified = untracked = conflicts = None
+    if counts:
+      tracked_modified, untracked, conflicts = _status_counts(git_repo, index)
+      untracked += sum(1 for _ in au_fps)
+      dirty = bool(tracked_modified or untracked or conflicts)
+    else:
+      dirty = next(au_fps, None) is not None or any(
+          st != pygit2.GIT_STATUS_IGNORED for st in _git_status(
+              git_repo, index, recurse_untracked=False, limit=1).values())
+
+    summary = self.StatusSummary(
+        self.branch_name, op, dirty, tracked_modified, untracked, conflicts,
+        False)
+    tmp_fp = os.path.join(self.gl_repo.path, STATUS_SUMMARY_FILE + '.tmp')
+    try:
+      with io.open(tmp_fp, mode='wb') as f:
+        f.write(json.dumps(summary._asdict()).encode('utf-8'))
+      os.rename(tmp_fp, os.path.join(self.gl_repo.path, STATUS_SUMMARY_FILE))
+    except (IOError, OSError):
+      pass
+    return summary
+
   def _status_file(self, path):
-    assert not os.path.isabs(path)
+    try:
+      return self._status_files([path])[path]
+    except KeyError:
+      raise KeyError(path)
 
-    git_st = self.gl_repo.git_repo.status_file(path)
+  def _status_files(self, paths):
+    """Return a dict of path -> (FileStatus, git status, is_au)."""
+    paths = frozenset(paths)
+    assert not any(os.path.isabs(path) for path in paths)
 
-    root = self.gl_repo.root
-    cmd_out = stdout(git('ls-files', '-v', '--full-name', path, _cwd=root))
-    is_au = cmd_out and cmd_out[0] == 'h'
-    if is_au:
-      exists_in_wd = os.path.exists(os.path.join(root, path))
-      f_st = self.FileStatus(
-          path, GL_STATUS_UNTRACKED, True, exists_in_wd, True, False)
+    git_repo = self.gl_repo.git_repo
+    index = git_repo.index
+    index.read(False)
+
+    def status_of(path):
+      try:
+        return git_repo.status_file(path)
+      except KeyError:
+        return None
+
+    if len(paths) < _STATUS_FILES_BATCH_MIN:
+      # It's cheaper to look up each path than to compute the status of the
+      # whole repo
+      git_sts = dict((path, status_of(path)) for path in paths)
+      au = frozenset(
+          path for path in paths
+          if _index_entry_flags(index, path) & _IDXENTRY_VALID)
     else:
-      f_st = self.FileStatus(path, *self._st_map[git_st])
-    return f_st, git_st, is_au
+      # One status computation and one index scan for all paths. Tracked
+      # unmodified files are not in the repo's status, the ones that are not
+      # in the index either (e.g., files in ignored dirs, which are reported
+      # as the dir) are looked up individually.
+      repo_sts = self._git_status()
+      in_index = set()
+      au = set()
+      for path, flags in _index_entries(index):
+        if path in paths:
+          in_index.add(path)
+          if flags & _IDXENTRY_VALID:
+            au.add(path)
+      git_sts = {}
+      for path in paths:
+        if path in repo_sts:
+          git_sts[path] = repo_sts[path]
+        elif path in in_index:
+          git_sts[path] = pygit2.GIT_STATUS_CURRENT
+        else:
+          git_sts[path] = status_of(path)
+
+    if self.gl_repo.is_sparse():
+      # The files left out of the checkout are not deleted (see _git_status)
+      for path, git_st in git_sts.items():
+        if (git_st and git_st & pygit2.GIT_STATUS_WT_DELETED and
+            _index_entry_skipped(index, path)):
+          git_sts[path] = git_st & ~pygit2.GIT_STATUS_WT_DELETED
+
+    root = self.gl_repo.root
+    ret = {}
+    for path, git_st in git_sts.items():
+      if git_st is None:  # nonexistent path
+        continue
+      is_au = path in au
+      if is_au:
+        exists_in_wd = os.path.exists(os.path.join(root, path))
+        f_st = self.FileStatus(
+            path, GL_STATUS_UNTRACKED, True, exists_in_wd, True, False)
+      else:
+        f_st = self.FileStatus(path, *self._st_map[git_st])
+      ret[path] = f_st, git_st, is_au
+    return ret
 
 
   # File related methods
 
   def track_file(self, path):
     """Start tracking changes to path."""
-    assert not os.path.isabs(path)
+    _raise_err(self.track_files([path]))
 
-    gl_st, git_st, is_au = self._status_file(path)
+  def track_files(self, paths):
+    """Start tracking changes to the given paths.
 
-    if gl_st.type == GL_STATUS_TRACKED:
-      raise ValueError('File {0} is already tracked'.format(path))
-    elif gl_st.type == GL_STATUS_IGNORED:
-      raise ValueError(
-          'File {0} is ignored. Edit the .gitignore file to stop ignoring '
-          'file {0}'.format(path))
-
-    # If we reached this point we know that the file to track is a untracked
-    # file. This means that in the Git world, the file could be either:
-    #   (i)  a new file for Git => add the file;
-    #   (ii) an assumed unchanged file => unmark it.
-    if git_st == pygit2.GIT_STATUS_WT_NEW:  # Case (i)
+    All paths are tracked in one index transaction.
+
+    Returns:
+      a list of (path, error) in the order of paths. error is None if the path
+      was tracked or the exception that explains why it couldn't be tracked
+      (KeyError if the path doesn't exist).
+    """
+    paths = _unique(paths)
+    sts = self._status_files(paths)
+
+    ret = []
+    to_add = []
+    to_unmark = []
+    for path in paths:
+      if path not in sts:
+        ret.append((path, KeyError(path)))
+        continue
+
+      gl_st, git_st, is_au = sts[path]
+      err = None
+      if gl_st.type == GL_STATUS_TRACKED:
+        err = ValueError('File {0} is already tracked'.format(path))
+      elif gl_st.type == GL_STATUS_IGNORED:
+        err = ValueError(
+            'File {0} is ignored. Edit the .gitignore file to stop ignoring '
+            'file {0}'.format(path))
+      # If we reached this point we know that the file to track is a untracked
+      # file. This means that in the Git world, the file could be either:
+      #   (i)  a new file for Git => add the file;
+      #   (ii) an assumed unchanged file => unmark it.
+      elif git_st == pygit2.GIT_STATUS_WT_NEW:  # Case (i)
+        to_add.append(path)
+      elif is_au:  # Case (ii)
+        to_unmark.append(path)
+      else:
+        err = GlError('File {0} in unkown status {1}'.format(path, git_st))
+      ret.append((path, err))
+
+    if to_add or to_unmark:
       with self._index as index:
-        index.add(path)
-    elif is_au:  # Case (ii)
-      git('update-index', '--no-assume-unchanged', path,
-          _cwd=self.gl_repo.root)
-    else:
-      raise GlError('File {0} in unkown status {1}'.format(path, git_st))
+        for path in to_add:
+          index.add(path)
+        for path in to_unmark:
+          _set_index_entry_flag(index, path, _IDXENTRY_VALID, False)
+    return ret
 
   def untrack_file(self, path):
     """Stop tracking changes to path."""
-    assert not os.path.isabs(path)
+    _raise_err(self.untrack_files([path]))
 
-    gl_st, git_st, is_au = self._status_file(path)
+  def untrack_files(self, paths):
+    """Stop tracking changes to the given paths.
 
-    if gl_st.type == GL_STATUS_UNTRACKED:
-      raise ValueError('File {0} is already untracked'.format(path))
-    elif gl_st.type == GL_STATUS_IGNORED:
-      raise ValueError(
-          'File {0} is ignored. Edit the .gitignore file to stop ignoring '
-          'file {0}'.format(path))
-    elif gl_st.in_conflict:
-      raise ValueError('File {0} has conflicts'.format(path))
-
-    # If we reached this point we know that the file to untrack is a tracked
-    # file. This means that in the Git world, the file could be either:
-    #   (i)  a new file for Git that is staged (the user executed `gl track` on
-    #        an uncomitted file) => reset changes;
-    #   (ii) the file is a previously committed file => mark it as assumed
-    #        unchanged.
-    if git_st == pygit2.GIT_STATUS_INDEX_NEW:  # Case (i)
+    All paths are untracked in one index transaction.
+
+    Returns:
+      a list of (path, error) in the order of paths. error is None if the path
+      was untracked or the exception that explains why it couldn't be
+      untracked (KeyError if the path doesn't exist).
+    """
+    paths = _unique(paths)
+    sts = self._status_files(paths)
+
+    ret = []
+    to_rm = []
+    to_mark = []
+    for path in paths:
+      if path not in sts:
+        ret.append((path, KeyError(path)))
+        continue
+
+      gl_st, git_st, is_au = sts[path]
+      err = None
+      if gl_st.type == GL_STATUS_UNTRACKED:
+        err = ValueError('File {0} is already untracked'.format(path))
+      elif gl_st.type == GL_STATUS_IGNORED:
+        err = ValueError(
+            'File {0} is ignored. Edit the .gitignore file to stop ignoring '
+            'file {0}'.format(path))
+      elif gl_st.in_conflict:
+        err = ValueError('File {0} has conflicts'.format(path))
+      # If we reached this point we know that the file to untrack is a tracked
+      # file. This means that in the Git world, the file could be either:
+      #   (i)  a new file for Git that is staged (the user executed `gl track`
+      #        on an uncomitted file) => reset changes;
+      #   (ii) the file is a previously committed file => mark it as assumed
+      #        unchanged.
+      elif git_st == pygit2.GIT_STATUS_INDEX_NEW:  # Case (i)
+        to_rm.append(path)
+      elif not is_au:  # Case (ii)
+        to_mark.append(path)
+      else:
+        err = GlError('File {0} in unkown status {1}'.format(path, git_st))
+      ret.append((path, err))
+
+    if to_rm or to_mark:
       with self._index as index:
-        index.remove(path)
-    elif not is_au:  # Case (ii)
-      git('update-index', '--assume-unchanged', path,
-          _cwd=self.gl_repo.root)
-    else:
-      raise GlError('File {0} in unkown status {1}'.format(path, git_st))
+        for path in to_rm:
+          index.remove(path)
+        for path in to_mark:
+          _set_index_entry_flag(index, path, _IDXENTRY_VALID, True)
+    return ret
 
   def resolve_file(self, path):
     """Mark the given path as resolved."""
-    assert not os.path.isabs(path)
+    _raise_err(self.resolve_files([path]))
 
-    gl_st, _, _ = self._status_file(path)
-    if not gl_st.in_conflict:
-      raise ValueError('File {0} has no conflicts'.format(path))
+  def resolve_files(self, paths):
+    """Mark the given paths as resolved.
 
-    with self._index as index:
-      index.add(path)
+    All paths are resolved in one index transaction.
+
+    Returns:
+      a list of (path, error) in the order of paths. error is None if the path
+      was resolved or the exception that explains why it couldn't be resolved
+      (KeyError if the path doesn't exist).
+    """
+    paths = _unique(paths)
+    sts = self._status_files(paths)
+
+    ret = []
+    to_add = []
+    for path in paths:
+      if path not in sts:
+        ret.append((path, KeyError(path)))
+      elif not sts[path][0].in_conflict:
+        ret.append(
+            (path, ValueError('File {0} has no conflicts'.format(path))))
+      else:
+        to_add.append(path)
+        ret.append((path, None))
+
+    if to_add:
+      with self._index as index:
+        for path in to_add:
+          index.add(path)
+    return ret
 
   def checkout_file(self, path, commit):
     """Checkouts the given path at the given commit."""
-    assert not os.path.isabs(path)
+    _raise_err(self.checkout_files([path], commit))
 
-    data = self.gl_repo.git_repo[commit.tree[path].id].data
-    with io.open(os.path.join(self.gl_repo.root, path), mode='wb') as dst:
-      dst.write(data)
+  def checkout_files(self, paths, commit):
+    """Checkouts the given paths at the given commit.
 
-    # So as to not get confused with the status of the file we also add it
-    with self._index as index:
-      index.add(path)
+    All paths are checked out in one index transaction.
 
-  def diff_file(self, path):
-    """Diff the working version of path with its committed version."""
-    assert not os.path.isabs(path)
+    Returns:
+      a list of (path, error) in the order of paths. error is None if the path
+      was checked out, KeyError if there's no such file at commit or
+      ValueError if the path is not in the sparse checkout.
+    """
+    paths = _unique(paths)
+    assert not any(os.path.isabs(path) for path in paths)
 
     git_repo = self.gl_repo.git_repo
-    try:
-      blob_at_head = git_repo[git_repo.head.peel().tree[path].id]
-    except KeyError:  # no blob at head
-      wt_blob = git_repo[git_repo.create_blob_fromworkdir(path)]
-      nil_blob = git_repo[git_repo.create_blob('')]
-      return nil_blob.diff(wt_blob, 0, path, path)
+    root = self.gl_repo.root
+    sparse = self.gl_repo.is_sparse()
+    if sparse:
+      sparse_dirs = self.gl_repo.sparse_dirs()
+      index = git_repo.index
+      index.read(False)
+    ret = []
+    done = []
+    for path in paths:
+      if sparse and (_index_entry_skipped(index, path) or (
+          sparse_dirs is not None and not _in_cone(path, sparse_dirs))):
+        ret.append((path, ValueError(
+            'File {0} is not in the sparse checkout, do gl sparse add {1} to '
+            'check it out'.format(path, path.rpartition('/')[0]))))
+        continue
+      try:
+        data = git_repo[commit.tree[path].id].data
+      except KeyError:
+        ret.append((path, KeyError(path)))
+        continue
+      with io.open(os.path.join(root, path), mode='wb') as dst:
+        dst.write(data)
+      done.append(path)
+      ret.append((path, None))
 
-    try:
-      wt_blob = git_repo[git_repo.create_blob_fromworkdir(path)]
-    except KeyError:  # no blob at wd (the file was deleted)
-      nil_blob = git_repo[git_repo.create_blob('')]
-      return blob_at_head.diff(nil_blob, 0, path, path)
+    # So as to not get confused with the status of the files we also add them
+    if done:
+      with self._index as index:
+        for path in done:
+          index.add(path)
+    return ret
 
-    return blob_at_head.diff(wt_blob, 0, path, path)
+  def diff_file(self, path, full=False):
+    """Diff the working version of path with its committed version.
+
+    The working version is diffed straight from memory, nothing is written to
+    the object database. If the file is over the diff limits a DiffSummary is
+    returned instead of the patch, unless full is True (see diff_files).
+    """
+    unused_path, patch = next(self.diff_files([path], full=full))
+    if not patch:
+      raise KeyError('No file {0} at head or in the working tree'.format(path))
+    return patch
+
+  def diff_files(self, paths=None, full=False, include=None, exclude=None):
+    """Diff the working version of the given paths with their committed version.
+
+    All patches come from one diff of the head tree with the working directory
+    (through the index) limited to the paths, so the cost is that of the paths
+    given (not of the whole repo), and they are computed as the generator is
+    consumed, so they can be output as they come. If paths is None, the
+    tracked files with changes are diffed (but those in exclude), plus the
+    files in include, all in the same diff.
+
+    Files that are too big to be worth diffing (see _DiffLimits) are not
+    diffed, a DiffSummary with their sizes and lines is returned instead of
+    their patch. If full is True all files are diffed.
+
+    Returns:
+      a generator of (path, patch) sorted by path (the order of libgit2's
+      diffs). patch is None if there's no file path at head or in the working
+      tree.
+    """
+    git_repo = self.gl_repo.git_repo
+    head_tree = git_repo.head.peel().tree
+    limits = None if full else _DiffLimits(git_repo.config)
+    index = git_repo.index
+    index.read(False)
+    given = _unique(paths if paths is not None else include or [])
+    assert not any(os.path.isabs(path) for path in given)
+    summaries = {}
+
+    def over_limits(path):
+      if path not in summaries:
+        wt_size = _wt_size(git_repo, path)
+        wt_version = None
+        if wt_size is not None:
+          wt_version = (wt_size, lambda: _wt_chunks(git_repo, path))
+        summaries[path] = limits.summary(
+            path, _blob_version(_tree_blob(git_repo, head_tree, path)),
+            wt_version)
+      return summaries[path] is not None
+
+    skip = self._diff_skip(index, exclude, over_limits if limits else None)
+    diff = _wt_diff(git_repo, index, paths, include, skip)
+    # The paths that get an entry even if they are not in the diff (the ones
+    # given with no changes and those over the limits)
+    key = _diff_sort_key(git_repo)
+    pending = sorted(
+        set(given).union(path for path, s in summaries.items() if s), key=key)
+    i = 0
+    done = set()
+    for patch in diff if diff is not None else []:
+      path = patch.delta.new_file.path
+      while i < len(pending) and key(pending[i]) < key(path):
+        if pending[i] not in done:
+          yield pending[i], self._no_delta_patch(
+              head_tree, pending[i], summaries)
+        i += 1
+      done.add(path)
+      yield path, patch
+    for path in pending[i:]:
+      if path not in done:
+        yield path, self._no_delta_patch(head_tree, path, summaries)
+
+  def _diff_skip(self, index, exclude, over_limits):
+    """Return the function to skip paths from the diff (see _wt_diff)."""
+    exclude = frozenset(exclude or [])
+    sparse = self.gl_repo.is_sparse()
+    if not exclude and not sparse and not over_limits:
+      return None
+
+    def skip(path):
+      # The files not checked out of a sparse repo are not deleted
+      return (
+          path in exclude or
+          (sparse and _index_entry_skipped(index, path)) or
+          (over_limits and over_limits(path)))
+    return skip
+
+  def _no_delta_patch(self, head_tree, path, summaries):
+    """Return the patch of path, which is not in the diff of diff_files."""
+    summary = summaries.get(path)
+    if summary:
+      return summary
+    git_repo = self.gl_repo.git_repo
+    blob_at_head = _tree_blob(git_repo, head_tree, path)
+    wt_contents = _wt_contents(git_repo, path)
+    if blob_at_head is None and wt_contents is None:
+      return None
+    if blob_at_head is None:
+      # An ignored file, libgit2 doesn't diff their contents
+      return _empty_blob(git_repo).diff_to_buffer(wt_contents, 0, path, path)
+    # No changes, the patch has no hunks
+    return blob_at_head.diff(blob_at_head, 0, path, path)
+
+  def diff_stats(self, paths=None, include=None, exclude=None):
+    """Return the line stats of the diff of the given paths with head.
+
+    This is much cheaper than diff_files for big diffs: the lines are counted
+    by libgit2 as it diffs each file and the totals are accumulated in the
+    same pass, no hunks or lines are built. paths, include and exclude are
+    like in diff_files.
+
+    Returns:
+      a pygit2's DiffStats with the totals (see diff_stats_files for the stats
+      of each file). None if there's nothing to diff.
+    """
+    git_repo = self.gl_repo.git_repo
+    index = git_repo.index
+    index.read(False)
+    diff = _wt_diff(
+        git_repo, index, paths, include, self._diff_skip(index, exclude, None))
+    return diff.stats if diff is not None else None
 
 
   # Merge related methods
@@ -1068,7 +1905,7 @@ class Branch(object):
       raise GlError('No fuse in progress, nothing to abort')
     git_repo = self.gl_repo.git_repo
     git_repo.set_head(git_repo.lookup_reference('GL_FUSE_ORIG_HEAD').target)
-    git_repo.reset(git_repo.head.peel().hex, pygit2.GIT_RESET_HARD)
+    self.gl_repo._reset_hard(git_repo.head.peel().hex)
 
     self._state_cleanup()
     restore_fn = op_cb.restore_ok if op_cb else None
@@ -1239,6 +2076,139 @@ class Tag(object):
     return self.tag_name
 
 
+class FileStatusList(object):
+  """A compact list of file statuses (see Branch.FileStatus).
+
+  Big trees can have hundreds of thousands of untracked files (think build
+  outputs), and a FileStatus tuple (plus its path) per file adds up. Here the
+  paths are split into a dir and a name, both kept in tables in which each
+  distinct string is only stored once, and the rest of the status of each file
+  is packed into one byte. The FileStatus tuples are built as needed when the
+  list is iterated or indexed.
+  """
+
+  # Bits of the packed status, the lowest two are the type
+  _TYPE_MASK = 0x3
+  _EXISTS_AT_HEAD = 0x4
+  _EXISTS_IN_WD = 0x8
+  _MODIFIED = 0x10
+  _IN_CONFLICT = 0x20
+
+  def __init__(self, statuses=()):
+    self._dirs = []  # the dir with id i is self._dirs[i]
+    self._dir_ids = {}
+    self._names = {}  # to reuse the string of names we already have
+    self._fp_dirs = array.array(str('I'))
+    self._fp_names = []
+    self._sts = array.array(str('B'))
+    for f_st in statuses:
+      self.append(*f_st)
+
+  def append(
+      self, fp, type, exists_at_head, exists_in_wd, modified, in_conflict):
+    d, _, name = fp.rpartition('/')
+    dir_id = self._dir_ids.get(d)
+    if dir_id is None:
+      dir_id = self._dir_ids[d] = len(self._dirs)
+      self._dirs.append(d)
+    self._fp_dirs.append(dir_id)
+    self._fp_names.append(self._names.setdefault(name, name))
+    self._sts.append(
+        type | (exists_at_head and self._EXISTS_AT_HEAD) |
+        (exists_in_wd and self._EXISTS_IN_WD) |
+        (modified and self._MODIFIED) | (in_conflict and self._IN_CONFLICT))
+
+  def sort(self):
+    """Sorts the list by path."""
+    order = sorted(range(len(self)), key=self._fp)
+    self._fp_dirs = array.array(str('I'), [self._fp_dirs[i] for i in order])
+    self._fp_names = [self._fp_names[i] for i in order]
+    self._sts = array.array(str('B'), [self._sts[i] for i in order])
+
+  def __len__(self):
+    return len(self._sts)
+
+  def __getitem__(self, i):
+    st = self._sts[i]
+    return Branch.FileStatus(
+        self._fp(i), st & self._TYPE_MASK, bool(st & self._EXISTS_AT_HEAD),
+        bool(st & self._EXISTS_IN_WD), bool(st & self._MODIFIED),
+        bool(st & self._IN_CONFLICT))
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def _fp(self, i):
+    d = self._dirs[self._fp_dirs[i]]
+    return d + '/' + self._fp_names[i] if d else self._fp_names[i]
+
+
+class StatusTimings(object):
+  """Where the time computing a status went (see Branch.status).
+
+  Attributes:
+    phases: an ordered dict of phase -> secs spent in it (the time of a phase
+      doesn't include that of the phases that ran inside of it). The phases
+      are 'preload' (see _preload_index), 'cache' (loading, checking and
+      saving the status cache), 'index' (diffing HEAD against the index),
+      'working directory' (diffing the index against the working directory,
+      which includes stat'ing and re-hashing tracked files and walking the
+      working directory for untracked ones), 'tracked files' and 'untracked
+      files' (the same diff split in two, when the status cache is used),
+      'git status' (the whole status computed by libgit2, when the status
+      cache is not used) and 'assumed unchanged' (reading the assumed
+      unchanged files off the index).
+    index_entries: the number of entries in the index.
+    workers: the number of threads used to preload the index.
+    refreshed: the number of index entries refreshed by the preload.
+    cache: how the status cache was used: None if it wasn't, 'rebuilt' if it
+      had to be computed from scratch, 'watcher' if the watcher told us what
+      changed and 'stat' if the dirs of the working directory were stat'ed.
+    dirs_rescanned: the number of dirs rescanned for untracked files (if the
+      cache was used).
+  """
+
+  def __init__(self):
+    self.phases = collections.OrderedDict()
+    self.index_entries = 0
+    self.workers = 1
+    self.refreshed = 0
+    self.cache = None
+    self.dirs_rescanned = 0
+    self._running = []  # [start, secs in inner phases] of running phases
+
+  @property
+  def total(self):
+    return sum(self.phases.values())
+
+  def start(self, phase):
+    self._running.append([time.time(), 0])
+
+  def stop(self, phase):
+    start, inner = self._running.pop()
+    secs = time.time() - start
+    self.phases[phase] = self.phases.get(phase, 0) + secs - inner
+    if self._running:
+      self._running[-1][1] += secs
+
+
+class _Phase(object):
+  """Context manager that times a phase in timings (if it's not None)."""
+
+  def __init__(self, timings, phase):
+    self.timings = timings
+    self.phase = phase
+
+  def __enter__(self):
+    if self.timings:
+      self.timings.start(self.phase)
+
+  def __exit__(self, type, value, traceback):
+    if self.timings:
+      self.timings.stop(self.phase)
+
+
 # Helpers for stashing
 
 def _stash(pattern):
@@ -1264,11 +2234,1323 @@ def _stash_msg_merge(name):
   return _stash_msg('merge-{0}'.format(name))
 
 
+# Index entries
+
+# Flag of index entries that is set by `git update-index --assume-unchanged`
+# (GIT_IDXENTRY_VALID in libgit2). pygit2's IndexEntry doesn't expose the entry
+# flags so we read them from the underlying libgit2 entries.
+_IDXENTRY_VALID = 0x8000
+
+# Extended flag of index entries that is set for the files left out of a
+# sparse checkout (GIT_IDXENTRY_SKIP_WORKTREE in libgit2)
+_IDXENTRY_SKIP_WORKTREE = 1 << 14
+
+# The stage of an entry (1 to 3 for conflicts) is in these bits of its flags
+_IDXENTRY_STAGESHIFT = 12
+
+
+def _index_entries(index, pathspec=None):
+  """Generator of (path, flags) for each entry in the given pygit2's index.
+
+  If pathspec is given, only the entries at or under those paths are
+  generated.
+  """
+  for path, c_entry in _c_index_entries(index, pathspec=pathspec):
+    yield path.decode('utf-8'), c_entry.flags
+
+
+def _c_index_entries(index, pathspec=None):
+  """Generator of (path as bytes, libgit2's entry) for the entries of index.
+
+  If pathspec is given, only the entries at or under those paths are
+  generated. The entries are sorted by path, so the ones under a dir are
+  found with a binary search instead of by looking at all of them.
+  """
+  c_index = index._index
+  n = C.git_index_entrycount(c_index)
+  if not pathspec or '' in pathspec:
+    ranges = [(b'', 0)]
+  else:
+    ranges = []
+    for path in _top_dirs(pathspec):
+      path = path.encode('utf-8')
+      c_entry = C.git_index_get_bypath(c_index, path, 0)
+      if c_entry != ffi.NULL:
+        yield path, c_entry
+      ranges.append((path + b'/', _index_lower_bound(c_index, n, path + b'/')))
+
+  for prefix, i in ranges:
+    while i < n:
+      c_entry = C.git_index_get_byindex(c_index, i)
+      path = ffi.string(c_entry.path)
+      if not path.startswith(prefix):
+        break
+      yield path, c_entry
+      i += 1
+
+
+def _index_entry_skipped(index, path):
+  """True if the index entry of path has the skip-worktree bit set.
+
+  Those are the files left out of a sparse checkout.
+  """
+  c_entry = C.git_index_get_bypath(index._index, path.encode('utf-8'), 0)
+  return c_entry != ffi.NULL and bool(
+      c_entry.flags_extended & _IDXENTRY_SKIP_WORKTREE)
+
+
+def _collapse_untracked(sts, index):
+  """Return the status sts with untracked dirs collapsed.
+
+  sts is a status with all untracked files in it (like git_repo.status()).
+  As with _git_status with recurse_untracked=False, the files in dirs with no
+  tracked files in them are reported as one 'dir/' entry for the outermost
+  such dir: untracked if there's some untracked file in it, ignored if all
+  of them are ignored.
+  """
+  tracked_dirs = set([''])
+  for path, _ in _index_entries(index):
+    d = path.rpartition('/')[0]
+    while d not in tracked_dirs:
+      tracked_dirs.add(d)
+      d = d.rpartition('/')[0]
+
+  ret = {}
+  for path, st in sts.items():
+    top = None
+    if st in _UNTRACKED_ST:
+      parts = path.rstrip('/').split('/')
+      if not path.endswith('/'):
+        parts.pop()  # only the dirs the file is in
+      for i in range(1, len(parts) + 1):
+        d = '/'.join(parts[:i])
+        if d not in tracked_dirs:
+          top = d + '/'
+          break
+    if not top:
+      ret[path] = st
+    elif ret.get(top) != pygit2.GIT_STATUS_WT_NEW:
+      ret[top] = st
+  return ret
+
+
+def _drop_not_checked_out(sts, index):
+  """Drops the files left out of a sparse checkout from the status sts.
+
+  libgit2 doesn't know about the skip-worktree bit, so it reports them as
+  deleted.
+  """
+  for path, st in list(sts.items()):
+    if st & pygit2.GIT_STATUS_WT_DELETED and _index_entry_skipped(index, path):
+      st &= ~pygit2.GIT_STATUS_WT_DELETED
+      if st:
+        sts[path] = st
+      else:
+        del sts[path]
+
+
+def _sparse_pathspec(gl_repo, index):
+  """Return the top-level paths to look at for the status of a sparse repo.
+
+  These are the paths at the root of the working directory, the top-level
+  dirs of the checked out files (that might have been removed from the
+  working directory), the files at the root of HEAD (that might have been
+  removed from the index too) and the top-level dirs of the sparse checkout.
+  """
+  ret = set(p for p in os.listdir(gl_repo.root) if p != '.git')
+  for path, c_entry in _c_index_entries(index):
+    if not c_entry.flags_extended & _IDXENTRY_SKIP_WORKTREE:
+      ret.add(path.decode('utf-8').partition('/')[0])
+  git_repo = gl_repo.git_repo
+  if not git_repo.head_is_unborn:
+    for entry in git_repo.head.peel().tree:
+      if entry.filemode != pygit2.GIT_FILEMODE_TREE:
+        ret.add(entry.name)
+  ret.update(d.partition('/')[0] for d in gl_repo.sparse_dirs() or [])
+  return sorted(ret)
+
+
+def _in_cone(path, dirs):
+  """True if path is checked out in a cone mode sparse checkout of dirs."""
+  parent = path.rpartition('/')[0]
+  if not parent or _under_any(path, frozenset(dirs)):
+    return True
+  return any(d.startswith(parent + '/') for d in dirs)
+
+
+def _index_lower_bound(c_index, n, path):
+  """Return the position of the first entry with a path >= path."""
+  lo, hi = 0, n
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if ffi.string(C.git_index_get_byindex(c_index, mid).path) < path:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+
+def _index_entry_flags(index, path):
+  """Return the flags of the index entry for path (0 if there's no entry)."""
+  c_entry = C.git_index_get_bypath(index._index, path.encode('utf-8'), 0)
+  return c_entry.flags if c_entry != ffi.NULL else 0
+
+
+def _set_index_entry_flag(index, path, flag, value):
+  """Sets (or clears if value is False) flag in the index entry for path.
+
+  The change is only made to the in-memory index, it's up to the caller to
+  write the index.
+  """
+  c_entry = C.git_index_get_bypath(index._index, path.encode('utf-8'), 0)
+  if c_entry == ffi.NULL:
+    raise KeyError(path)
+  if value:
+    c_entry.flags |= flag
+  else:
+    c_entry.flags &= ~flag & 0xFFFF
+
+
+def _add_conflict(index, path, ancestor, ours, theirs):
+  """Puts back in index the conflict of path (as saved by a branch switch).
+
+  ancestor, ours and theirs are dicts with the mode, id and path of the entry
+  of each stage (None if there's no entry for that stage). The entry of the
+  resolved file is removed, like `git update-index --unresolve` does. The
+  change is only made to the in-memory index.
+  """
+  try:
+    index.remove(path)
+  except KeyError:  # no resolved entry
+    pass
+  for stage, e in enumerate([ancestor, ours, theirs], 1):
+    if not e:
+      continue
+    # c_path has to be kept alive until the entry is added (which copies it)
+    c_entry, c_path = pygit2.IndexEntry(
+        e['path'], pygit2.Oid(hex=e['id']), e['mode'])._to_c()
+    c_entry.flags = stage << _IDXENTRY_STAGESHIFT
+    check_error(C.git_index_add(index._index, c_entry))
+
+
+# Status engine
+
+# Status flags of the file in the index with respect to HEAD and of the file in
+# the working directory with respect to the index for each of the deltas of
+# libgit2's diffs (this is how libgit2 computes the status). Type changes are
+# reported as modifications.
+_HEAD_TO_INDEX_ST = {
+    pygit2.GIT_DELTA_ADDED: pygit2.GIT_STATUS_INDEX_NEW,
+    pygit2.GIT_DELTA_DELETED: pygit2.GIT_STATUS_INDEX_DELETED,
+    pygit2.GIT_DELTA_MODIFIED: pygit2.GIT_STATUS_INDEX_MODIFIED,
+    pygit2.GIT_DELTA_TYPECHANGE: pygit2.GIT_STATUS_INDEX_MODIFIED,
+    }
+_INDEX_TO_WD_ST = {
+    pygit2.GIT_DELTA_UNTRACKED: pygit2.GIT_STATUS_WT_NEW,
+    pygit2.GIT_DELTA_IGNORED: pygit2.GIT_STATUS_IGNORED,
+    pygit2.GIT_DELTA_DELETED: pygit2.GIT_STATUS_WT_DELETED,
+    pygit2.GIT_DELTA_MODIFIED: pygit2.GIT_STATUS_WT_MODIFIED,
+    pygit2.GIT_DELTA_TYPECHANGE: pygit2.GIT_STATUS_WT_MODIFIED,
+    }
+_UNTRACKED_ST = frozenset([pygit2.GIT_STATUS_WT_NEW, pygit2.GIT_STATUS_IGNORED])
+
+# Stage bits of index entries, entries with a stage other than 0 are conflicts
+_IDXENTRY_STAGEMASK = 0x3000
+
+
+def _git_status(
+    git_repo, index, pathspec=None, tracked=True, untracked=True,
+    recurse_untracked=True, limit=None, timings=None):
+  """Return a dict of path -> git status of the files in the working directory.
+
+  The result is the same as the one of git_repo.status(), but we do the diffs
+  ourselves so that the work can be limited to some paths and to the tracked
+  or untracked part of the status.
+
+  Args:
+    git_repo: the pygit2's repository.
+    index: the pygit2's index of git_repo.
+    pathspec: if given, only the files at or under these paths (relative to
+      the root of the repo) are looked at.
+    tracked: whether to include the status of the files in the index.
+    untracked: whether to include untracked and ignored files.
+    recurse_untracked: if False, dirs with only untracked files in them are
+      reported as one 'dir/' entry instead of looking at what's in them.
+    limit: if given, we stop as soon as this many files that are not ignored
+      are found (and only those are in the result).
+    timings: if given, a StatusTimings object where to record the time spent
+      in each diff.
+  """
+  if pathspec is not None and '' in pathspec:
+    pathspec = None
+  # libgit2 only limits the walk to the common prefix of the paths, so we do
+  # one diff per path
+  specs = [[path] for path in pathspec] if pathspec else [None]
+
+  sts = {}
+  found = set()  # the files found that are not ignored (if there's a limit)
+  if tracked and index.conflicts:
+    dirs = frozenset(pathspec) if pathspec else None
+    for entries in index.conflicts:
+      path = next(e.path for e in entries if e)
+      if not dirs or _under_any(path, dirs):
+        sts[path] = pygit2.GIT_STATUS_CONFLICTED
+        found.add(path)
+        if limit and len(found) >= limit:
+          return sts
+  conflicts = dict(sts)
+
+  def diff_status(diff_fn, flags, spec, st_map):
+    if limit and len(found) >= limit:
+      return
+    _diff_status(git_repo, diff_fn, flags, spec, st_map, sts, found, limit)
+
+  if not untracked:
+    wd_phase = 'tracked files'
+  elif not tracked:
+    wd_phase = 'untracked files'
+  else:
+    wd_phase = 'working directory'
+
+  if tracked:
+    c_tree = _c_head_tree(git_repo)
+    with _Phase(timings, 'index'):
+      for spec in specs:
+        diff_status(
+            lambda c_diff, c_opts: C.git_diff_tree_to_index(
+                c_diff, git_repo._repo, c_tree, index._index, c_opts),
+            0, spec, _HEAD_TO_INDEX_ST)
+
+  wd_flags = pygit2.GIT_DIFF_INCLUDE_TYPECHANGE
+  if untracked:
+    wd_flags |= (
+        pygit2.GIT_DIFF_INCLUDE_UNTRACKED | pygit2.GIT_DIFF_INCLUDE_IGNORED)
+    if recurse_untracked:
+      wd_flags |= pygit2.GIT_DIFF_RECURSE_UNTRACKED_DIRS
+  wd_st = _INDEX_TO_WD_ST
+  if not tracked:
+    wd_st = dict((d, st) for d, st in wd_st.items() if st in _UNTRACKED_ST)
+  with _Phase(timings, wd_phase):
+    for spec in specs:
+      diff_status(
+          lambda c_diff, c_opts: C.git_diff_index_to_workdir(
+              c_diff, git_repo._repo, index._index, c_opts),
+          wd_flags, spec, wd_st)
+
+  sts.update(conflicts)  # conflicts override what the diffs found
+  return sts
+
+
+def _status_counts(git_repo, index):
+  """Return the (tracked modified, untracked, conflicts) counts of the status.
+
+  The counts are those of _git_status with recurse_untracked=False (ignored
+  files are not counted), but the files are counted as libgit2 finds them:
+  the only paths kept are those of the files in conflict and of the files
+  changed in the index, which are usually few.
+  """
+  conflicts = set()
+  if index.conflicts:
+    for entries in index.conflicts:
+      conflicts.add(next(e.path for e in entries if e))
+
+  staged = {}
+  c_tree = _c_head_tree(git_repo)
+
+  def on_staged(path, st):
+    if path not in conflicts:
+      staged[path] = st
+    return False
+
+  _walk_diff(
+      git_repo,
+      lambda c_diff, c_opts: C.git_diff_tree_to_index(
+          c_diff, git_repo._repo, c_tree, index._index, c_opts),
+      0, None, _HEAD_TO_INDEX_ST, on_staged)
+
+  counts = [0, 0]  # tracked modified, untracked
+
+  def on_wd(path, st):
+    if path in conflicts or st == pygit2.GIT_STATUS_IGNORED:
+      return False
+    if (st == pygit2.GIT_STATUS_WT_DELETED and
+        _index_entry_skipped(index, path)):
+      return False  # not checked out (see _drop_not_checked_out)
+    st |= staged.pop(path, 0)
+    counts[st == pygit2.GIT_STATUS_WT_NEW] += 1
+    return False
+
+  _walk_diff(
+      git_repo,
+      lambda c_diff, c_opts: C.git_diff_index_to_workdir(
+          c_diff, git_repo._repo, index._index, c_opts),
+      pygit2.GIT_DIFF_INCLUDE_TYPECHANGE | pygit2.GIT_DIFF_INCLUDE_UNTRACKED |
+      pygit2.GIT_DIFF_INCLUDE_IGNORED,
+      None, _INDEX_TO_WD_ST, on_wd)
+  return counts[0] + len(staged), counts[1], len(conflicts)
+
+
+def _diff_status(
+    git_repo, diff_fn, flags, pathspec, st_map, sts, found=None, limit=None):
+  """Runs the libgit2 diff diff_fn and adds the status of each delta to sts.
+
+  The deltas are collected as libgit2 finds them (and then dropped from the
+  diff), this way we don't pay for the patches pygit2 builds when iterating
+  over a diff. If limit is given, the paths that are not ignored are added to
+  the set found and the diff is cancelled once it has limit paths.
+  """
+  def on_delta(path, st):
+    sts[path] = sts.get(path, 0) | st
+    if limit and st != pygit2.GIT_STATUS_IGNORED:
+      found.add(path)
+      return len(found) >= limit
+    return False
+
+  _walk_diff(git_repo, diff_fn, flags, pathspec, st_map, on_delta)
+
+
+def _walk_diff(git_repo, diff_fn, flags, pathspec, st_map, on_delta):
+  """Runs the libgit2 diff diff_fn and calls on_delta(path, st) for each delta.
+
+  st is the status of the delta given by st_map (the deltas not in st_map are
+  skipped). If on_delta returns True the diff is cancelled.
+  """
+  cancelled = []
+
+  def notify(c_diff, c_delta, c_matched_pathspec, c_payload):
+    st = st_map.get(c_delta.status)
+    if st:
+      path = ffi.string(c_delta.new_file.path).decode('utf-8')
+      if on_delta(path, st):
+        cancelled.append(True)
+        return C.GIT_EUSER  # cancel the diff
+    return 1  # skip the delta
+
+  c_opts = ffi.new('git_diff_options *')
+  check_error(C.git_diff_init_options(c_opts, 1))
+  c_opts.flags = flags | pygit2.GIT_DIFF_DISABLE_PATHSPEC_MATCH
+  c_notify = ffi.callback('git_diff_notify_cb', notify, -1)
+  c_opts.notify_cb = c_notify
+  paths = StrArray(pathspec)
+  if pathspec:
+    c_opts.pathspec = paths.array[0]
+  c_diff = ffi.new('git_diff **')
+  err = diff_fn(c_diff, c_opts)
+  if err == C.GIT_EUSER and cancelled:
+    return  # we cancelled it (and libgit2 freed the diff)
+  check_error(err)
+  # We wrap the (empty) diff so that pygit2 frees it
+  pygit2.Diff.from_c(bytes(ffi.buffer(c_diff)[:]), git_repo)
+
+
+def diff_stats_files(stats):
+  """Return a generator of (path, insertions, deletions) with the stats of
+  each file in stats (a pygit2's DiffStats, see Branch.diff_stats).
+
+  insertions and deletions are None for binary files.
+
+  Raises:
+    GlError if some file has 10M+ lines added or removed (the counts can't be
+    told apart then).
+  """
+  width = _DIFF_STATS_NUMBER_WIDTH
+  for line in stats.format(pygit2.GIT_DIFF_STATS_NUMBER, 1).splitlines():
+    cols = [line[:width], line[width:2 * width]]
+    if not all(_DIFF_STATS_NUMBER.match(col) for col in cols):
+      raise GlError(
+          'Can\'t tell the lines added and removed apart in "{0}" (10M+ lines '
+          'changed in a file?)'.format(line))
+    counts = [None if col.strip() == '-' else int(col) for col in cols]
+    yield line[2 * width:], counts[0], counts[1]
+
+
+def _c_head_tree(git_repo):
+  """Return the libgit2 pointer to the head tree (NULL if head is unborn)."""
+  if git_repo.head_is_unborn:
+    return ffi.NULL
+  tree_ptr = ffi.new('git_tree **')
+  ffi.buffer(tree_ptr)[:] = git_repo.head.peel().tree._pointer[:]
+  return tree_ptr[0]
+
+
+def _head_to_workdir_diff(git_repo, index, pathspec, untracked=True, skip=None):
+  """Return the pygit2's diff of the working version of pathspec with head.
+
+  Like git_diff_tree_to_workdir_with_index (which pygit2 doesn't expose), the
+  diff is that of the head tree with the index merged with that of the index
+  with the working directory. If pathspec is None the diff is that of the
+  whole repo. If untracked is True, untracked files are diffed as new files.
+  If skip is given, the paths for which skip(path) is True are left out of
+  the diff before libgit2 loads their contents.
+  """
+  c_opts = ffi.new('git_diff_options *')
+  check_error(C.git_diff_init_options(c_opts, 1))
+  c_opts.flags = (
+      pygit2.GIT_DIFF_INCLUDE_TYPECHANGE |
+      pygit2.GIT_DIFF_DISABLE_PATHSPEC_MATCH)
+  if untracked:
+    c_opts.flags |= (
+        pygit2.GIT_DIFF_INCLUDE_UNTRACKED |
+        pygit2.GIT_DIFF_RECURSE_UNTRACKED_DIRS |
+        pygit2.GIT_DIFF_SHOW_UNTRACKED_CONTENT)
+  paths = StrArray(pathspec)
+  if pathspec:
+    c_opts.pathspec = paths.array[0]
+  errors = []
+  if skip:
+    def notify(c_diff, c_delta, c_matched_pathspec, c_payload):
+      path = ffi.string(c_delta.new_file.path).decode('utf-8')
+      try:
+        return 1 if skip(path) else 0
+      except Exception as e:  # raised once libgit2 is done (see below)
+        errors.append(e)
+        return C.GIT_EUSER
+    c_notify = ffi.callback('git_diff_notify_cb', notify, -1)
+    c_opts.notify_cb = c_notify
+
+  def diff(diff_fn, *args):
+    c_diff = ffi.new('git_diff **')
+    err = diff_fn(c_diff, git_repo._repo, *(args + (c_opts,)))
+    if errors:
+      raise errors[0]
+    check_error(err)
+    return pygit2.Diff.from_c(bytes(ffi.buffer(c_diff)[:]), git_repo)
+
+  ret = diff(C.git_diff_tree_to_index, _c_head_tree(git_repo), index._index)
+  ret.merge(diff(C.git_diff_index_to_workdir, index._index))
+  return ret
+
+
+def _wt_diff(git_repo, index, paths, include, skip):
+  """Return the diff of Branch.diff_files (None if there's nothing to diff).
+
+  If paths is None, the diff is that of the tracked files with changes merged
+  with that of the files in include.
+  """
+  if paths is not None:
+    paths = _unique(paths)
+    if not paths:
+      return None
+    return _head_to_workdir_diff(git_repo, index, paths, skip=skip)
+  ret = _head_to_workdir_diff(git_repo, index, None, untracked=False, skip=skip)
+  include = _unique(include or [])
+  if include:
+    ret.merge(_head_to_workdir_diff(git_repo, index, include, skip=skip))
+  return ret
+
+
+def _diff_sort_key(git_repo):
+  """Return the key to sort paths in the order of libgit2's diffs."""
+  try:
+    ignorecase = git_repo.config.get_bool('core.ignorecase')
+  except KeyError:
+    ignorecase = False
+  if ignorecase:
+    return lambda path: path.lower().encode('utf-8')
+  return lambda path: path.encode('utf-8')
+
+
+def _under_any(path, dirs):
+  """True if path is one of the given dirs or it is inside of one of them.
+
+  dirs is a set of paths relative to the root ('' is the root).
+  """
+  if '' in dirs or path in dirs:
+    return True
+  i = path.find('/')
+  while i != -1:
+    if path[:i] in dirs:
+      return True
+    i = path.find('/', i + 1)
+  return False
+
+
+def _top_dirs(dirs):
+  """Return the dirs in the given list that are not inside another one."""
+  ret = set()
+  for d in sorted(dirs):
+    if not _under_any(d, ret):
+      ret.add(d)
+  return sorted(ret)
+
+
+def _drop_under(d, dirs):
+  """Removes the keys of dict d that are at or under any of the given dirs."""
+  dirs = frozenset(dirs)
+  for path in [path for path in d if _under_any(path, dirs)]:
+    del d[path]
+
+
+# Diffing working files (see Branch.diff_files)
+
+_EMPTY_BLOB_ID = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+
+
+def _empty_blob(git_repo):
+  """Return the empty blob, the old side of the diff of a new file.
+
+  Git considers the empty blob to always exist, libgit2 doesn't, so it's
+  written the first time it's needed (and never again).
+  """
+  try:
+    return git_repo[_EMPTY_BLOB_ID]
+  except KeyError:
+    return git_repo[git_repo.create_blob(b'')]
+
+
+def _tree_blob(git_repo, tree, path):
+  """Return the blob of path in tree, None if there's no such blob."""
+  try:
+    return git_repo[tree[path].id]
+  except KeyError:
+    return None
+
+
+def _tree_changes(git_repo, tree1, tree2, prefix=''):
+  """Generator of (path, old blob, new blob) for each file changed in the trees.
+
+  The blobs are those of path in tree1 and tree2 (None if there's no such
+  file). Either tree can be None (no tree). The subtrees with the same id in
+  both trees are skipped, so the cost is that of the changes, and the files
+  come in the order of libgit2's diffs. Submodules are left out.
+  """
+  entries1 = dict((e.name, e) for e in tree1) if tree1 is not None else {}
+  entries2 = dict((e.name, e) for e in tree2) if tree2 is not None else {}
+  is_tree = lambda e: e is not None and e.filemode == pygit2.GIT_FILEMODE_TREE
+  is_blob = lambda e: e is not None and e.filemode not in (
+      pygit2.GIT_FILEMODE_TREE, pygit2.GIT_FILEMODE_COMMIT)
+
+  def key(name):  # git sorts the trees as if they had a trailing /
+    e = entries2.get(name) or entries1.get(name)
+    return name + '/' if is_tree(e) else name
+
+  for name in sorted(set(entries1) | set(entries2), key=key):
+    e1, e2 = entries1.get(name), entries2.get(name)
+    if (e1 is not None and e2 is not None and e1.id == e2.id and
+        e1.filemode == e2.filemode):
+      continue
+    path = prefix + name
+    old = git_repo[e1.id] if is_blob(e1) else None
+    new = git_repo[e2.id] if is_blob(e2) else None
+    if old is not None or new is not None:
+      yield path, old, new
+    if is_tree(e1) or is_tree(e2):
+      for change in _tree_changes(
+          git_repo, git_repo[e1.id] if is_tree(e1) else None,
+          git_repo[e2.id] if is_tree(e2) else None, prefix=path + '/'):
+        yield change
+
+
+def _wt_size(git_repo, path):
+  """Return the size of path in the working tree, None if there's no file.
+
+  Like in _wt_contents, the size of a symlink is that of its target.
+  """
+  try:
+    st = os.lstat(os.path.join(git_repo.workdir, path))
+  except OSError:
+    return None
+  if not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+    return None
+  return st.st_size
+
+
+def _wt_contents(git_repo, path):
+  """Return the contents of path in the working tree, None if there's no file.
+
+  The contents are read as is, with no filters applied (like in
+  _preload_index), the files libgit2 diffs get them (see Branch.diff_files).
+  For symlinks, the contents are the target of the link.
+  """
+  fp = os.path.join(git_repo.workdir, path)
+  if os.path.islink(fp):
+    target = os.readlink(fp)
+    return target if isinstance(target, bytes) else target.encode('utf-8')
+  if not os.path.isfile(fp):
+    return None
+  with io.open(fp, mode='rb') as f:
+    return f.read()
+
+
+def _wt_chunks(git_repo, path):
+  """Return a generator of the contents of path in the working tree in chunks.
+
+  The contents are the same as those of _wt_contents, but the file is read as
+  the generator is consumed, so it is never in memory all at once.
+  """
+  fp = os.path.join(git_repo.workdir, path)
+  if os.path.islink(fp):
+    yield _wt_contents(git_repo, path)
+    return
+  with io.open(fp, mode='rb') as f:
+    while True:
+      chunk = f.read(_DIFF_CHUNK_SIZE)
+      if not chunk:
+        break
+      yield chunk
+
+
+def _blob_version(blob):
+  """Return the (size, chunks) of blob to check against the diff limits.
+
+  The chunks are slices of the blob's buffer, so the contents are not copied
+  all at once (see _DiffLimits.summary).
+  """
+  if blob is None:
+    return None
+
+  def chunks():
+    data = memoryview(blob)
+    for i in range(0, len(data), _DIFF_CHUNK_SIZE):
+      yield data[i:i + _DIFF_CHUNK_SIZE].tobytes()
+  return blob.size, chunks
+
+
+def _count_lines(chunks):
+  """Return the number of lines of the contents given as chunks."""
+  lines = 0
+  last = b''
+  for chunk in chunks:
+    if chunk:
+      lines += chunk.count(b'\n')
+      last = chunk
+  if last and not last.endswith(b'\n'):  # the last line has no newline
+    lines += 1
+  return lines
+
+
+class _DiffLimits(object):
+  """The limits above which files are not diffed, only summarized.
+
+  The limits are the max size in bytes and the max number of lines of either
+  version of the file, given by the gitless.diffMaxSize and
+  gitless.diffMaxLines config options. They can be set for the files that
+  match a pattern with gitless.<pattern>.diffMaxSize and
+  gitless.<pattern>.diffMaxLines (e.g., gitless.*.lock.diffMaxLines), in
+  which case the last pattern (in config order) that matches wins. Patterns
+  with no / are matched against the name of the file, otherwise against its
+  path relative to the repo root. A negative limit means no limit.
+  """
+
+  _OPTIONS = ('diffmaxsize', 'diffmaxlines')
+
+  def __init__(self, config):
+    self.max_size = self._get(config, 'gitless.diffMaxSize', _DIFF_MAX_SIZE)
+    self.max_lines = self._get(
+        config, 'gitless.diffMaxLines', _DIFF_MAX_LINES)
+    # pattern -> [max size, max lines] (None if not set for the pattern)
+    self.patterns = collections.OrderedDict()
+    for name in config:
+      section, _, rest = name.partition('.')
+      pattern, _, option = rest.rpartition('.')
+      if (section.lower() != 'gitless' or not pattern or
+          option.lower() not in self._OPTIONS):
+        continue
+      limits = self.patterns.pop(pattern, [None, None])
+      limits[self._OPTIONS.index(option.lower())] = config.get_int(name)
+      self.patterns[pattern] = limits  # it goes last
+
+  @staticmethod
+  def _get(config, name, default):
+    try:
+      return config.get_int(name)
+    except KeyError:
+      return default
+
+  def for_path(self, path):
+    """Return the (max size, max lines) of path."""
+    max_size, max_lines = self.max_size, self.max_lines
+    fname = os.path.basename(path)
+    for pattern, (size, lines) in self.patterns.items():
+      if not fnmatch.fnmatchcase(path if '/' in pattern else fname, pattern):
+        continue
+      if size is not None:
+        max_size = size
+      if lines is not None:
+        max_lines = lines
+    return max_size, max_lines
+
+  def summary(self, path, old, new):
+    """Return the DiffSummary of path if it's over the limits, None otherwise.
+
+    old and new are the (size, chunks) of each version of path, chunks being
+    a function that returns a generator of its contents (None if there's no
+    such version). The lines are counted as the chunks come, and only if the
+    sizes are not enough to tell (a file can't have more lines than bytes).
+    """
+    max_size, max_lines = self.for_path(path)
+    over = lambda n, limit: limit >= 0 and n > limit
+    sizes = [v[0] for v in (old, new) if v]
+    over_size = any(over(size, max_size) for size in sizes)
+    if not over_size and not any(over(size, max_lines) for size in sizes):
+      return None
+    old_lines, new_lines = [
+        _count_lines(v[1]()) if v else None for v in (old, new)]
+    if not over_size and not any(
+        over(lines, max_lines) for lines in (old_lines, new_lines)
+        if lines is not None):
+      return None
+    return DiffSummary(
+        path, old[0] if old else None, new[0] if new else None,
+        old_lines, new_lines)
+
+
+# Index preloading (see Branch.status)
+
+# The entries are split in this many chunks per worker so that the work is
+# balanced even if some dirs need more work than others
+_PRELOAD_CHUNKS_PER_WORKER = 4
+
+_HASH_BUF_SIZE = 1024 * 1024
+
+_IDXENTRY_MODES = frozenset([0o100644, 0o100755])
+
+
+def _preload_index(git_repo, index, workers, pathspec=None, checksum=None):
+  """Refreshes the stat data of the index entries of unchanged files.
+
+  This is like git's preloaded index. The index entries are split in chunks of
+  consecutive entries (i.e., by dir) that a pool of threads takes turns at.
+  Each file is stat'ed and, if its stat data doesn't match the one in the
+  index (e.g., because it was touched or checked out again), it is hashed.
+  Files whose contents are still those of the index get their entries
+  refreshed (and the index is written), so that when libgit2 computes the
+  status it doesn't need to hash them one after the other. Files that did
+  change are left for libgit2 to find out.
+
+  The index is only written if some entry changed. Files modified in the
+  same second the index is written are not refreshed: they could change
+  again without their mtime changing, so their entries are left as they are
+  (which, like git's smudging of racily clean entries, makes the status look
+  at their contents).
+
+  checksum is that of the index as it was read (see _index_checksum). If the
+  index in disk no longer has that checksum when we are about to write it,
+  someone else changed it while we were hashing (e.g., with git add), and the
+  index is not written (writing it would undo their changes).
+
+  Returns:
+    the number of entries that were refreshed.
+  """
+  index_fp = os.path.join(git_repo.path, 'index')
+  try:
+    index_mtime = os.stat(index_fp).st_mtime
+  except OSError:  # no index yet
+    return 0
+
+  entries = []
+  for path, c_entry in _c_index_entries(index, pathspec=pathspec):
+    if (c_entry.flags & (_IDXENTRY_VALID | _IDXENTRY_STAGEMASK) or
+        c_entry.mode not in _IDXENTRY_MODES):
+      continue  # au files, conflicts, symlinks and submodules
+    entries.append((
+        path, c_entry.mode, c_entry.file_size,
+        (c_entry.mtime.seconds, c_entry.mtime.nanoseconds), c_entry.ino,
+        bytes(ffi.buffer(c_entry.id.id)[:])))
+  if not entries:
+    return 0
+
+  root = git_repo.workdir.encode('utf-8')
+  chunk_size = max(1, len(entries) // (workers * _PRELOAD_CHUNKS_PER_WORKER))
+  chunks = queue.Queue()
+  for i in range(0, len(entries), chunk_size):
+    chunks.put(entries[i:i + chunk_size])
+  refreshed = []  # list.append is thread-safe
+
+  def work():
+    while True:
+      try:
+        chunk = chunks.get_nowait()
+      except queue.Empty:
+        return
+      for entry in chunk:
+        st = _unchanged_file_stat(root, index_mtime, *entry)
+        if st:
+          refreshed.append((entry[0], st))
+
+  threads = [threading.Thread(target=work) for _ in range(workers)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+
+  # The index will be written now or later, so its mtime won't be older than
+  # this
+  racy_secs = int(time.time())
+  refreshed = [(path, st) for path, st in refreshed if st.st_mtime < racy_secs]
+  if not refreshed:
+    return 0
+  c_index = index._index
+  for path, st in refreshed:
+    c_entry = C.git_index_get_bypath(c_index, path, 0)
+    c_entry.ctime.seconds, c_entry.ctime.nanoseconds = _stat_time(st, 'ctime')
+    c_entry.mtime.seconds, c_entry.mtime.nanoseconds = _stat_time(st, 'mtime')
+    c_entry.dev = st.st_dev & 0xFFFFFFFF
+    c_entry.ino = st.st_ino & 0xFFFFFFFF
+    c_entry.uid = st.st_uid & 0xFFFFFFFF
+    c_entry.gid = st.st_gid & 0xFFFFFFFF
+  if _index_checksum(git_repo.path) != checksum:
+    return 0
+  try:
+    index.write()
+  except pygit2.GitError:  # someone else has the index locked, no big deal
+    return 0
+  return len(refreshed)
+
+
+def _unchanged_file_stat(root, index_mtime, path, mode, size, mtime, ino, oid):
+  """Return the stat of the file of an index entry if it didn't change.
+
+  None is returned if the file changed or if its stat data already matches
+  the one in the index entry (so there's nothing to refresh).
+  """
+  fp = os.path.join(root, path)
+  try:
+    st = os.lstat(fp)
+  except OSError:
+    return None
+  if (not stat.S_ISREG(st.st_mode) or
+      (0o100755 if st.st_mode & stat.S_IXUSR else 0o100644) != mode or
+      st.st_size & 0xFFFFFFFF != size):
+    return None  # changed (or let libgit2 decide, e.g., if core.filemode)
+  if (_stat_time(st, 'mtime') == mtime and st.st_ino & 0xFFFFFFFF == ino and
+      st.st_mtime < index_mtime):
+    return None  # up to date (and not racy)
+
+  h = hashlib.sha1('blob {0}\0'.format(st.st_size).encode('ascii'))
+  try:
+    with io.open(fp, mode='rb') as f:
+      while True:
+        buf = f.read(_HASH_BUF_SIZE)
+        if not buf:
+          break
+        h.update(buf)
+  except (IOError, OSError):
+    return None
+  if h.digest() != oid:
+    return None
+  if _stat_time(st, 'mtime') == mtime and st.st_ino & 0xFFFFFFFF == ino:
+    return None  # unchanged but racy, refreshing the entry wouldn't change it
+  return st
+
+
+def _stat_time(st, name):
+  """Return the (secs, nanosecs) of st's 'mtime' or 'ctime'."""
+  ns = getattr(st, 'st_{0}_ns'.format(name), None)
+  if ns is None:  # Python < 3.3
+    t = getattr(st, 'st_' + name)
+    return int(t), int((t - int(t)) * 1000000000)
+  return ns // 1000000000, ns % 1000000000
+
+
+# Status cache
+
+STATUS_CACHE_FILE = 'GL_STATUS_CACHE'
+STATUS_SUMMARY_FILE = 'GL_STATUS_SUMMARY'
+# A summary (see Branch.status_summary) as JSON takes less than this many bytes
+# (PIPE_BUF in Linux)
+_STATUS_SUMMARY_MAX_SIZE = 4096
+STATUS_CACHE_COLLAPSED_FILE = 'GL_STATUS_CACHE_COLLAPSED'
+_STATUS_CACHE_VERSION = 1
+
+# Dirs modified less than this many secs before the status was computed are
+# not trusted (they could change again in the same mtime tick)
+_STATUS_CACHE_RACY_SECS = 2
+
+# If the watcher reports more changed paths than this, it's cheaper to stat
+# the working directory
+_WATCHER_MAX_PATHS = 1000
+
+
+class _StatusCache(object):
+  """Cache of the status of the working directory.
+
+  Finding the untracked and ignored files requires walking the whole working
+  directory, including big untracked trees (like build outputs). The cache
+  keeps the untracked part of the status together with the mtime of each dir
+  (and of its .gitignore), the checksum of the index, HEAD and the stat of the
+  global ignore files. Files can only appear in or disappear from a dir if the
+  dir's mtime changes, so later status computations only rescan the dirs that
+  changed. The tracked part of the status is computed every time (that only
+  needs to stat the files in the index).
+
+  If the watcher is running (see gl watch), we ask it for the paths that
+  changed since the status was cached instead, and only those paths are
+  looked at (for both the tracked and untracked part of the status).
+
+  The status with untracked dirs collapsed (see Branch.status) is cached
+  separately, so that using both doesn't make one invalidate the other.
+
+  The cache lives in the Gitless's dir, it can be disabled by setting the
+  gitless.statusCache config option to false.
+  """
+
+  def __init__(
+      self, gl_repo, recurse_untracked=True, timings=None,
+      refreshed_from=None, on_tracked=None):
+    self.gl_repo = gl_repo
+    self.recurse_untracked = recurse_untracked
+    self.timings = timings
+    # The checksum the index had before we refreshed it (see _preload_index),
+    # a cache for that index is still good
+    self.refreshed_from = refreshed_from
+    # Called with the tracked part of the status before we look for untracked
+    # files (see Branch.status)
+    self.on_tracked = on_tracked
+    self.path = os.path.join(
+        gl_repo.path,
+        STATUS_CACHE_FILE if recurse_untracked else STATUS_CACHE_COLLAPSED_FILE)
+
+  def status(self, index):
+    """Return a dict of path -> git status (like git_repo.status())."""
+    with _Phase(self.timings, 'cache'):
+      return self._status(index)
+
+  def _status(self, index):
+    git_repo = self.gl_repo.git_repo
+    timings = self.timings
+    start = time.time()
+    key = self._key()
+    data = self._load()
+    rekeyed = bool(
+        data and self.refreshed_from and
+        data.get('index') == self.refreshed_from)
+    if rekeyed:
+      data['index'] = key['index']  # only the stat data of entries changed
+    if data and any(data.get(k) != v for k, v in key.items()):
+      data = None
+
+    watched = _watcher_changes(
+        self.gl_repo, data.get('watcher') if data else None)
+    changed = watched[1] if watched else None
+    if changed is not None and len(changed) > _WATCHER_MAX_PATHS:
+      changed = None
+
+    if not data:
+      data = dict(key, dirs={}, sts={})
+      dirty = ['']
+      changed = None
+    elif changed is not None and 'tracked' in data:
+      dirty = self._dirty_paths(changed, data['sts'])
+    else:
+      changed = None
+      dirty = self._dirty_paths(
+          [d for d, sig in data['dirs'].items() if sig != self._sig(d)],
+          data['sts'])
+
+    if timings:
+      if dirty == ['']:
+        timings.cache = 'rebuilt'
+      else:
+        timings.cache = 'stat' if changed is None else 'watcher'
+
+    if changed is None:
+      tracked = _git_status(git_repo, index, untracked=False, timings=timings)
+    else:
+      tracked = data['tracked']
+      if changed:
+        changed = _top_dirs(changed)
+        _drop_under(tracked, changed)
+        tracked.update(_git_status(
+            git_repo, index, pathspec=changed, untracked=False,
+            timings=timings))
+
+    if self.on_tracked:
+      self.on_tracked(tracked)
+
+    if dirty:
+      dirty = _top_dirs(dirty)
+      if timings:
+        timings.dirs_rescanned = len(dirty)
+      _drop_under(data['sts'], dirty)
+      _drop_under(data['dirs'], dirty)
+      data['sts'].update(_git_status(
+          git_repo, index, pathspec=dirty, tracked=False,
+          recurse_untracked=self.recurse_untracked, timings=timings))
+      for d in dirty:
+        self._record_dirs(d, data, start)
+
+    if watched:
+      data['watcher'] = watched[0]
+      data['tracked'] = tracked
+      self._save(data)
+    elif dirty or rekeyed or 'tracked' in data:
+      data.pop('watcher', None)
+      data.pop('tracked', None)
+      self._save(data)
+
+    sts = dict(tracked)
+    for path, st in data['sts'].items():
+      if sts.get(path) != pygit2.GIT_STATUS_CONFLICTED:
+        sts[path] = sts.get(path, 0) | st
+    return sts
+
+  def _key(self):
+    """The info that invalidates the whole cache if it changes."""
+    gl_repo = self.gl_repo
+    git_repo = gl_repo.git_repo
+    ignore_fps = [
+        os.path.join(gl_repo.path, 'info', 'exclude'),
+        os.path.join(
+            os.environ.get('XDG_CONFIG_HOME') or os.path.join('~', '.config'),
+            'git', 'ignore')]
+    try:
+      ignore_fps.append(gl_repo.config['core.excludesfile'])
+    except KeyError:
+      pass
+    return {
+        'version': _STATUS_CACHE_VERSION,
+        'index': _index_checksum(gl_repo.path),
+        'head': (
+            None if git_repo.head_is_unborn else str(git_repo.head.target)),
+        'ignore': [_stat_sig(os.path.expanduser(fp)) for fp in ignore_fps]
+        }
+
+  def _sig(self, dir_path):
+    """The signature of a dir, None if it doesn't exist."""
+    fp = os.path.join(self.gl_repo.root, dir_path)
+    sig = _stat_sig(fp)
+    if not sig:
+      return None
+    return [sig[0]] + (
+        _stat_sig(os.path.join(fp, '.gitignore')) or [None, None])
+
+  def _dirty_paths(self, changed, cached_sts):
+    """Return the paths to rescan given the paths that changed."""
+    ret = []
+    for path in changed:
+      parts = path.split('/')
+      whole_dirs = [
+          d for d in ('/'.join(parts[:i]) for i in range(1, len(parts)))
+          if d + '/' in cached_sts]
+      if whole_dirs:
+        # Changes inside of dirs that are reported as a whole don't affect
+        # the status, unless the dir is untracked (if it ends up with no
+        # files in it it's no longer reported), in which case we look at the
+        # dir again (but not at what's inside of it)
+        if cached_sts[whole_dirs[0] + '/'] != pygit2.GIT_STATUS_IGNORED:
+          ret.append(whole_dirs[0])
+        continue
+      ret.append(path)
+      if parts[-1] == '.gitignore':
+        ret.append('/'.join(parts[:-1]))
+    return ret
+
+  def _record_dirs(self, dir_path, data, start):
+    """Records the signature of dir_path and of all dirs under it.
+
+    Dirs that are reported as a whole (ignored dirs and, if untracked dirs
+    are collapsed, untracked dirs) are not walked, that's what makes
+    collapsing them cheap. For untracked ones we only need to know when they
+    end up with no files in them (see _record_witness).
+    """
+    root = self.gl_repo.root
+    sts = data['sts']
+    dirs = data['dirs']
+    ignored = pygit2.GIT_STATUS_IGNORED
+
+    def whole(d):  # the status of d if it's reported as a whole
+      return sts.get(d + '/') if d else None
+
+    if whole(dir_path) is not None:
+      if whole(dir_path) != ignored:
+        self._record_witness(dir_path, dirs, start)
+      return
+
+    for curr, dirnames, fps in os.walk(os.path.join(root, dir_path)):
+      curr = os.path.relpath(curr, root)
+      curr = '' if curr == '.' else curr.replace(os.sep, '/')
+      dirs[curr] = self._recorded_sig(curr, start)
+
+      if curr and ('.git' in dirnames or '.git' in fps):
+        dirnames[:] = []  # a nested repo, its files are not ours
+        continue
+      walk = []
+      for d in dirnames:
+        d_path = curr + '/' + d if curr else d
+        if d == '.git':
+          continue
+        elif whole(d_path) is None:
+          walk.append(d)
+        elif whole(d_path) != ignored:
+          self._record_witness(d_path, dirs, start)
+      dirnames[:] = walk
+
+  def _record_witness(self, dir_path, dirs, start):
+    """Records the signature of dir_path and of the dirs down to a file in it.
+
+    dir_path is an untracked dir that is reported as a whole. It has files in
+    it for as long as the file we found is there, and the file can't go away
+    without the mtime of one of those dirs changing. So we don't need to look
+    at the rest of what's in dir_path.
+    """
+    root = self.gl_repo.root
+
+    def find(d):  # the dirs from d down to a file, None if there's none
+      try:
+        names = sorted(os.listdir(os.path.join(root, d)))
+      except OSError:
+        return None
+      subdirs = []
+      for name in names:
+        fp = os.path.join(root, d, name)
+        if name == '.git' or os.path.islink(fp) or not os.path.isdir(fp):
+          return [d]  # a file (or a nested repo)
+        subdirs.append(d + '/' + name)
+      for subdir in subdirs:
+        chain = find(subdir)
+        if chain:
+          return [d] + chain
+      return None
+
+    for d in find(dir_path) or [dir_path]:
+      dirs[d] = self._recorded_sig(d, start)
+
+  def _recorded_sig(self, dir_path, start):
+    """The signature of dir_path to record (None if it's racy)."""
+    sig = self._sig(dir_path)
+    if sig and max(t for t in sig[:2] if t) > start - _STATUS_CACHE_RACY_SECS:
+      return None  # racy, we'll look at it again next time
+    return sig
+
+  def _load(self):
+    try:
+      with io.open(self.path, mode='rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+      return None
+
+  def _save(self, data):
+    tmp_fp = self.path + '.tmp'
+    with io.open(tmp_fp, mode='wb') as f:
+      f.write(json.dumps(data).encode('utf-8'))
+    os.rename(tmp_fp, self.path)
+
+
+# Watcher (see gl watch)
+
+WATCHER_SOCKET_FILE = 'GL_WATCHER_SOCK'
+WATCHER_PID_FILE = 'GL_WATCHER_PID'
+
+_WATCHER_TIMEOUT = 2  # in secs
+
+
+def _watcher_changes(gl_repo, token):
+  """Asks the watcher for the paths that changed since token.
+
+  Returns:
+    None if there's no watcher running or a (token, paths) tuple where token
+    identifies the current state of the working directory and paths is the
+    list of paths (relative to the root) that changed since the given token.
+    paths is None if the watcher can't tell (e.g., it lost events), in which
+    case the whole working directory has to be looked at.
+  """
+  sock_fp = os.path.join(gl_repo.path, WATCHER_SOCKET_FILE)
+  if not hasattr(socket, 'AF_UNIX') or not os.path.exists(sock_fp):
+    return None
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.settimeout(_WATCHER_TIMEOUT)
+  try:
+    s.connect(sock_fp)
+    s.sendall(json.dumps({'since': token}).encode('utf-8') + b'\n')
+    resp = b''
+    while not resp.endswith(b'\n'):
+      chunk = s.recv(65536)
+      if not chunk:
+        return None
+      resp += chunk
+    resp = json.loads(resp.decode('utf-8'))
+    return resp['token'], resp['paths']
+  except (socket.error, ValueError, KeyError):
+    return None
+  finally:
+    s.close()
+
+
+def _stat_sig(fp):
+  """Return [mtime, size] of fp or None if it doesn't exist."""
+  try:
+    st = os.stat(fp)
+  except OSError:
+    return None
+  return [st.st_mtime, st.st_size]
+
+
+def _index_header(git_path):
+  """Return the (version, entries) in the header of the index.
+
+  Both are None if there's no index (or it's not an index).
+  """
+  try:
+    with io.open(os.path.join(git_path, 'index'), mode='rb') as f:
+      header = f.read(_INDEX_HEADER.size)
+  except (IOError, OSError):
+    return None, None
+  if len(header) != _INDEX_HEADER.size:
+    return None, None
+  sig, version, entries = _INDEX_HEADER.unpack(header)
+  if sig != b'DIRC':
+    return None, None
+  return version, entries
+
+
+def _index_checksum(git_path):
+  """Return the checksum of the index (its trailing SHA-1) or None."""
+  try:
+    with io.open(os.path.join(git_path, 'index'), mode='rb') as f:
+      f.seek(-20, os.SEEK_END)
+      return binascii.hexlify(f.read()).decode('ascii')
+  except (IOError, OSError):
+    return None
+
+
 # Misc
 
+def _fork_detached():
+  """Forks a process that is detached from this one (like a daemon does).
+
+  Returns True in the detached process (which has to end with os._exit) and
+  False in this one. The detached process is not a child of this process, it
+  has its own session and its stdin, stdout and stderr are /dev/null, so no
+  one waits for it to exit (e.g., the shell that reads our stdout).
+  """
+  pid = os.fork()
+  if pid:
+    os.waitpid(pid, 0)  # the child exits right after forking again
+    return False
+  try:
+    os.setsid()
+    if os.fork():
+      os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+      os.dup2(devnull, fd)
+    os.close(devnull)
+  except BaseException:
+    os._exit(1)
+  return True
+
+
 OpCb = collections.namedtuple(
     'OpCb', ['apply_ok', 'apply_err', 'save', 'restore_ok'])
 
+def _unique(paths):
+  """Return the list of the given paths without duplicates (in order)."""
+  seen = set()
+  ret = []
+  for path in paths:
+    if path not in seen:
+      seen.add(path)
+      ret.append(path)
+  return ret
+
+def _raise_err(results):
+  """Raises the error of the first failed (path, error) result, if any."""
+  for _, err in results:
+    if err:
+      raise err
+
 def stdout(p):
   return p.stdout.decode(ENCODING)
 
@@ -8,9 +8,17 @@
 from __future__ import unicode_literals
 
 from functools import wraps
+import io
+import json
 import os
 import shutil
 import tempfile
+import time
+try:
+  import tracemalloc
+except ImportError:  # Python < 3.4
+  tracemalloc = None
+import unittest
 
 from sh import git
 
@@ -254,6 +262,25 @@ class TestFileTrack(TestFile):
   def test_track_ignored(self):
     self.__assert_track_ignored(IGNORED_FP, IGNORED_FP_WITH_SPACE)
 
+  @assert_no_side_effects(TRACKED_FP, IGNORED_FP, NONEXISTENT_FP)
+  def test_track_files(self):
+    self.curr_b.untrack_file(TRACKED_DIR_FP_WITH_SPACE)
+    fps = [
+        UNTRACKED_FP, TRACKED_FP, UNTRACKED_DIR_DIR_FP_WITH_SPACE, IGNORED_FP,
+        TRACKED_DIR_FP_WITH_SPACE, NONEXISTENT_FP]
+    ret = self.curr_b.track_files(fps)
+    self.assertEqual(fps, [fp for fp, _ in ret])
+    errs = dict(ret)
+    self.assertTrue(isinstance(errs[TRACKED_FP], ValueError))
+    self.assertTrue(isinstance(errs[IGNORED_FP], ValueError))
+    self.assertTrue(isinstance(errs[NONEXISTENT_FP], KeyError))
+    for fp in (
+        UNTRACKED_FP, UNTRACKED_DIR_DIR_FP_WITH_SPACE,
+        TRACKED_DIR_FP_WITH_SPACE):
+      self.assertEqual(None, errs[fp])
+      self.assertEqual(
+          core.GL_STATUS_TRACKED, self.curr_b.status_file(fp).type)
+
 
 class TestFileUntrack(TestFile):
 
@@ -340,6 +367,26 @@ class TestFileUntrack(TestFile):
   def test_untrack_ignored(self):
     self.__assert_untrack_ignored(IGNORED_FP, IGNORED_FP_WITH_SPACE)
 
+  @assert_no_side_effects(UNTRACKED_FP, IGNORED_FP, NONEXISTENT_FP)
+  def test_untrack_files(self):
+    self.curr_b.track_file(UNTRACKED_DIR_FP)
+    fps = [
+        TRACKED_FP, UNTRACKED_FP, TRACKED_DIR_DIR_FP_WITH_SPACE, IGNORED_FP,
+        UNTRACKED_DIR_FP, NONEXISTENT_FP]
+    ret = self.curr_b.untrack_files(fps)
+    self.assertEqual(fps, [fp for fp, _ in ret])
+    errs = dict(ret)
+    self.assertTrue(isinstance(errs[UNTRACKED_FP], ValueError))
+    self.assertTrue(isinstance(errs[IGNORED_FP], ValueError))
+    self.assertTrue(isinstance(errs[NONEXISTENT_FP], KeyError))
+    for fp in (TRACKED_FP, TRACKED_DIR_DIR_FP_WITH_SPACE, UNTRACKED_DIR_FP):
+      self.assertEqual(None, errs[fp])
+      self.assertEqual(
+          core.GL_STATUS_UNTRACKED, self.curr_b.status_file(fp).type)
+    # The assumed unchanged bit is visible to git
+    out = utils_lib.stdout(git('ls-files', '-v', TRACKED_DIR_DIR_FP_WITH_SPACE))
+    self.assertTrue(out.startswith('h '))
+
 
 class TestFileCheckout(TestFile):
 
@@ -447,6 +494,268 @@ class TestFileStatus(TestFile):
     for f_st in self.curr_b.status():
       self.assertEqual(f_st, self.curr_b.status_file(f_st.fp))
 
+  def test_status_all_untracked_tracked(self):
+    au_fps = [TRACKED_FP_WITH_SPACE, TRACKED_DIR_DIR_FP_WITH_SPACE]
+    for fp in au_fps:
+      self.curr_b.untrack_file(fp)
+    os.remove(TRACKED_DIR_DIR_FP_WITH_SPACE)
+    st_all = dict((f_st.fp, f_st) for f_st in self.curr_b.status())
+    for fp in au_fps:
+      self.assertTrue(fp in st_all)
+      self.__assert_type(fp, core.GL_STATUS_UNTRACKED, st_all[fp].type)
+      self.__assert_field(fp, 'exists_at_head', True, st_all[fp].exists_at_head)
+      self.assertEqual(st_all[fp], self.curr_b.status_file(fp))
+    self.__assert_field(
+        TRACKED_FP_WITH_SPACE, 'exists_in_wd', True,
+        st_all[TRACKED_FP_WITH_SPACE].exists_in_wd)
+    self.__assert_field(
+        TRACKED_DIR_DIR_FP_WITH_SPACE, 'exists_in_wd', False,
+        st_all[TRACKED_DIR_DIR_FP_WITH_SPACE].exists_in_wd)
+
+  def test_status_cache(self):
+    def assert_status_equivalence():
+      self.assertItemsEqual(
+          list(self.curr_b.status(use_cache=False)), list(self.curr_b.status()))
+
+    assert_status_equivalence()
+    self.assertTrue(
+        os.path.exists(os.path.join(self.repo.path, core.STATUS_CACHE_FILE)))
+    assert_status_equivalence()  # now from the cache
+
+    utils_lib.write_file(os.path.join(DIR_DIR, 'new'))
+    assert_status_equivalence()
+    utils_lib.write_file(os.path.join('new_dir', 'new_dir', 'new'))
+    assert_status_equivalence()
+    os.remove(UNTRACKED_DIR_FP)
+    assert_status_equivalence()
+    shutil.rmtree(DIR_DIR)
+    assert_status_equivalence()
+    utils_lib.write_file(
+        os.path.join('new_dir', '.gitignore'), contents='new_dir')
+    assert_status_equivalence()
+    utils_lib.write_file('.gitignore', contents=UNTRACKED_FP)
+    assert_status_equivalence()
+    self.curr_b.track_file(UNTRACKED_FP_WITH_SPACE)
+    assert_status_equivalence()
+
+  def test_status_tracked_first(self):
+    utils_lib.write_file(TRACKED_FP, contents='contents')
+    git.rm('--cached', TRACKED_FP_WITH_SPACE)
+    early = []
+    late = list(self.curr_b.status(on_tracked=early.extend))
+    self.assertTrue(TRACKED_FP in [f.fp for f in early])
+    self.assertFalse(TRACKED_FP in [f.fp for f in late])
+    # Deleted from the index but in the working directory, it's untracked
+    self.assertFalse(TRACKED_FP_WITH_SPACE in [f.fp for f in early])
+    self.assertTrue(TRACKED_FP_WITH_SPACE in [f.fp for f in late])
+    self.assertItemsEqual(
+        list(self.curr_b.status(use_cache=False)), early + late)
+
+  def test_status_collapse_untracked(self):
+    def status():
+      st = list(self.curr_b.status(collapse_untracked=True))
+      self.assertItemsEqual(
+          list(self.curr_b.status(use_cache=False, collapse_untracked=True)),
+          st)
+      return dict((f_st.fp, f_st) for f_st in st)
+
+    utils_lib.write_file(os.path.join('new_dir', 'new_dir', 'new'))
+    utils_lib.write_file(os.path.join(DIR_DIR, 'new_dir', 'new'))
+    utils_lib.write_file(os.path.join('other_dir', 'a', 'b', 'new'))
+    utils_lib.write_file(os.path.join('other_dir', 'c', 'new'))
+    st = status()
+    for d in ['new_dir/', DIR_DIR + '/new_dir/', 'other_dir/']:
+      self.assertTrue(d in st)
+      self.assertEqual(core.GL_STATUS_UNTRACKED, st[d].type)
+    self.assertFalse(any(fp.endswith('/new') for fp in st))
+    self.assertTrue(UNTRACKED_DIR_DIR_FP in st)
+
+    # Untracked dirs reported as a whole are not walked, only the dirs down to
+    # one of their files are recorded
+    cache_fp = os.path.join(self.repo.path, core.STATUS_CACHE_COLLAPSED_FILE)
+    with io.open(cache_fp, mode='rb') as f:
+      dirs = json.loads(f.read().decode('utf-8'))['dirs']
+    self.assertTrue('other_dir/a/b' in dirs)
+    self.assertFalse('other_dir/c' in dirs)
+
+    os.remove(os.path.join('new_dir', 'new_dir', 'new'))
+    self.assertFalse('new_dir/' in status())
+    self.curr_b.track_file(os.path.join(DIR_DIR, 'new_dir', 'new'))
+    st = status()
+    self.assertFalse(DIR_DIR + '/new_dir/' in st)
+    self.assertTrue(DIR_DIR + '/new_dir/new' in st)
+
+  def test_status_preload(self):
+    tracked_fps = [
+        TRACKED_FP, TRACKED_FP_WITH_SPACE, TRACKED_DIR_FP,
+        TRACKED_DIR_FP_WITH_SPACE, TRACKED_DIR_DIR_FP,
+        TRACKED_DIR_DIR_FP_WITH_SPACE]
+    # Same size, different contents
+    utils_lib.write_file(TRACKED_DIR_FP, contents=TRACKED_FP_CONTENTS_1)
+    st = list(self.curr_b.status(use_cache=False, workers=1))
+    for fp in tracked_fps:
+      os.utime(fp, (1, 1))
+
+    index = self.repo.git_repo.index
+    index.read(False)
+    index_fp = os.path.join(self.repo.path, 'index')
+    checksum = core._index_checksum(self.repo.path)
+
+    # The index is not written if it changed in disk since it was read
+    index_st = os.stat(index_fp)
+    self.assertEqual(
+        0, core._preload_index(
+            self.repo.git_repo, index, 4, checksum='0' * 40))
+    self.assertEqual(index_st.st_mtime, os.stat(index_fp).st_mtime)
+    index.read()
+
+    refreshed = core._preload_index(
+        self.repo.git_repo, index, 4, checksum=checksum)
+    self.assertEqual(len(tracked_fps) - 1, refreshed)
+    self.assertEqual(
+        0, core._preload_index(
+            self.repo.git_repo, index, 4,
+            checksum=core._index_checksum(self.repo.path)))
+    self.assertItemsEqual(st, list(self.curr_b.status(workers=4)))
+
+    # Refreshing the index doesn't invalidate the status cache
+    for fp in tracked_fps:
+      os.utime(fp, (1, 1))
+    t = core.StatusTimings()
+    self.assertItemsEqual(
+        st, list(self.curr_b.status(workers=4, timings=t)))
+    self.assertEqual(len(tracked_fps) - 1, t.refreshed)
+    self.assertEqual('stat', t.cache)
+
+    # Racy files are not refreshed and the index is only written if some
+    # entry changed
+    index.read()
+    index_st = os.stat(index_fp)
+    future = time.time() + 100
+    os.utime(TRACKED_FP, (future, future))
+    self.assertEqual(
+        0, core._preload_index(
+            self.repo.git_repo, index, 4,
+            checksum=core._index_checksum(self.repo.path)))
+    self.assertEqual(index_st.st_mtime, os.stat(index_fp).st_mtime)
+    self.assertFalse(self.curr_b.status_file(TRACKED_FP).modified)
+    self.assertTrue(self.curr_b.status_file(TRACKED_DIR_FP).modified)
+
+  def test_status_timings(self):
+    def timings(**kwargs):
+      t = core.StatusTimings()
+      st = list(self.curr_b.status(timings=t, **kwargs))
+      self.assertItemsEqual(st, list(self.curr_b.status(**kwargs)))
+      return t
+
+    # Without the cache the status is libgit2's
+    t = timings(use_cache=False)
+    self.assertEqual(None, t.cache)
+    self.assertEqual(['git status', 'assumed unchanged'], list(t.phases))
+    self.assertEqual(len(self.repo.git_repo.index), t.index_entries)
+
+    self.assertEqual('rebuilt', timings().cache)
+    t = timings()
+    self.assertEqual('stat', t.cache)
+    self.assertEqual(0, t.dirs_rescanned)
+    for phase in ['cache', 'index', 'tracked files', 'assumed unchanged']:
+      self.assertTrue(phase in t.phases)
+    self.assertAlmostEqual(sum(t.phases.values()), t.total)
+
+    t = timings(workers=4)
+    self.assertEqual(4, t.workers)
+    self.assertTrue('preload' in t.phases)
+
+  def test_status_summary(self):
+    self.curr_b.untrack_file(TRACKED_FP_WITH_SPACE)
+    utils_lib.write_file(os.path.join('new_dir', 'new'))
+    sts = list(self.curr_b.status(collapse_untracked=True))
+    summary = self.curr_b.status_summary()
+    self.assertEqual(self.curr_b.branch_name, summary.branch_name)
+    self.assertEqual(None, summary.op)
+    self.assertTrue(summary.dirty)
+    self.assertFalse(summary.stale)
+    self.assertEqual(
+        len([f for f in sts if f.type == core.GL_STATUS_TRACKED]),
+        summary.tracked_modified)
+    self.assertEqual(
+        len([f for f in sts if f.type == core.GL_STATUS_UNTRACKED]),
+        summary.untracked)
+    self.assertEqual(0, summary.conflicts)
+    self.assertTrue(self.curr_b.status_summary(counts=False).dirty)
+
+    # Only ignored files
+    self.curr_b.track_file(TRACKED_FP_WITH_SPACE)
+    git.add('.')
+    git.commit(m='commit')
+    summary = self.curr_b.status_summary()
+    self.assertFalse(summary.dirty)
+    self.assertEqual(0, summary.untracked)
+    self.assertFalse(self.curr_b.status_summary(counts=False).dirty)
+
+  def test_status_summary_timeout(self):
+    summary_fp = os.path.join(self.repo.path, core.STATUS_SUMMARY_FILE)
+
+    def summary_id():
+      try:
+        return os.stat(summary_fp).st_ino
+      except OSError:
+        return None
+
+    def wait_for_summary(last_id):
+      # The summary is computed in a detached process that goes on after the
+      # timeout and saves it (in a new file) once it's done
+      for _ in range(0, 100):
+        if summary_id() not in (None, last_id):
+          return
+        time.sleep(0.1)
+      self.fail('Summary wasn\'t computed')
+
+    utils_lib.write_file(os.path.join('new_dir', 'new'))
+    summary = self.curr_b.status_summary(timeout=0)
+    self.assertTrue(summary.stale)
+    self.assertEqual(None, summary.dirty)
+    wait_for_summary(None)
+
+    last_id = summary_id()
+    summary = self.curr_b.status_summary(timeout=0)
+    wait_for_summary(last_id)
+    self.assertTrue(summary.stale)
+    self.assertEqual(
+        self.curr_b.status_summary(), summary._replace(stale=False))
+
+    # The summary is returned if it's ready in time
+    self.assertFalse(self.curr_b.status_summary(timeout=10).stale)
+
+  def test_status_files_equivalence(self):
+    self.curr_b.untrack_file(TRACKED_DIR_FP_WITH_SPACE)
+    utils_lib.write_file(TRACKED_FP, contents='contents')
+    fps = ALL_FPS_IN_WD + [NONEXISTENT_FP, NONEXISTENT_FP_WITH_SPACE]
+    expected = dict((fp, self.curr_b.status_file(fp)) for fp in ALL_FPS_IN_WD)
+    self.assertEqual(expected, self.curr_b.status_files(fps))
+
+    # Force the computation of the status of the whole repo
+    batch_min = core._STATUS_FILES_BATCH_MIN
+    core._STATUS_FILES_BATCH_MIN = 0
+    try:
+      self.assertEqual(expected, self.curr_b.status_files(fps))
+    finally:
+      core._STATUS_FILES_BATCH_MIN = batch_min
+
+  def test_status_pathspec(self):
+    self.curr_b.untrack_file(TRACKED_DIR_DIR_FP)
+    utils_lib.write_file(TRACKED_DIR_FP, contents='contents')
+    st_all = list(self.curr_b.status())
+    for pathspec in [
+        [DIR], [DIR_DIR], [TRACKED_DIR_FP], [DIR, DIR_DIR, UNTRACKED_FP],
+        [NONEXISTENT_FP], ['']]:
+      expected = [
+          f_st for f_st in st_all
+          if any(f_st.fp == p or f_st.fp.startswith(p + '/') or not p
+                 for p in pathspec)]
+      self.assertItemsEqual(
+          expected, list(self.curr_b.status(pathspec=pathspec)))
+
   def test_status_nonexistent_fp(self):
     self.assertRaises(KeyError, self.curr_b.status_file, NONEXISTENT_FP)
     self.assertRaises(
@@ -558,6 +867,74 @@ class TestFileStatus(TestFile):
             fp, field, expected, field, got))
 
 
+class TestFileStatusList(TestFile):
+
+  def test_status_list(self):
+    self.curr_b.untrack_file(TRACKED_DIR_FP)
+    os.remove(TRACKED_DIR_DIR_FP)
+    st_all = list(self.curr_b.status())
+    st_list = core.FileStatusList(self.curr_b.status())
+    self.assertEqual(len(st_all), len(st_list))
+    self.assertEqual(st_all, list(st_list))
+    self.assertEqual(st_all[-1], st_list[-1])
+    st_list.sort()
+    self.assertEqual(sorted(st_all, key=lambda f: f.fp), list(st_list))
+
+  @unittest.skipUnless(tracemalloc, 'needs tracemalloc')
+  def test_status_list_memory(self):
+    # The list should take at least 5 times less memory than a list of
+    # FileStatus tuples for a big tree of untracked files
+    MIN_REDUCTION = 5
+    FPS_QTY = 100000
+
+    def statuses():
+      for i in range(0, FPS_QTY):
+        fp = 'build/out/dir{0}/file{1}.o'.format(i // 100, i % 100)
+        yield core.Branch.FileStatus(
+            fp, core.GL_STATUS_UNTRACKED, False, True, True, False)
+
+    def mem(build):
+      tracemalloc.start()
+      try:
+        sts = build()  # keep it alive while we measure
+        return tracemalloc.get_traced_memory()[0]
+      finally:
+        tracemalloc.stop()
+
+    tuples_mem = mem(lambda: list(statuses()))
+    list_mem = mem(lambda: core.FileStatusList(statuses()))
+    self.assertTrue(
+        list_mem * MIN_REDUCTION < tuples_mem,
+        msg='list {0}, tuples {1}'.format(list_mem, tuples_mem))
+
+
+class TestExpandPaths(TestFile):
+
+  def test_expand_paths(self):
+    self.assertEqual(
+        sorted(ALL_DIR_FPS_IN_WD), sorted(self.repo.expand_paths([DIR])))
+    self.assertEqual(
+        sorted(set(ALL_FPS_IN_WD) - set([IGNORED_FP, IGNORED_FP_WITH_SPACE])),
+        sorted(self.repo.expand_paths(['.'])))
+    # Paths given more than once are only generated once
+    self.assertEqual(
+        sorted([IGNORED_FP] + ALL_DIR_FPS_IN_WD), sorted(self.repo.expand_paths(
+            [DIR, DIR_DIR, IGNORED_FP, IGNORED_FP, UNTRACKED_DIR_FP])))
+
+  def test_expand_paths_prunes(self):
+    utils_lib.append_to_file('.gitignore', contents='\nnode_modules/\n')
+    utils_lib.write_file('node_modules/pkg/index.js')
+    utils_lib.write_file('node_modules/tracked.js')
+    git.add('-f', 'node_modules/tracked.js')
+    utils_lib.write_file('nested/.git/HEAD')
+    utils_lib.write_file('nested/f')
+    fps = list(self.repo.expand_paths(['']))
+    self.assertTrue('node_modules/tracked.js' in fps)
+    self.assertFalse('node_modules/pkg/index.js' in fps)
+    self.assertFalse(any(fp.startswith('nested') for fp in fps))
+    self.assertFalse(any('.git/' in fp for fp in fps))
+
+
 class TestFileDiff(TestFile):
 
   @assert_status_unchanged(
@@ -694,6 +1071,152 @@ class TestFileDiff(TestFile):
     self.assertEqual('+', hunk.lines[1].origin)
     self.assertEqual('new line', hunk.lines[1].content)
 
+  def test_diff_files(self):
+    utils_lib.write_file(TRACKED_FP, contents='new contents')
+    os.remove(TRACKED_DIR_FP)
+    fps = [
+        TRACKED_FP, NONEXISTENT_FP, UNTRACKED_FP, TRACKED_DIR_FP,
+        TRACKED_FP_WITH_SPACE, TRACKED_FP]
+    diffs = dict(self.curr_b.diff_files(fps))
+    self.assertEqual(sorted(set(fps)), sorted(diffs))
+    self.assertEqual(None, diffs[NONEXISTENT_FP])
+    self.assertEqual(
+        [(1, 1), (1, 0), (0, 1), (0, 0)],
+        [diffs[fp].line_stats[1:] for fp in fps[:-1] if diffs[fp]])
+    self.assertEqual(
+        sorted(diffs), [fp for fp, _ in self.curr_b.diff_files(fps)])
+
+  def test_diff_files_modified(self):
+    utils_lib.write_file(TRACKED_FP, contents='new contents')
+    os.remove(TRACKED_DIR_FP)
+    utils_lib.write_file(TRACKED_FP_WITH_SPACE, contents='new contents')
+    diffs = list(self.curr_b.diff_files(
+        include=[UNTRACKED_FP], exclude=[TRACKED_FP_WITH_SPACE]))
+    self.assertEqual(
+        sorted([TRACKED_FP, TRACKED_DIR_FP, UNTRACKED_FP]),
+        [fp for fp, _ in diffs])
+    self.assertEqual(
+        [(1, 1), (0, 1), (1, 0)],
+        [dict(diffs)[fp].line_stats[1:]
+         for fp in [TRACKED_FP, TRACKED_DIR_FP, UNTRACKED_FP]])
+
+  def test_diff_stats(self):
+    self.assertEqual(None, self.curr_b.diff_stats([]))
+    utils_lib.write_file(TRACKED_FP, contents='new contents\n')
+    os.remove(TRACKED_DIR_FP)
+    stats = self.curr_b.diff_stats(
+        [TRACKED_FP, UNTRACKED_FP, TRACKED_DIR_FP, TRACKED_FP_WITH_SPACE])
+    self.assertEqual(3, stats.files_changed)
+    self.assertEqual(2, stats.insertions)
+    self.assertEqual(2, stats.deletions)
+    self.assertEqual(
+        sorted([
+            (TRACKED_FP, 1, 1), (UNTRACKED_FP, 1, 0), (TRACKED_DIR_FP, 0, 1)]),
+        sorted(core.diff_stats_files(stats)))
+
+  def test_diff_limits(self):
+    utils_lib.write_file(TRACKED_FP, contents='1\n2\n3')
+    utils_lib.write_file(UNTRACKED_FP, contents='1\n2\n3\n')
+    git.config('gitless.diffMaxLines', 2)
+    self.assertEqual(
+        core.DiffSummary(TRACKED_FP, 5, 5, 1, 3),
+        self.curr_b.diff_file(TRACKED_FP))
+    self.assertEqual(
+        core.DiffSummary(UNTRACKED_FP, None, 6, None, 3),
+        self.curr_b.diff_file(UNTRACKED_FP))
+    self.assertEqual(
+        (3, 1), self.curr_b.diff_file(TRACKED_FP, full=True).line_stats[1:])
+
+    # The limits of the last pattern that matches win
+    git.config('gitless.f*.diffMaxLines', -1)
+    git.config('gitless.{0}.diffMaxSize'.format(UNTRACKED_FP), 5)
+    self.assertEqual(
+        (3, 1), self.curr_b.diff_file(TRACKED_FP).line_stats[1:])
+    self.assertEqual(
+        core.DiffSummary(UNTRACKED_FP, None, 6, None, 3),
+        self.curr_b.diff_file(UNTRACKED_FP))
+
+  def test_diff_commits_files(self):
+    c1 = self.repo.revparse_single('HEAD')
+    utils_lib.write_file(TRACKED_FP, contents='1\n2\n3\n')
+    utils_lib.write_file(UNTRACKED_FP, contents='new contents\n')
+    git.add(TRACKED_FP, UNTRACKED_FP)
+    git.rm(TRACKED_DIR_FP)
+    git.commit(m='changes')
+    c2 = self.repo.revparse_single('HEAD')
+
+    full = [
+        (p.delta.new_file.path, p.line_stats[1:])
+        for p in self.curr_b.diff_commits_files(c1, c2, full=True)]
+    self.assertEqual(
+        full,
+        [(p.delta.new_file.path, p.line_stats[1:])
+         for p in self.curr_b.diff_commits_files(c1, c2)])
+    for fp in [TRACKED_FP, UNTRACKED_FP, TRACKED_DIR_FP]:
+      self.assertTrue(fp in dict(full), msg=fp)
+
+    git.config('gitless.diffMaxLines', 2)
+    patches = dict(
+        (p.path, p) if isinstance(p, core.DiffSummary)
+        else (p.delta.new_file.path, p)
+        for p in self.curr_b.diff_commits_files(c1, c2))
+    self.assertEqual(
+        core.DiffSummary(TRACKED_FP, 5, 6, 1, 3), patches[TRACKED_FP])
+    self.assertEqual((1, 0), patches[UNTRACKED_FP].line_stats[1:])
+
+  def test_diff_stats_files_overflow(self):
+    class Stats(object):
+      def __init__(self, line):
+        self.line = line
+      def format(self, unused_format, unused_width):
+        return self.line + '\n'
+
+    self.assertEqual(
+        [('f', 1234567, 0)],
+        list(core.diff_stats_files(Stats('1234567 0       f'))))
+    # 10M+ lines added run into the lines removed
+    self.assertRaises(
+        core.GlError, list, core.diff_stats_files(Stats('123456781       f')))
+
+  def objects(self):
+    objects_dir = os.path.join(self.repo.path, 'objects')
+    return sorted(
+        os.path.join(d, fp) for d in os.listdir(objects_dir) if len(d) == 2
+        for fp in os.listdir(os.path.join(objects_dir, d)))
+
+  def test_diff_no_objects_written(self):
+    objects = self.objects
+
+    # The empty blob (the old side of new files) is written at most once
+    self.curr_b.diff_file(UNTRACKED_FP)
+    before = objects()
+    utils_lib.write_file(TRACKED_FP, contents='new contents')
+    utils_lib.write_file(UNTRACKED_FP, contents='new contents')
+    os.remove(TRACKED_FP_WITH_SPACE)
+    for fp in [TRACKED_FP, UNTRACKED_FP, TRACKED_FP_WITH_SPACE]:
+      self.assertEqual(1, len(self.curr_b.diff_file(fp).hunks))
+    self.assertEqual(before, objects())
+
+  def test_diff_clean_filters(self):
+    # The working version is diffed with its line endings converted
+    git.config('core.autocrlf', 'true')
+    utils_lib.write_file(TRACKED_FP, contents='a\r\nb\r\n')
+    git.add(TRACKED_FP)
+    git.commit(TRACKED_FP, m='crlf')
+    utils_lib.append_to_file(TRACKED_FP, contents='c\r\n')
+    before = self.objects()
+    patch = self.curr_b.diff_file(TRACKED_FP)
+    self.assertEqual((1, 0), patch.line_stats[1:])
+    self.assertEqual(before, self.objects())
+
+    git.config('--unset', 'core.autocrlf')
+    utils_lib.write_file('.gitattributes', contents='*.txt eol=crlf\n')
+    utils_lib.write_file('f.txt', contents='a\nb\n')
+    git.add('f.txt')
+    git.commit('f.txt', m='eol')
+    utils_lib.write_file('f.txt', contents='a\r\nb\r\n')
+    self.assertEqual(0, len(self.curr_b.diff_file('f.txt').hunks))
+
 
 class TestFileResolve(TestFile):
 
@@ -738,6 +1261,119 @@ class TestFileResolve(TestFile):
         self.curr_b.resolve_file, DIR_FP_IN_CONFLICT)
 
 
+class TestIndexFormat(TestFile):
+
+  def test_index_format(self):
+    info = self.repo.index_info()
+    self.assertEqual(2, info.version)
+    self.assertEqual(len(self.repo.git_repo.index), info.entries)
+    self.assertFalse(info.split)
+    self.repo.check_index()
+
+    git('update-index', '--index-version', '4')
+    self.assertEqual(4, self.repo.index_info().version)
+    self.assertRaises(core.GlError, self.repo.check_index)
+    self.assertRaises(core.GlError, self.repo.check_index, split=False)
+    self.repo.rewrite_index()
+    self.assertEqual(2, self.repo.index_info().version)
+    self.repo.check_index()
+
+    git.config('core.splitIndex', 'true')
+    git('update-index', '--split-index')
+    self.assertTrue(self.repo.index_info().split)
+    self.assertRaises(core.GlError, self.repo.check_index)
+    # Only the header is read, which doesn't tell a split index apart
+    self.repo.check_index(split=False)
+    self.repo.rewrite_index(version=3)
+    info = self.repo.index_info()
+    self.assertEqual(3, info.version)
+    self.assertFalse(info.split)
+    self.assertFalse(self.repo.config.get_bool('core.splitIndex'))
+    self.curr_b.track_file(UNTRACKED_FP)
+    self.assertFalse(self.repo.index_info().split)
+
+  def test_index_writes(self):
+    # Changes left in memory by a failed index transaction are discarded
+    index = self.repo.git_repo.index
+    try:
+      with self.curr_b._index as idx:
+        idx.remove(TRACKED_FP)
+        raise ValueError()
+    except ValueError:
+      pass
+    self.assertTrue(TRACKED_FP in index)
+    self.curr_b.track_file(UNTRACKED_FP)
+    self.assertTrue(TRACKED_FP in self.repo.git_repo.index)
+
+
+class TestSparse(TestCore):
+
+  def setUp(self):
+    super(TestSparse, self).setUp()
+    for fp in ['f', 'a/f', 'a/b/f', 'c/f', 'c/d/f']:
+      utils_lib.write_file(fp)
+    git.add('.')
+    git.commit(m='1')
+    self.curr_b = self.repo.current_branch
+
+  def test_sparse(self):
+    self.assertFalse(self.repo.is_sparse())
+    self.assertEqual(None, self.repo.sparse_dirs())
+
+    self.repo.set_sparse_dirs(['a'])
+    self.assertEqual(['a'], self.repo.sparse_dirs())
+    self.assertTrue(os.path.exists('a/b/f'))
+    self.assertFalse(os.path.exists('c'))
+    self.assertEqual([], list(self.curr_b.status()))
+
+    self.repo.set_sparse_dirs(['c/d'], add=True)
+    self.assertEqual(['a', 'c/d'], self.repo.sparse_dirs())
+    self.assertTrue(os.path.exists('c/f'))
+    self.assertTrue(os.path.exists('c/d/f'))
+
+    utils_lib.append_to_file('a/f', contents='contents')
+    self.assertEqual(['a/f'], [f.fp for f in self.curr_b.status()])
+
+    self.repo.set_sparse_dirs(['a'])
+    self.assertRaises(
+        ValueError, self.curr_b.checkout_file, 'c/d/f',
+        self.repo.revparse_single('HEAD'))
+    self.assertRaises(ValueError, self.repo.set_sparse_dirs, ['.'])
+
+    self.repo.disable_sparse()
+    self.assertFalse(self.repo.is_sparse())
+    self.assertTrue(os.path.exists('c/d/f'))
+    self.assertEqual(['a/f'], [f.fp for f in self.curr_b.status()])
+
+  def test_sparse_deleted(self):
+    self.repo.set_sparse_dirs(['a'])
+    os.remove('f')
+    self.assertEqual(['f'], [f.fp for f in self.curr_b.status()])
+    git.rm('--cached', 'f')
+    self.assertEqual(['f'], [f.fp for f in self.curr_b.status()])
+
+    git.reset('HEAD', 'f')
+    git.checkout('f')
+    shutil.rmtree('a')
+    self.assertEqual(
+        ['a/b/f', 'a/f'], sorted(f.fp for f in self.curr_b.status()))
+
+  def test_sparse_switch(self):
+    self.repo.set_sparse_dirs(['a'])
+    b = self.repo.create_branch('b', self.curr_b.head)
+    utils_lib.write_file('a/untracked')
+    self.repo.switch_current_branch(b)
+    self.assertFalse(os.path.exists('a/untracked'))
+    self.assertFalse(os.path.exists('c'))
+    self.assertEqual([], list(b.status()))
+
+    self.repo.switch_current_branch(self.curr_b)
+    self.assertTrue(os.path.exists('a/untracked'))
+    self.assertFalse(os.path.exists('c'))
+    self.assertEqual(
+        ['a/untracked'], [f.fp for f in self.curr_b.status()])
+
+
 # Unit tests for branch related operations
 
 class TestBranch(TestCore):
@@ -850,6 +1486,41 @@ class TestBranchSwitch(TestBranch):
     self.assertTrue(st)
     self.assertEqual(core.GL_STATUS_UNTRACKED, st.type)
 
+  def test_switch_file_classification_is_mantained_many(self):
+    fps = [TRACKED_FP, TRACKED_FP_WITH_SPACE, TRACKED_DIR_DIR_FP_WITH_SPACE]
+    for fp in fps[1:]:
+      utils_lib.write_file(fp, contents=TRACKED_FP_CONTENTS_1)
+    git.add(*fps[1:])
+    git.commit(*fps[1:], m='3')
+    git.branch('-f', BRANCH)
+    self.curr_b.untrack_files(fps)
+    self.repo.switch_current_branch(self.repo.lookup_branch(BRANCH))
+    sts = self.curr_b.status_files(fps)
+    for fp in fps:
+      self.assertEqual(core.GL_STATUS_TRACKED, sts[fp].type)
+    self.repo.switch_current_branch(self.repo.lookup_branch('master'))
+    sts = self.curr_b.status_files(fps)
+    for fp in fps:
+      self.assertEqual(core.GL_STATUS_UNTRACKED, sts[fp].type)
+
+  def test_switch_file_classification_old_format(self):
+    # Older versions saved the assumed unchanged files separated by spaces
+    fps = [TRACKED_DIR_FP, TRACKED_FP]
+    utils_lib.write_file(TRACKED_DIR_FP, contents=TRACKED_FP_CONTENTS_1)
+    git.add(TRACKED_DIR_FP)
+    git.commit(TRACKED_DIR_FP, m='3')
+    git.branch('-f', BRANCH)
+    self.curr_b.untrack_files(fps)
+    self.repo.switch_current_branch(self.repo.lookup_branch(BRANCH))
+    au_fp = os.path.join(self.repo.path, 'GL_AU_master')
+    self.assertEqual(
+        ''.join(fp + '\n' for fp in fps), utils_lib.read_file(au_fp))
+    utils_lib.write_file(au_fp, contents=' '.join(fps))
+    self.repo.switch_current_branch(self.repo.lookup_branch('master'))
+    sts = self.curr_b.status_files(fps)
+    for fp in fps:
+      self.assertEqual(core.GL_STATUS_UNTRACKED, sts[fp].type)
+
   def test_switch_with_hidden_files(self):
     hf = '.file'
     utils_lib.write_file(hf)
@@ -7,10 +7,14 @@
 
 from __future__ import unicode_literals
 
+import io
 import logging
 import os
 import re
+import subprocess
+import sys
 import time
+import unittest
 
 from sh import ErrorReturnCode, gl, git
 
@@ -47,6 +51,54 @@ class TestNotInRepo(utils.TestBase):
       gl.publish, gl.history)
 
 
+class TestStartup(utils.TestBase):
+
+  # Budget (in microseconds) for the import time of `gl --version` as reported
+  # by `python -X importtime`
+  IMPORT_TIME_BUDGET = 100000
+  # Runs `gl --version` in-process
+  VERSION_CMD = (
+      'import sys; from gitless.cli import gl; gl.run(["--version"]); '
+      'sys.stdout.flush()')
+  # Modules that should only be imported once we know which cmd to run
+  HEAVY_MODULES = ['pygit2', 'sh', 'clint', 'gitless.core']
+
+  def setUp(self):
+    super(TestStartup, self).setUp('gl-e2e-test')
+
+  def test_version_and_help_not_in_repo(self):
+    self.assertTrue('GL Version' in utils.stdout(gl('--version')))
+    self.assertTrue('subcommands' in utils.stdout(gl('--help')))
+
+  def test_no_heavy_imports(self):
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        self.VERSION_CMD + '; print(" ".join(sys.modules))'])
+    out = out.decode(utils.ENCODING)
+    self.assertTrue('GL Version' in out)
+    imported = out.splitlines()[-1].split()
+    for m in self.HEAVY_MODULES:
+      self.assertFalse(m in imported, msg='{0} was imported'.format(m))
+
+  def test_import_time_budget(self):
+    if sys.version_info < (3, 7):  # no -X importtime
+      return
+    p = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', self.VERSION_CMD],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    self.assertTrue('GL Version' in out.decode(utils.ENCODING))
+    total = 0
+    for l in err.decode(utils.ENCODING).splitlines():
+      cols = l.split('|')  # import time: self | cumulative | name
+      if len(cols) == 3 and cols[1].strip().isdigit():
+        total += int(cols[0].split(':')[1])
+    self.assertTrue(
+        total < self.IMPORT_TIME_BUDGET,
+        msg='imports took {0}us, budget is {1}us'.format(
+            total, self.IMPORT_TIME_BUDGET))
+
+
 class TestBasic(TestEndToEnd):
 
   def test_basic_functionality(self):
@@ -138,6 +190,61 @@ class TestBasic(TestEndToEnd):
     gl.resolve('file1')
     gl.commit(m='fixed conflicts')
 
+  def test_paths_from_stdin(self):
+    fps = ['file1', 'dir/file 2', 'dir/file\n3']
+    for fp in fps:
+      utils.write_file(fp)
+    self.assertRaises(ErrorReturnCode, gl.track)
+    out = utils.stdout(gl.track('--stdin', '-z', _in='\0'.join(fps)))
+    for fp in fps:
+      self.assertTrue('File {0} is now a tracked file'.format(fp) in out)
+    gl.untrack('--stdin', _in='file1\ndir/file 2\n')
+    st = utils.stdout(gl.status('--porcelain', _tty_out=False))
+    self.assertTrue('U -WM- file1' in st)
+    self.assertTrue('U -WM- dir/file 2' in st)
+    gl.commit('--stdin', '-z', m='commit', _in='dir/file\n3\0')
+    self.assertFalse('file\n3' in utils.stdout(gl.status(_tty_out=False)))
+
+  def test_checkout_invalid_commit_point(self):
+    utils.write_file('file1')
+    err = utils.stderr(gl.checkout(
+        '--commit-point', 'non-existent', 'file1', _ok_code=[1]))
+    self.assertTrue('Invalid commit point non-existent' in err, msg=err)
+    self.assertFalse('internal error' in err, msg=err)
+
+  def test_pager_quit(self):
+    # The output is piped into the pager as it's generated, if the pager
+    # exits early gl stops rendering the history and exits (without an
+    # error). The history is much bigger than the pipe buffer (64 KB), so gl
+    # can't get away with writing all of it before noticing the pager is gone
+    n = 10000
+    commits = []
+    for i in range(0, n):
+      msg = 'commit {0}\n'.format(i)
+      commits.append(
+          'commit refs/heads/master\n'
+          'committer test <test@test.com> {0} +0000\n'
+          'data {1}\n{2}{3}\n'.format(
+              1500000000 + i, len(msg), msg,
+              'from refs/heads/master^0\n' if not i else ''))
+    git('fast-import', '--quiet', _in=''.join(commits))
+
+    t = time.time()
+    out = utils.stdout(gl.history(_tty_out=False))
+    full_t = time.time() - t
+    self.assertEqual(n + 1, out.count('Commit Id'))
+    self.assertTrue(len(out) > 10 * 64 * 1024, msg=len(out))
+
+    git.config('core.pager', 'head -n 1')
+    t = time.time()
+    out = utils.stdout(gl.history())
+    paged_t = time.time() - t
+    self.assertEqual(1, out.count('Commit Id'), msg='out is ' + out)
+    # Only about a pipe buffer worth of history (a tenth of it at most) got
+    # rendered before gl exited, the margin is for gl's startup
+    self.assertTrue(
+        paged_t < full_t / 2,
+        msg='paged_t {0}, full_t {1}'.format(paged_t, full_t))
 
 class TestCommit(TestEndToEnd):
 
@@ -251,6 +358,101 @@ class TestStatus(TestEndToEnd):
     if (self.UNTRACKED_DIR_FP in st) or (rel_untracked not in st):
       self.fail()
 
+  def test_status_paths(self):
+    utils.write_file(self.TRACKED_DIR_FP, contents='some modifications')
+    utils.write_file('dir2/file3')
+    st = utils.stdout(gl.status(self.DIR, _tty_out=False))
+    self.assertTrue(self.TRACKED_DIR_FP in st)
+    self.assertTrue(self.UNTRACKED_DIR_FP in st)
+    self.assertFalse('dir2' in st)
+    st = utils.stdout(gl.status(
+        self.UNTRACKED_DIR_FP, 'dir2', '--untracked=all', _tty_out=False))
+    self.assertFalse(self.TRACKED_DIR_FP in st)
+    self.assertTrue(self.UNTRACKED_DIR_FP in st)
+    self.assertTrue('dir2/file3' in st)
+
+  def test_status_untracked_dirs(self):
+    utils.write_file('dir2/file3')
+    utils.write_file('dir2/dir3/file4')
+    utils.write_file('dir/dir3/file5')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertTrue('dir2/\n' in st)
+    self.assertTrue('dir/dir3/\n' in st)
+    self.assertFalse('file3' in st or 'file4' in st or 'file5' in st)
+    self.assertTrue(self.UNTRACKED_DIR_FP in st)
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+    os.chdir('dir2')
+    self.assertTrue('../dir2/\n' in utils.stdout(gl.status(_tty_out=False)))
+
+    st = utils.stdout(gl.status('--untracked=all', _tty_out=False))
+    self.assertFalse('dir2/\n' in st)
+    for fp in ['file3', 'dir3/file4', '../dir/dir3/file5']:
+      self.assertTrue(fp in st)
+
+  def test_status_porcelain(self):
+    utils.write_file(self.TRACKED_DIR_FP, contents='some modifications')
+    utils.write_file('dir2/file 3')
+    expected = [
+        '# gl-status v1', '# branch master',
+        'T HWM- ' + self.TRACKED_DIR_FP, 'U -WM- ' + self.UNTRACKED_DIR_FP,
+        'U -WM- dir2/']
+    st = utils.stdout(gl.status('--porcelain', _tty_out=False))
+    self.assertEqual(expected[:2], st.splitlines()[:2])
+    self.assertItemsEqual(expected, st.splitlines())
+    os.chdir(self.DIR)
+    st = utils.stdout(gl.status('-z', _tty_out=False))
+    self.assertTrue(st.endswith('\0'))
+    self.assertItemsEqual(expected, st.split('\0')[:-1])
+
+  def test_status_no_cache(self):
+    utils.write_file(self.TRACKED_DIR_FP, contents='some modifications')
+    utils.write_file('dir2/file3')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+    os.remove(self.UNTRACKED_DIR_FP)
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertFalse(self.UNTRACKED_DIR_FP in st)
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+
+  def test_status_timings(self):
+    st = utils.stdout(gl.status('--timings', _tty_out=False))
+    self.assertTrue('Computing the status took' in st)
+    self.assertTrue('working directory' in st or 'tracked files' in st)
+    # --no-cache uses libgit2's status
+    st = utils.stdout(gl.status('--timings', '--no-cache', _tty_out=False))
+    self.assertTrue('git status' in st, msg=st)
+    git.config('gitless.statusAdviceThreshold', '1')
+    p = gl.status('--porcelain', _tty_out=False)
+    self.assertTrue('Computing the status took' in utils.stderr(p))
+    self.assertFalse('Computing the status took' in utils.stdout(p))
+    git.config('gitless.statusAdviceThreshold', '0')
+    self.assertFalse(
+        'Computing the status took' in utils.stdout(gl.status(_tty_out=False)))
+
+  def test_status_split_index(self):
+    git('update-index', '--split-index')
+    err = utils.stderr(gl.status(_ok_code=[1], _tty_out=False))
+    self.assertTrue('gl index --rewrite' in err, msg=err)
+    gl.index('--rewrite')
+    gl.status()
+
+  def test_status_bad_workers(self):
+    st = utils.stdout(gl.status(_tty_out=False))
+    git.config('gitless.statusWorkers', 'many')
+    self.assertEqual(st, utils.stdout(gl.status(_tty_out=False)))
+
+  def test_prompt(self):
+    utils.write_file(self.TRACKED_DIR_FP, contents='some modifications')
+    utils.write_file('dir2/file3')
+    self.assertEqual(
+        'master *1 %2\n', utils.stdout(gl.prompt('-t', '0', _tty_out=False)))
+    self.assertEqual(
+        'master *\n',
+        utils.stdout(gl.prompt('-t', '0', '--no-counts', _tty_out=False)))
+    self.assertEqual(
+        'master 1\n', utils.stdout(gl.prompt(
+            '-t', '0', '--format', '{branch} {modified}', _tty_out=False)))
+
 
 class TestBranch(TestEndToEnd):
 
@@ -376,6 +578,63 @@ class TestDiffFile(TestEndToEnd):
       self.fail('out is ' + out2)
     self.assertEqual(out1, out2)
 
+  def test_diff_stats(self):
+    utils.write_file(self.TRACKED_FP, contents='contents\n')
+    utils.write_file(self.DIR_TRACKED_FP, contents='contents\ncontents\n')
+    out = utils.stdout(gl.diff('--numstat', _tty_out=False))
+    self.assertEqual(
+        '2\t1\t{0}\n1\t1\t{1}\n'.format(
+            self.DIR_TRACKED_FP, self.TRACKED_FP), out)
+    out = utils.stdout(gl.diff('--name-only', _tty_out=False))
+    self.assertEqual(
+        '{0}\n{1}\n'.format(self.DIR_TRACKED_FP, self.TRACKED_FP), out)
+    out = utils.stdout(gl.diff('--stat', _tty_out=False))
+    self.assertTrue(
+        '2 files changed, 3 insertions(+), 2 deletions(-)' in out,
+        msg='out is ' + out)
+    self.assertRaises(ErrorReturnCode, gl.diff, '--stat', '--numstat')
+
+    gl.commit(m='commit')
+    out = utils.stdout(gl.history('-s', _tty_out=False))
+    self.assertTrue(
+        '2 files changed, 3 insertions(+), 2 deletions(-)' in out,
+        msg='out is ' + out)
+
+  def test_diff_big_file(self):
+    utils.write_file(self.TRACKED_FP, contents='contents\n' * 3)
+    git.config('gitless.{0}.diffMaxLines'.format(self.TRACKED_FP), 2)
+    out = utils.stdout(gl.diff(_tty_out=False))
+    self.assertTrue(
+        'Not showing diffs for big file' in out, msg='out is ' + out)
+    self.assertTrue('New version: 3 lines' in out, msg='out is ' + out)
+    self.assertFalse('+contents' in out, msg='out is ' + out)
+    out = utils.stdout(gl.diff('--full', _tty_out=False))
+    self.assertTrue('+contents' in out, msg='out is ' + out)
+
+    gl.commit(m='commit')
+    out = utils.stdout(gl.history('-v', _tty_out=False))
+    self.assertTrue(
+        'Not showing diffs for big file' in out, msg='out is ' + out)
+    out = utils.stdout(gl.history('-v', '--full', _tty_out=False))
+    self.assertTrue('+contents' in out, msg='out is ' + out)
+
+  def test_diff_highlight(self):
+    utils.write_file(self.TRACKED_FP, contents='f(foo, x, y)\n')
+    gl.commit(o=self.TRACKED_FP, m='commit')
+    utils.write_file(self.TRACKED_FP, contents='f(bar, x, z)\n')
+    git.config('color.ui', True)
+    git.config('core.pager', 'cat')
+    out = utils.stdout(gl.diff())
+    bold = '\033[1;32m{0}\033[0m'.format
+    self.assertTrue(
+        '+f(' + bold('bar') + '\033[32m, x, ' + bold('z') in out,
+        msg='out is ' + out)
+
+    # No color if the output is not a tty
+    out = utils.stdout(gl.diff(_tty_out=False))
+    self.assertFalse('\033[' in out, msg='out is ' + out)
+    self.assertTrue('+f(bar, x, z)' in out, msg='out is ' + out)
+
 
 class TestOp(TestEndToEnd):
 
@@ -649,6 +908,148 @@ class TestMerge(TestOp):
     self.assertTrue('contents 2' in contents)
 
 
+class TestServer(TestEndToEnd):
+
+  def setUp(self):
+    super(TestServer, self).setUp()
+    utils.write_file('f1')
+    utils.write_file('f2')
+    gl.commit(o='f1', m='commit')
+
+  def tearDown(self):
+    gl.server('stop', _ok_code=[0, 1])
+    super(TestServer, self).tearDown()
+
+  def test_start_stop(self):
+    self.assertTrue('not running' in utils.stdout(gl.server('status')))
+    self.assertRaises(ErrorReturnCode, gl.server, 'stop')
+    gl.server('start')
+    self.assertTrue('is running' in utils.stdout(gl.server('status')))
+    sock_st = os.stat(os.path.join('.git', 'GL_SERVER_SOCK'))
+    self.assertEqual(0o600, sock_st.st_mode & 0o777)
+    self.assertRaises(ErrorReturnCode, gl.server, 'start')
+    gl.server('stop')
+    # Wait for the server to go away
+    for _ in range(0, 50):
+      if 'not running' in utils.stdout(gl.server('status')):
+        break
+      time.sleep(0.1)
+    else:
+      self.fail('Server didn\'t stop')
+
+  def test_same_output(self):
+    utils.write_file('f1', contents='modified')
+    status_out = utils.stdout(gl.status(_tty_out=False))
+    branch_out = utils.stdout(gl.branch(_tty_out=False))
+    gl.server('start')
+    self.assertEqual(status_out, utils.stdout(gl.status(_tty_out=False)))
+    self.assertEqual(branch_out, utils.stdout(gl.branch(_tty_out=False)))
+
+  def test_errors_and_cwd(self):
+    gl.server('start')
+    os.mkdir('dir')
+    os.chdir('dir')
+    self.assertTrue('//dir' in utils.stdout(gl.status(_tty_out=False)))
+    err = utils.stderr(gl.track('non-existent', _ok_code=[1]))
+    self.assertTrue('non-existent' in err)
+    self.assertRaises(ErrorReturnCode, gl.status, '--non-existent-flag')
+
+  def test_config_changes_are_seen(self):
+    utils.write_file('f1', contents='modified')
+    gl.server('start')
+    git.config('color.ui', 'false')
+    self.assertFalse('\x1b[' in utils.stdout(gl.status()))
+    git.config('color.ui', 'true')
+    self.assertTrue('\x1b[' in utils.stdout(gl.status()))
+
+  def test_changes_are_seen(self):
+    gl.server('start')
+    gl.track('f2')
+    utils.write_file('f3')
+    out = utils.stdout(gl.status(_tty_out=False))
+    self.assertTrue('f2 (new file)' in out)
+    self.assertTrue('f3' in out)
+
+
+@unittest.skipUnless(
+    sys.platform.startswith('linux'), 'the watcher needs inotify')
+class TestWatch(TestEndToEnd):
+
+  def setUp(self):
+    super(TestWatch, self).setUp()
+    utils.write_file('dir/f1')
+    utils.write_file('f2')
+    gl.commit(o='dir/f1', m='commit')
+
+  def tearDown(self):
+    gl.watch('stop', _ok_code=[0, 1])
+    super(TestWatch, self).tearDown()
+
+  def test_start_stop(self):
+    self.assertTrue('not running' in utils.stdout(gl.watch('status')))
+    self.assertRaises(ErrorReturnCode, gl.watch, 'stop')
+    gl.watch('start')
+    self.assertTrue('is running' in utils.stdout(gl.watch('status')))
+    self.assertRaises(ErrorReturnCode, gl.watch, 'start')
+    gl.watch('stop')
+    for _ in range(0, 50):
+      if 'not running' in utils.stdout(gl.watch('status')):
+        break
+      time.sleep(0.1)
+    else:
+      self.fail('Watcher didn\'t stop')
+
+  def test_changes_are_seen(self):
+    gl.watch('start')
+    gl.status()  # gets the first token
+    utils.write_file('dir/f1', contents='modified')
+    utils.write_file('dir/sub/f3')
+    os.remove('f2')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertTrue('dir/f1' in st)
+    self.assertTrue('dir/sub/' in st)
+    self.assertFalse('f2' in st)
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+
+    # The dir is no longer reported once it has no files in it
+    os.remove('dir/sub/f3')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertFalse('dir/sub/' in st)
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+
+    utils.write_file('dir/sub/f3')
+    utils.write_file('.gitignore', contents='sub')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertFalse('dir/sub/' in st)
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+
+  def test_ignored_dirs_not_watched(self):
+    utils.write_file('.gitignore', contents='build\n')
+    for i in range(0, 10):
+      utils.write_file('build/d{0}/f'.format(i))
+    gl.watch('start')
+    with io.open(os.path.join('.git', 'GL_WATCHER_PID')) as f:
+      fdinfo_dir = os.path.join('/proc', f.read().strip(), 'fdinfo')
+
+    def watches():
+      n = 0
+      for fd in os.listdir(fdinfo_dir):
+        with io.open(os.path.join(fdinfo_dir, fd)) as f:
+          n += sum(1 for l in f if l.startswith('inotify wd:'))
+      return n
+
+    # The root, dir, and the Git dir and its info dir
+    self.assertTrue(watches() <= 4, msg='{0} watches'.format(watches()))
+    gl.status()  # gets the first token
+
+    # Once build is no longer ignored it's watched
+    utils.write_file('.gitignore', contents='')
+    st = utils.stdout(gl.status(_tty_out=False))
+    self.assertTrue('build/' in st)
+    self.assertTrue(watches() > 10, msg='{0} watches'.format(watches()))
+    self.assertEqual(st, utils.stdout(gl.status('--no-cache', _tty_out=False)))
+
+
 class TestPerformance(TestEndToEnd):
 
   FPS_QTY = 10000
@@ -685,6 +1086,31 @@ class TestPerformance(TestEndToEnd):
     logging.info('Done')
     assert_status_performance()
 
+  def test_parallel_status_scaling(self):
+    # Status after touching all tracked files (so that they all need to be
+    # re-hashed) with 1, 4 and 16 workers. The timings are recorded (logged),
+    # how they scale depends too much on the machine to assert on them.
+    CONTENTS = 'x' * 64 * 1024
+
+    for i in range(0, self.FPS_QTY // 10):
+      utils.write_file('f' + text(i), CONTENTS)
+    git.add('.')
+    git.commit(m='commit')
+    expected = utils.stdout(gl.status('--no-cache', _tty_out=False))
+
+    times = {}
+    for workers in [1, 4, 16]:
+      t = time.time() - 60
+      for i in range(0, self.FPS_QTY):
+        os.utime('f' + text(i), (t, t))
+      t = time.time()
+      out = utils.stdout(gl.status('-j', workers, _tty_out=False))
+      times[workers] = time.time() - t
+      self.assertEqual(expected, out)
+    logging.info(
+        'status scaling (secs): 1 worker %s, 4 workers %s, 16 workers %s',
+        times[1], times[4], times[16])
+
   def test_branch_switch_performance(self):
     MAX_TOLERANCE = 100
 
@@ -708,3 +1134,176 @@ class TestPerformance(TestEndToEnd):
     self.assertTrue(
         gl_t < git_t*MAX_TOLERANCE,
         msg='gl_t {0}, git_t {1}'.format(gl_t, git_t))
+
+  def test_index_write_cost(self):
+    # The cost of the track and commit workloads is dominated by the writes of
+    # the whole index. They are timed before and after moving the index to
+    # version 4 of the format in split mode (which git can write but Gitless
+    # can't read, so the after is only timed with git) and after gl index
+    # --rewrite moves it back. The timings and the sizes of the index are
+    # recorded (logged), they depend too much on the machine to assert on
+    # them.
+    index_fp = os.path.join('.git', 'index')
+    git.add('.')
+    git.commit(m='commit')
+
+    def workload(name, track, commit):
+      fps = ['{0}{1}'.format(name, i) for i in range(0, self.FPS_QTY // 10)]
+      for fp in fps:
+        utils.write_file(fp, fp)
+      t = time.time()
+      track(*fps)
+      track_t = time.time() - t
+      t = time.time()
+      commit(m='commit')
+      commit_t = time.time() - t
+      # In split mode this is the size of the split part (what gets written)
+      return track_t, commit_t, os.path.getsize(index_fp)
+
+    def gl_commit(m):
+      gl.commit(m=m, _tty_out=False)
+
+    times = []
+    times.append(('before (gl)', workload('gl_v2_', gl.track, gl_commit)))
+    times.append(('before (git)', workload('git_v2_', git.add, git.commit)))
+    git('update-index', '--index-version', '4', '--split-index')
+    times.append((
+        'after (git, v4 split)', workload('git_v4_', git.add, git.commit)))
+    gl.index('--rewrite')
+    times.append((
+        'after gl index --rewrite (gl)',
+        workload('gl_rewritten_', gl.track, gl_commit)))
+    for name, (track_t, commit_t, size) in times:
+      logging.info(
+          'index write cost %s: track %.3fs, commit %.3fs, index of %s bytes',
+          name, track_t, commit_t, size)
+
+  def test_track_untrack_performance(self):
+    # The test fails if tracking (or untracking) all files takes more than 10
+    # times what `git add` (or `git update-index --assume-unchanged`) takes
+    MAX_TOLERANCE = 10
+
+    fps = ['f' + text(i) for i in range(0, self.FPS_QTY)]
+
+    t = time.time()
+    gl.track(*fps)
+    gl_t = time.time() - t
+    git.reset()
+
+    t = time.time()
+    git.add('.')
+    git_t = time.time() - t
+
+    self.assertTrue(
+        gl_t < git_t*MAX_TOLERANCE,
+        msg='gl_t {0}, git_t {1}'.format(gl_t, git_t))
+
+    git.commit(m='commit')
+
+    t = time.time()
+    gl.untrack(*fps)
+    gl_t = time.time() - t
+    git('update-index', '--no-assume-unchanged', *fps)
+
+    t = time.time()
+    git('update-index', '--assume-unchanged', *fps)
+    git_t = time.time() - t
+
+    self.assertTrue(
+        gl_t < git_t*MAX_TOLERANCE,
+        msg='gl_t {0}, git_t {1}'.format(gl_t, git_t))
+
+
+class TestHighlightPerformance(unittest.TestCase):
+  """Microbenchmarks of the intra-line highlighting of gl diff.
+
+  The corpus is made of the lines of Gitless's own source with an identifier
+  changed in each (as in a rename), and the same lines joined into one long
+  line (as in a minified or generated file). The tests check the sections
+  that are highlighted and that the cap on token diffing is honored (which is
+  what keeps highlighting linear in the length of the lines), the timings are
+  only logged (they are too noisy to assert on).
+  """
+
+  IDENTIFIER = re.compile(r'[A-Za-z_]\w*')
+  TOKEN_START = re.compile(r'\w*$', re.UNICODE)
+
+  def setUp(self):
+    from gitless.cli import pprint
+    self.pprint = pprint
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    self.lines = []
+    for fp in sorted(os.listdir(src_dir)):
+      if fp.endswith('.py'):
+        with io.open(os.path.join(src_dir, fp), encoding='utf-8') as f:
+          self.lines.extend(l for l in f if self.IDENTIFIER.search(l))
+
+  def changed_identifier(self, line):
+    ids = list(self.IDENTIFIER.finditer(line))
+    return ids[len(ids) // 2]
+
+  def edit(self, line):
+    # Change the identifier in the middle of the line
+    m = self.changed_identifier(line)
+    return line[:m.start()] + m.group() + '_changed' + line[m.end():]
+
+  def log_highlight_timings(self, pairs, name):
+    class DiffLine(object):
+      def __init__(self, origin, content):
+        self.origin = origin
+        self.content = content
+        self.old_lineno = self.new_lineno = 1
+
+    t = time.time()
+    for line1, line2 in pairs:
+      self.pprint._highlight(line1, line2)
+    highlight_t = time.time() - t
+
+    diff_lines = [
+        (DiffLine('-', line1), DiffLine('+', line2)) for line1, line2 in pairs]
+    t = time.time()
+    for del_line, add_line in diff_lines:
+      self.pprint._format_line(del_line, 8)
+      self.pprint._format_line(add_line, 8)
+    format_t = time.time() - t
+
+    logging.info(
+        'highlight of %s (%s pairs): %ss (formatting: %ss)', name, len(pairs),
+        highlight_t, format_t)
+
+  def test_highlight_source_lines(self):
+    pairs = [(l, self.edit(l)) for l in self.lines]
+    for line1, line2 in pairs:
+      unused_bold1, bold2 = self.pprint._highlight(line1, line2)
+      self.assertTrue(bold2, msg=line2)
+      # Only the token with the changed identifier is bolded (+ 1 for the
+      # leading +/- char)
+      m = self.changed_identifier(line1)
+      token_start = self.TOKEN_START.search(line1, 0, m.start()).start()
+      for start, end in bold2:
+        self.assertTrue(
+            token_start + 1 <= start and end <= m.end() + len('_changed') + 1,
+            msg='{0} in {1}'.format((start, end), line2))
+    self.log_highlight_timings(pairs, 'source lines')
+
+  def test_highlight_long_lines(self):
+    line = ''.join(l.strip() for l in self.lines)
+    pairs = [(line, self.edit(line))] * 10
+    bold1, bold2 = self.pprint._highlight(*pairs[0])
+    self.assertEqual(1, len(bold2))
+    self.assertTrue(bold2[0][1] - bold2[0][0] < 100)
+    self.log_highlight_timings(pairs, 'long lines')
+
+  def test_highlight_token_diff_cap(self):
+    # The changed section is longer than the cap, so it's bolded as a whole
+    # instead of diffing its tokens
+    words = ' '.join(
+        self.IDENTIFIER.findall(''.join(self.lines)))[
+            :self.pprint._MAX_TOKEN_DIFF_LEN]
+    line1 = 'f(' + words + ')'
+    line2 = 'f(' + ' '.join(reversed(words.split(' '))) + ')'
+    pairs = [(line1, line2)] * 10
+    bold1, bold2 = self.pprint._highlight(line1, line2)
+    self.assertEqual(1, len(bold1))
+    self.assertEqual(1, len(bold2))
+    self.log_highlight_timings(pairs, 'lines over the cap')
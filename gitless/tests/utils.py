@@ -69,6 +69,8 @@ def append_to_file(fp, contents=''):
 def set_test_config():
   git.config('user.name', 'test')
   git.config('user.email', 'test@test.com')
+  # So that a slow machine doesn't change the output of gl status
+  git.config('gitless.statusAdviceThreshold', '0')
 
 
 def read_file(fp):
@@ -1,9 +1,13 @@
 # -*- mode: python -*-
 import os
 
+from gitless.cli.gl import SUB_CMDS
+
 a = Analysis(['gl.py'],
              pathex=[os.getcwd()],
-             hiddenimports=['pygit2_cffi_51591433xe8494016'],
+             # gl imports the modules of subcommands lazily
+             hiddenimports=['pygit2_cffi_51591433xe8494016'] + [
+                 'gitless.cli.gl_' + subcmd for subcmd in SUB_CMDS],
              hookspath=None,
              runtime_hooks=None)
 
@@ -40,6 +40,8 @@ reqs = ['pygit2==0.23.0', 'sh==1.11', 'clint==0.3.6']
 if sys.version_info < (2, 7) or (
     sys.version_info < (3, 3) and sys.version_info > (3, 0)):
   reqs.append('argparse')
+if sys.version_info < (2, 7):
+  reqs.append('importlib')
 
 
 ld = """